@@ -0,0 +1,19 @@
+!TIGHT ARITHMETIC LOOP ON REGISTERS
+#DATA
+N 100000
+RES 0
+#CODE
+LDA T0 0
+LDA T1 1
+LDA T2 0
+LOOP:
+ADD T1 T0
+AND T1 65535
+OR T1 3
+SRL T1 1
+SRR T1 2
+SUB T2 T1
+INC T0
+BSM T0 N LOOP
+STR RES T1
+HLT
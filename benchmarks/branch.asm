@@ -0,0 +1,39 @@
+!BRANCH HEAVY: CLASSIFIES EVERY COUNTER VALUE BY ITS LOW BITS
+#DATA
+N 60000
+ODD 0
+FOURS 0
+OTHER 0
+#CODE
+LDA T0 0
+LOOP:
+LDA T1 T0
+AND T1 3
+BEQ T1 0 FOUR
+BEQ T1 2 EVEN
+BNE T1 1 ODD3
+LDA T2 ODD
+INC T2
+STR ODD T2
+JMP NEXT
+ODD3:
+BBG T1 2 THREE
+JMP NEXT
+THREE:
+LDA T2 ODD
+INC T2
+STR ODD T2
+JMP NEXT
+FOUR:
+LDA T2 FOURS
+INC T2
+STR FOURS T2
+JMP NEXT
+EVEN:
+LDA T2 OTHER
+INC T2
+STR OTHER T2
+NEXT:
+INC T0
+BSM T0 N LOOP
+HLT
@@ -0,0 +1,25 @@
+!MUL/DIV/MOD HEAVY: LINEAR CONGRUENTIAL GENERATOR WITH A RUNNING DIGIT SUM
+#DATA
+N 50000
+SEED 12345
+DIGITS 0
+#CODE
+LDA T0 SEED
+LDA T3 0
+LOOP:
+MUL T0 1103515245
+ADD T0 12345
+LDA T2 2147483648
+MOD T2 T0
+LDA T0 T2
+LDA T1 1000
+DIV T1 T0
+LDA T2 10
+MOD T2 T1
+ADD T3 T2
+LDA T1 N
+DEC T1
+STR N T1
+BBG T1 0 LOOP
+STR DIGITS T3
+HLT
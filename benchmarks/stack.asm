@@ -0,0 +1,24 @@
+!PUSH/POP HEAVY: BUILDS AND UNWINDS A STACK OF 64 WORDS PER ROUND
+#DATA
+ROUNDS 2000
+DEPTH 64
+SUM 0
+#CODE
+LDA T0 0
+ROUND:
+LDA T1 0
+FILL:
+PUSH T1
+PUSH DEPTH
+POP T2
+INC T1
+BSM T1 DEPTH FILL
+DRAIN:
+POP T2
+ADD T3 T2
+DEC T1
+BBG T1 0 DRAIN
+INC T0
+BSM T0 ROUNDS ROUND
+STR SUM T3
+HLT
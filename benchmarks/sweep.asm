@@ -0,0 +1,58 @@
+!MEMORY SWEEP: EVERY PASS READS, UPDATES AND WRITES BACK ARR+0 TO ARR+15 THROUGH A+n ADDRESSING
+#DATA
+PASSES 20000
+ARR 1
+#CODE
+LDA T0 0
+PASS:
+LDA T1 ARR
+ADD T1 T0
+STR ARR T1
+LDA T1 ARR+1
+ADD T1 T0
+STR ARR+1 T1
+LDA T1 ARR+2
+ADD T1 T0
+STR ARR+2 T1
+LDA T1 ARR+3
+ADD T1 T0
+STR ARR+3 T1
+LDA T1 ARR+4
+ADD T1 T0
+STR ARR+4 T1
+LDA T1 ARR+5
+ADD T1 T0
+STR ARR+5 T1
+LDA T1 ARR+6
+ADD T1 T0
+STR ARR+6 T1
+LDA T1 ARR+7
+ADD T1 T0
+STR ARR+7 T1
+LDA T1 ARR+8
+ADD T1 T0
+STR ARR+8 T1
+LDA T1 ARR+9
+ADD T1 T0
+STR ARR+9 T1
+LDA T1 ARR+10
+ADD T1 T0
+STR ARR+10 T1
+LDA T1 ARR+11
+ADD T1 T0
+STR ARR+11 T1
+LDA T1 ARR+12
+ADD T1 T0
+STR ARR+12 T1
+LDA T1 ARR+13
+ADD T1 T0
+STR ARR+13 T1
+LDA T1 ARR+14
+ADD T1 T0
+STR ARR+14 T1
+LDA T1 ARR+15
+ADD T1 T0
+STR ARR+15 T1
+INC T0
+BSM T0 PASSES PASS
+HLT
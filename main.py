@@ -1,8 +1,95 @@
+import argparse
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import platform
+import random
+import operator
 import re
-import tkinter as tk
-from tkinter import filedialog
-from tkinter import ttk
-import copy
+import struct
+import subprocess
+import sys
+import time
+from array import array
+from collections import deque
+
+
+class SimulatorError(Exception):
+    pass
+
+
+# Raised when the running program does something the machine cannot do,
+# such as overflowing the stack
+class SimulatorFault(SimulatorError):
+    pass
+
+
+# Raised when the source of a program is not valid assembly
+class AssemblerError(SimulatorError):
+    pass
+
+
+# Operand kinds resolved by the decoder
+REG = 'R'
+MEM = 'M'
+IMM = 'I'
+LABEL = 'L'
+
+# Opcode ids, in the same order as ALU.operations
+OPCODES = ('LDA', 'STR', 'PUSH', 'POP', 'AND', 'OR', 'NOT', 'ADD', 'SUB', 'DIV',
+           'MUL', 'MOD', 'INC', 'DEC', 'BEQ', 'BNE', 'BBG', 'BSM', 'JMP', 'HLT',
+           'SRR', 'SRL', 'NOP')
+OPCODE_IDS = {name: i for i, name in enumerate(OPCODES)}
+
+# Semantics shared by the execution engines. Two-operand instructions compute
+# reg1 = function(reg1, src), or function(src, reg1) for the reversed ones
+# (SUB, DIV and MOD take the second argument as left operand).
+ARITHMETIC = {'AND': operator.and_,
+              'OR': operator.or_,
+              'ADD': operator.add,
+              'MUL': operator.mul}
+REVERSED_ARITHMETIC = {'SUB': operator.sub,
+                       'DIV': operator.floordiv,
+                       'MOD': operator.mod}
+COMPARISONS = {'BEQ': operator.eq,
+               'BNE': operator.ne,
+               'BBG': operator.gt,
+               'BSM': operator.lt}
+
+
+class Operand:
+    __slots__ = ('kind', 'value')
+
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+
+    def __repr__(self):
+        return 'Operand(%r, %r)' % (self.kind, self.value)
+
+
+# A label at the start of a line of code
+LABEL_PATTERN = re.compile(r'(\w+):')
+
+
+# One decoded line of the program: opcode, resolved operands and the ALU handler
+# bound to them, so executing it needs no string work.
+class Instruction:
+    __slots__ = ('opcode', 'op', 'operands', 'handler', 'args', 'text', 'line')
+
+    def __init__(self, opcode, operands, text='', line=0):
+        self.opcode = opcode
+        self.op = OPCODE_IDS[opcode]
+        self.operands = tuple(operands)
+        self.handler = None
+        self.args = ()
+        self.text = text
+        self.line = line
+
+    def __repr__(self):
+        return 'Instruction(%r, %r)' % (self.opcode, list(self.operands))
 
 
 class Register:
@@ -10,37 +97,160 @@ class Register:
         self.value = 0
 
 
+# Wrap an int to a signed 32-bit word
+def to_word(value):
+    return ((value + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+
+# Bulk accesses must lie inside memory, where slicing would grow or truncate it
+def check_range(memory, address, count):
+    if address < 0 or count < 0 or address + count > len(memory):
+        raise IndexError("memory range %d to %d out of range" % (
+            address, address + count - 1))
+
+
+# Memory of signed 32-bit words, stored in an array so that snapshots are plain byte
+# copies. Writes wrap around like 32-bit arithmetic.
 class Memory:
     def __init__(self, size):
-        self.mem = [0] * size
+        self.mem = array('i', bytes(4 * size))
+
+    def __len__(self):
+        return len(self.mem)
 
     def read(self, address):
         return self.mem[address]
 
     def write(self, address, value):
-        self.mem[address] = value
+        try:
+            self.mem[address] = value
+        except OverflowError:
+            self.mem[address] = to_word(value)
+
+    # Bulk store of values starting at address
+    def load(self, address, values):
+        words = array('i', [to_word(value) for value in values])
+        check_range(self, address, len(words))
+        self.mem[address:address + len(words)] = words
+
+    # Bulk read of count words starting at address
+    def dump(self, address, count):
+        check_range(self, address, count)
+        return self.mem[address:address + count].tolist()
+
+    # Zero-copy view of count words starting at address
+    def view(self, address, count):
+        check_range(self, address, count)
+        return memoryview(self.mem)[address:address + count]
+
+    def snapshot(self):
+        return self.mem.tobytes()
+
+    def restore(self, snapshot):
+        memoryview(self.mem).cast('B')[:] = snapshot
 
     def copy(self):
-        new_memory = Memory(len(self.mem))
-        new_memory.mem = copy.deepcopy(self.mem)
+        new_memory = Memory(0)
+        new_memory.mem = array('i', self.mem)
         return new_memory
 
 
+# Sparse memory for large address spaces: words live in fixed-size pages that are only
+# allocated when first written. Untouched words read as 0.
+class PagedMemory:
+    def __init__(self, size, page_bits=10):
+        self.size = size
+        self.page_bits = page_bits
+        self.page_size = 1 << page_bits
+        self.mask = self.page_size - 1
+        self.pages = {}
+
+    def __len__(self):
+        return self.size
+
+    def read(self, address):
+        page = self.pages.get(address >> self.page_bits)
+        if page is None or address >= self.size:
+            if not 0 <= address < self.size:
+                raise IndexError("memory address %d out of range" % address)
+            return 0
+        return page[address & self.mask]
+
+    def write(self, address, value):
+        page = self.pages.get(address >> self.page_bits)
+        if page is None or address >= self.size:
+            page = self.allocate(address)
+        try:
+            page[address & self.mask] = value
+        except OverflowError:
+            page[address & self.mask] = to_word(value)
+
+    def allocate(self, address):
+        if not 0 <= address < self.size:
+            raise IndexError("memory address %d out of range" % address)
+        page = self.pages.get(address >> self.page_bits)
+        if page is None:
+            page = self.pages[address >> self.page_bits] = array('i', bytes(4 * self.page_size))
+        return page
+
+    def load(self, address, values):
+        values = list(values)
+        check_range(self, address, len(values))
+        for offset, value in enumerate(values):
+            self.write(address + offset, value)
+
+    def dump(self, address, count):
+        check_range(self, address, count)
+        return [self.read(a) for a in range(address, address + count)]
+
+    # Zero-copy when the range lies inside one allocated page, a copy otherwise
+    def view(self, address, count):
+        check_range(self, address, count)
+        page = self.pages.get(address >> self.page_bits)
+        start = address & self.mask
+        if page is not None and start + count <= self.page_size:
+            return memoryview(page)[start:start + count]
+        return memoryview(array('i', self.dump(address, count)))
+
+    def snapshot(self):
+        return {index: page.tobytes() for index, page in self.pages.items()}
+
+    def restore(self, snapshot):
+        self.pages = {index: array('i', data) for index, data in snapshot.items()}
+
+    def copy(self):
+        new_memory = PagedMemory(self.size, self.page_bits)
+        new_memory.restore(self.snapshot())
+        return new_memory
+
+
+MEMORIES = {'flat': Memory, 'paged': PagedMemory}
+
+
+# Fixed-capacity stack of 32-bit words; sp is the number of words on the stack.
 class Stack:
     def __init__(self, size):
-        self.stack = [None] * size
+        self.stack = array('i', bytes(4 * size))
         self.sp = 0
 
     def push(self, value):
-        self.stack[self.sp] = value
+        try:
+            self.stack[self.sp] = value
+        except IndexError:
+            raise SimulatorFault("stack overflow")
+        except OverflowError:
+            self.stack[self.sp] = to_word(value)
         self.sp += 1
 
     def pop(self):
+        if self.sp == 0:
+            raise SimulatorFault("stack underflow")
         self.sp -= 1
-        s = self.stack.pop(self.sp)
-        print('pop')
-        print(s)
-        return s
+        return self.stack[self.sp]
+
+    # Zero-copy view of the words currently on the stack, bottom first
+    def contents(self):
+        return memoryview(self.stack)[:self.sp]
 
 
 class ProgramCounter:
@@ -60,28 +270,32 @@ class ALU:
         self.memory = memory
         self.stack = stack
         self.program_counter = program_counter
-        self.operations = {'LDA': self.lda,
-                           'STR': self.str,
-                           'PUSH': self.push,
-                           'POP': self.pop,
-                           'AND': self.and_,
-                           'OR': self.or_,
-                           'NOT': self.not_,
-                           'ADD': self.add,
-                           'SUB': self.sub,
-                           'DIV': self.div,
-                           'MUL': self.mul,
-                           'MOD': self.mod,
-                           'INC': self.inc,
-                           'DEC': self.dec,
-                           'BEQ': self.beq,
-                           'BNE': self.bne,
-                           'BBG': self.bbg,
-                           'BSM': self.bsm,
-                           'JMP': self.jmp,
-                           'HLT': self.hlt,
-                           'SRR': self.srr,
-                           'SRL': self.srl,
+        # Handlers are selected by opcode and by the kinds of the operands, e.g. 'RM'
+        # for ADD T0 A. They take the operand values (register index, memory address,
+        # constant or label target) as plain ints.
+        self.operations = {'LDA': {'RR': self.lda_reg, 'RM': self.lda_mem, 'RI': self.lda_imm},
+                           'STR': {'MR': self.str_reg, 'MI': self.str_imm},
+                           'PUSH': {'R': self.push_reg, 'M': self.push_mem, 'I': self.push_imm},
+                           'POP': {'R': self.pop},
+                           'AND': {'RR': self.and_reg, 'RM': self.and_mem, 'RI': self.and_imm},
+                           'OR': {'RR': self.or_reg, 'RM': self.or_mem, 'RI': self.or_imm},
+                           'NOT': {'R': self.not_},
+                           'ADD': {'RR': self.add_reg, 'RM': self.add_mem, 'RI': self.add_imm},
+                           'SUB': {'RR': self.sub_reg, 'RM': self.sub_mem, 'RI': self.sub_imm},
+                           'DIV': {'RR': self.div_reg, 'RM': self.div_mem, 'RI': self.div_imm},
+                           'MUL': {'RR': self.mul_reg, 'RM': self.mul_mem, 'RI': self.mul_imm},
+                           'MOD': {'RR': self.mod_reg, 'RM': self.mod_mem, 'RI': self.mod_imm},
+                           'INC': {'R': self.inc},
+                           'DEC': {'R': self.dec},
+                           'BEQ': self.branches(COMPARISONS['BEQ']),
+                           'BNE': self.branches(COMPARISONS['BNE']),
+                           'BBG': self.branches(COMPARISONS['BBG']),
+                           'BSM': self.branches(COMPARISONS['BSM']),
+                           'JMP': {'L': self.jmp},
+                           'HLT': {'L': self.hlt},
+                           'SRR': {'RI': self.srr},
+                           'SRL': {'RI': self.srl},
+                           'NOP': {'': self.nop},
                            }
 
     # Part 1
@@ -90,148 +304,91 @@ class ALU:
     # Load register reg1 with the contents of either the contents of reg2, or the memory var or a constant const.
     #  Memory regions loads (load into a variable, for instance) are NOT ALLOWED.
 
-    def lda(self, reg1, reg2):
-
-        # check if reg1 and reg2 are registers (T0ˆ9)
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
-
-        # if reg2 is a register
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            self.registers[reg1].value = self.registers[reg2].value
+    def lda_reg(self, reg1, reg2):
+        self.registers[reg1].value = self.registers[reg2].value
 
-        # if reg2 is a variable => number as string
-        elif type(reg2) == str and re.match(r'\d+', reg2):
+    def lda_mem(self, reg1, var):
+        self.registers[reg1].value = self.memory.read(var)
 
-            self.registers[reg1].value = self.memory.read(int(reg2))
-        # if reg2 is a constant
-        else:
-            self.registers[reg1].value = int(reg2)
+    def lda_imm(self, reg1, const):
+        self.registers[reg1].value = const
 
     # 2. 2. STR <var> <reg>/<const>
     # Store in the memory position referred by var the value of register reg or a constant const.
     # Register stores (store into register t0, for instance) are NOT ALLOWED.
 
-    def str(self, var, reg):
+    def str_reg(self, var, reg):
+        self.memory.write(var, self.registers[reg].value)
 
-        var = int(var)
-        # if reg is a register
-        if re.match(r'T\d+', reg):
-            reg = int(reg[1:])
-            self.memory.write(var, self.registers[reg].value)
-        # if reg is a constant
-        else:
-            self.memory.write(var, int(reg))
+    def str_imm(self, var, const):
+        self.memory.write(var, const)
 
     # 3. PUSH <reg>/<var>/<const>
     # Push to the top of the stack the contents of reg or var or a constant const
 
-    def push(self, reg):
+    def push_reg(self, reg):
+        self.stack.push(self.registers[reg].value)
 
-        # if reg is a register
-        if re.match(r'T\d+', reg):
-            reg = int(reg[1:])
-            self.stack.push(self.registers[reg].value)
-        # if reg is a variable
-        elif re.match(r'\d+', reg):
-            self.stack.push(self.memory.read(int(reg)))
-        # if reg is a constant
-        else:
-            self.stack.push(reg)
+    def push_mem(self, var):
+        self.stack.push(self.memory.read(var))
+
+    def push_imm(self, const):
+        self.stack.push(const)
 
     # 4. POP <reg>
     # Pop from the top of the stack and store the value on reg. Storing in a memory region is NOT ALLOWED.
+
     def pop(self, reg):
-        if re.match(r'T\d+', reg):
-            reg = int(reg[1:])
-            self.registers[reg].value = self.stack.pop()
+        self.registers[reg].value = self.stack.pop()
 
     # 5. AND <reg1> <reg2>/<var>/<const>
     # Performs a logical AND operation between reg1 and a register reg2,
     # a variable var or a constant const, and store the result on register reg1.
     # Memory regions stores (store result into a variable, for instance) are NOT ALLOWED.
 
-    def and_(self, reg1, reg2):
-
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
+    def and_reg(self, reg1, reg2):
+        self.registers[reg1].value &= self.registers[reg2].value
 
-        # if reg2 is a register
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            self.registers[reg1].value = self.registers[reg1].value & self.registers[reg2].value
+    def and_mem(self, reg1, var):
+        self.registers[reg1].value &= self.memory.read(var)
 
-        # if reg2 is a variable
-        elif type(reg2) == str and re.match(r'\d+', reg2):
-
-            self.registers[reg1].value = self.registers[reg1].value & self.memory.read(
-                int(reg2))
-
-        # if reg2 is a constant
-        else:
-            self.registers[reg1].value = self.registers[reg1].value & self.memory.read(
-                reg2)
+    def and_imm(self, reg1, const):
+        self.registers[reg1].value &= const
 
     # 6. OR <reg1> <reg2>/<var>/<const>
     # Performs a logical OR operation between reg1 and a register reg2,
     # a variable var or a constant const, and store the result on register reg1.
     # Memory regions stores (store result into a variable, for instance) are NOT ALLOWED.
 
-    def or_(self, reg1, reg2):
-
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
-
-        # if reg2 is a register
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            self.registers[reg1].value = self.registers[reg1].value | self.registers[reg2].value
+    def or_reg(self, reg1, reg2):
+        self.registers[reg1].value |= self.registers[reg2].value
 
-        # if reg2 is a variable
-        elif type(reg2) == str and re.match(r'\d+', reg2):
+    def or_mem(self, reg1, var):
+        self.registers[reg1].value |= self.memory.read(var)
 
-            self.registers[reg1].value = self.registers[reg1].value | self.memory.read(
-                reg2)
-
-        # if reg2 is a constant
-        else:
-            self.registers[reg1].value = self.registers[reg1].value | int(reg2)
+    def or_imm(self, reg1, const):
+        self.registers[reg1].value |= const
 
     # 7. NOT <reg>
     # Performs a logical NOT operation on register reg and store the result on register reg.
     # Memory regions stores (store result into a variable, for instance) are NOT ALLOWED.
 
     def not_(self, reg):
-
-        if re.match(r'T\d+', reg):
-            reg = int(reg[1:])
-            self.registers[reg].value = ~self.registers[reg].value
+        self.registers[reg].value = ~self.registers[reg].value
 
     # 8. ADD <reg1> <reg2>/<var>/<const>
     # Performs the addition operation of reg1 and a register reg2, a variable var or a constant const,
     # and store the result on register reg1. Memory regions stores (store result into a variable, for
     # instance) are NOT ALLOWED.
 
-    def add(self, reg1, reg2):
-
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
+    def add_reg(self, reg1, reg2):
+        self.registers[reg1].value += self.registers[reg2].value
 
-        # if reg2 is a register
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            self.registers[reg1].value = self.registers[reg1].value + \
-                self.registers[reg2].value
+    def add_mem(self, reg1, var):
+        self.registers[reg1].value += self.memory.read(var)
 
-        # if reg2 is a variable
-        elif type(reg2) == str and re.match(r'\d+', reg2):
-
-            self.registers[reg1].value = self.registers[reg1].value + \
-                self.memory.read(reg2)
-        # if reg2 is a constant
-        else:
-            self.registers[reg1].value = self.registers[reg1].value + int(reg2)
+    def add_imm(self, reg1, const):
+        self.registers[reg1].value += const
 
     # 9. SUB <reg1> <reg2>/<var>/<const>
     # Performs the subtraction operation of reg1 and a register reg2,
@@ -239,27 +396,17 @@ class ALU:
     # The operation is given by second argument minus the first argument (i.e., reg2 – reg1).
     # Memory regions stores (store result into a variable, for instance) are NOT ALLOWED.
 
-    def sub(self, reg1, reg2):
-
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
+    def sub_reg(self, reg1, reg2):
+        register = self.registers[reg1]
+        register.value = self.registers[reg2].value - register.value
 
-        # if reg2 is a register
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            self.registers[reg1].value = self.registers[reg2].value - \
-                self.registers[reg1].value
+    def sub_mem(self, reg1, var):
+        register = self.registers[reg1]
+        register.value = self.memory.read(var) - register.value
 
-        # if reg2 is a variable
-        elif type(reg2) == str and re.match(r'\d+', reg2):
-
-            self.registers[reg1].value = self.memory.read(reg2) - \
-                self.registers[reg1].value
-
-        # if reg2 is a constant
-        else:
-            self.registers[reg1].value = int(reg2) - \
-                self.registers[reg1].value
+    def sub_imm(self, reg1, const):
+        register = self.registers[reg1]
+        register.value = const - register.value
 
     # 10. DIV <reg1> <reg2>/<var>/<const>
     # Performs the integer division operation of reg1 and a register reg2,
@@ -267,54 +414,37 @@ class ALU:
     # The operation is given by second argument divided by the first argument (i.e., reg2 / reg1).
     # Memory regions stores (store result into a variable, for instance) are NOT ALLOWED.
 
-    def div(self, reg1, reg2):
+    def div_reg(self, reg1, reg2):
+        register = self.registers[reg1]
+        if not register.value:
+            raise SimulatorFault("division by zero")
+        register.value = self.registers[reg2].value // register.value
 
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
+    def div_mem(self, reg1, var):
+        register = self.registers[reg1]
+        if not register.value:
+            raise SimulatorFault("division by zero")
+        register.value = self.memory.read(var) // register.value
 
-        # if reg2 is a register
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            self.registers[reg1].value = self.registers[reg2].value / \
-                self.registers[reg1].value
-
-        # if reg2 is a variable
-        elif type(reg2) == str and re.match(r'\d+', reg2):
-
-            self.registers[reg1].value = self.memory.read(reg2) / \
-                self.registers[reg1].value
-
-        # if reg2 is a constant
-        else:
-            self.registers[reg1].value = int(reg2) / \
-                self.registers[reg1].value
+    def div_imm(self, reg1, const):
+        register = self.registers[reg1]
+        if not register.value:
+            raise SimulatorFault("division by zero")
+        register.value = const // register.value
 
     # 11. MUL <reg1> <reg2>/<var>/<const>
     # Performs the multiplication operation of reg1 and a register reg2,
     # a variable var or a constant const, and store the result on register reg1.
     # Memory regions stores (store result into a variable, for instance) are NOT ALLOWED.
 
-    def mul(self, reg1, reg2):
-
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
-
-        # if reg2 is a register
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            self.registers[reg1].value = self.registers[reg2].value * \
-                self.registers[reg1].value
+    def mul_reg(self, reg1, reg2):
+        self.registers[reg1].value *= self.registers[reg2].value
 
-        # if reg2 is a variable
-        elif type(reg2) == str and re.match(r'\d+', reg2):
+    def mul_mem(self, reg1, var):
+        self.registers[reg1].value *= self.memory.read(var)
 
-            self.registers[reg1].value = self.memory.read(reg2) * \
-                self.registers[reg1].value
-
-        # if reg2 is a constant
-        else:
-            self.registers[reg1].value = int(reg2) * \
-                self.registers[reg1].value
+    def mul_imm(self, reg1, const):
+        self.registers[reg1].value *= const
 
     # 12. MOD <reg1> <reg2>/<var>/<const>
     # Performs the integer modulo operation of reg1 and a register reg2,
@@ -322,35 +452,29 @@ class ALU:
     # The operation is given by second argument modulo the first argument (i.e., reg2 mod reg1).
     # Memory regions stores (store result into a variable, for instance) are NOT ALLOWED.
 
-    def mod(self, reg1, reg2):
+    def mod_reg(self, reg1, reg2):
+        register = self.registers[reg1]
+        if not register.value:
+            raise SimulatorFault("division by zero")
+        register.value = self.registers[reg2].value % register.value
 
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
+    def mod_mem(self, reg1, var):
+        register = self.registers[reg1]
+        if not register.value:
+            raise SimulatorFault("division by zero")
+        register.value = self.memory.read(var) % register.value
 
-        # if reg2 is a register
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            self.registers[reg1].value = self.registers[reg2].value % \
-                self.registers[reg1].value
-
-        # if reg2 is a variable
-        elif type(reg2) == str and re.match(r'\d+', reg2):
-            self.registers[reg1].value = self.memory.read(reg2) % \
-                self.registers[reg1].value
-
-        # if reg2 is a constant
-        else:
-            self.registers[reg1].value = int(reg2) % \
-                self.registers[reg1].value
+    def mod_imm(self, reg1, const):
+        register = self.registers[reg1]
+        if not register.value:
+            raise SimulatorFault("division by zero")
+        register.value = const % register.value
 
     # 13. INC <reg>
     # Increments the value of register reg.
     # Memory increments (incrementing a variable, for instance) are NOT ALLOWED.
 
     def inc(self, reg):
-
-        if re.match(r'T\d+', reg):
-            reg = int(reg[1:])
         self.registers[reg].value += 1
 
     # 14. DEC <reg>
@@ -358,137 +482,71 @@ class ALU:
     # Memory increments (decrementing a variable, for instance) are NOT ALLOWED.
 
     def dec(self, reg):
-
-        if re.match(r'T\d+', reg):
-            reg = int(reg[1:])
         self.registers[reg].value -= 1
 
     # 15. BEQ <reg1>/<var1>/<const1> <reg2>/<var2>/<const2> <LABEL>
     # Performs a comparison between two values, given by registers, variables or constants.
     # Any combination is permitted. If they are equal, jump to the address defined by the label LABEL
 
-    def beq(self, reg1, reg2, label):
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
-            val1 = self.registers[reg1].value
-
-        elif type(reg1) == str and re.match(r'\d+', reg1):
-
-            val1 = self.memory.read(reg1)
-
-        else:
-            val1 = int(reg1)
-
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            val2 = self.registers[reg2].value
-
-        elif type(reg2) == str and re.match(r'\d+', reg2):
-
-            val2 = self.memory.read(reg2)
-
-        else:
-            val2 = int(reg2)
-
-        if val1 == val2:
-            self.program_counter.pc = label
-
     # 16. BNE <reg1>/<var1>/<const1> <reg2>/<var2>/<const2> <LABEL>
     # Performs a comparison between two values, given by registers, variables or constants.
     # Any combination is permitted. If they are different, jump to the address defined by the label LABEL
 
-    def bne(self, reg1, reg2, label):
-
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
-            val1 = self.registers[reg1].value
-
-        elif type(reg1) == str and re.match(r'\d+', reg1):
-
-            val1 = self.memory.read(reg1)
-
-        else:
-            val1 = int(reg1)
-
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            val2 = self.registers[reg2].value
-
-        elif type(reg2) == str and re.match(r'\d+', reg2):
-
-            val2 = self.memory.read(reg2)
-
-        else:
-            val2 = int(reg2)
-
-        if val1 != val2:
-            self.program_counter.pc = label
-
     # 17. BBG <reg1>/<var1>/<const1> <reg2>/<var2>/<const2> <LABEL>
     # Performs a comparison between two values, given by registers, variables or constants.
     # Any combination is permitted. If the first parameter is bigger than the second parameter,
     # jump to the address defined by the label LABEL
 
-    def bbg(self, reg1, reg2, label):
-
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
-            val1 = self.registers[reg1].value
-
-        elif type(reg1) == str and re.match(r'\d+', reg1):
-
-            val1 = self.memory.read(reg1)
-
-        else:
-            val1 = int(reg1)
-
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            val2 = self.registers[reg2].value
-
-        elif type(reg2) == str and re.match(r'\d+', reg2):
-
-            val2 = self.memory.read(reg2)
-
-        else:
-            val2 = int(reg2)
-
-        if val1 > val2:
-            self.program_counter.pc = label
-
     # 18. BSM <reg1>/<var1>/<const1> <reg2>/<var2>/<const2> <LABEL>
     # Performs a comparison between two values, given by registers, variables or constants.
     # Any combination is permitted. If the first parameter is smaller than the second parameter,
     #  jump to the address defined by the label LABEL
 
-    def bsm(self, reg1, reg2, label):
-        print('inside  bsm')
-        if re.match(r'T\d+', str(reg1)):
-            reg1 = int(reg1[1:])
-            val1 = self.registers[reg1].value
+    # Every combination of operand kinds gets its own handler, built around compare.
+    def branches(self, compare):
+        registers = self.registers
+        read = self.memory.read
+        program_counter = self.program_counter
 
-        elif type(reg1) == str and re.match(r'\d+', reg1):
+        def rr(reg1, reg2, label):
+            if compare(registers[reg1].value, registers[reg2].value):
+                program_counter.pc = label
 
-            val1 = self.memory.read(reg1)
+        def rm(reg1, var2, label):
+            if compare(registers[reg1].value, read(var2)):
+                program_counter.pc = label
 
-        else:
-            val1 = int(reg1)
+        def ri(reg1, const2, label):
+            if compare(registers[reg1].value, const2):
+                program_counter.pc = label
 
-        if re.match(r'T\d+', str(reg2)):
-            reg2 = int(reg2[1:])
-            val2 = self.registers[reg2].value
+        def mr(var1, reg2, label):
+            if compare(read(var1), registers[reg2].value):
+                program_counter.pc = label
 
-        elif type(reg2) == str and re.match(r'\d+', reg2):
-            val2 = self.memory.read(reg2)
+        def mm(var1, var2, label):
+            if compare(read(var1), read(var2)):
+                program_counter.pc = label
 
-        else:
-            val2 = int(reg2)
+        def mi(var1, const2, label):
+            if compare(read(var1), const2):
+                program_counter.pc = label
 
-        print(val1, val2)
+        def ir(const1, reg2, label):
+            if compare(const1, registers[reg2].value):
+                program_counter.pc = label
 
-        if val1 < val2:
-            print("Bsm")
-            self.program_counter.pc = label
+        def im(const1, var2, label):
+            if compare(const1, read(var2)):
+                program_counter.pc = label
+
+        def ii(const1, const2, label):
+            if compare(const1, const2):
+                program_counter.pc = label
+
+        return {'RRL': rr, 'RML': rm, 'RIL': ri,
+                'MRL': mr, 'MML': mm, 'MIL': mi,
+                'IRL': ir, 'IML': im, 'IIL': ii}
 
     # 19. JMP <LABEL>
     # Jump to the address defined by the label LABEL
@@ -497,10 +555,16 @@ class ALU:
         self.program_counter.pc = label
 
     # 20. HLT
-    # End the program execution.
+    # End the program execution. The decoder passes the index of the last instruction,
+    # so the program counter steps past the end of the program.
+
+    def hlt(self, last):
+        self.program_counter.pc = last
 
-    def hlt(self):
-        self.program_counter.pc = -1
+    # Empty line left behind by a label on its own line.
+
+    def nop(self):
+        pass
 
     # Part 2
 
@@ -509,167 +573,2687 @@ class ALU:
     #  by the constant const. For instance, the value 0001 left shifted 1 time becomes 0010.
 
     def srl(self, reg, const):
-
-        if re.match(r'T\d+', reg):
-            reg = int(reg[1:])
-            self.registers[reg].value = self.registers[reg].value << int(const)
+        self.registers[reg].value <<= const
 
     # b. SRR <reg> <const>
     # This operation takes the value in reg and performs a logical shift right of the number of bits defined
     # by the constant const. For instance, the value 1000 right shifted 1 time becomes 0100.
 
     def srr(self, reg, const):
+        self.registers[reg].value >>= const
+
+
+# Tracing. A Tracer is an observer of the simulator: it is told about every executed
+# instruction and writes a record to a sink. With no observers attached, Simulator.run
+# uses a loop without any tracing code in it.
+#
+# Observers have two methods: observe(pc, instruction), called after the instruction
+# at pc executed, and resume(), called before a run or step starts.
+
+TRACE_OFF = 0
+TRACE_INSTRUCTION = 1
+TRACE_OPERAND = 2
+TRACE_LEVELS = {'off': TRACE_OFF,
+                'instruction': TRACE_INSTRUCTION,
+                'operand': TRACE_OPERAND}
+
+
+# One JSON object per executed instruction, e.g.
+# {"step": 3, "pc": 2, "op": "ADD", "next": 3, "operands": [["R", 0, 25], ["R", 1, 15]]}
+# where each operand is [kind, operand value, value after execution].
+class JsonlTraceSink:
+    def __init__(self, file, buffer_size=1 << 20):
+        self.file = open(file, 'w', buffering=buffer_size)
+
+    def write(self, step, pc, instruction, next_pc, operands):
+        if operands is None:
+            self.file.write('{"step": %d, "pc": %d, "op": "%s", "next": %d}\n' % (
+                step, pc, instruction.opcode, next_pc))
+        else:
+            self.file.write('{"step": %d, "pc": %d, "op": "%s", "next": %d, "operands": %s}\n' % (
+                step, pc, instruction.opcode, next_pc, json.dumps(operands)))
 
-        if re.match(r'T\d+', reg):
-            reg = int(reg[1:])
-            self.registers[reg].value = self.registers[reg].value >> int(const)
+    def close(self):
+        self.file.close()
 
 
-class Simulator:
-    def __init__(self):
-        self.registers = [Register() for _ in range(4)]
-        self.memory = Memory(4096)
-        self.stack = Stack(4096)
-        self.program_counter = ProgramCounter()
-        self.alu = ALU(self.registers, self.memory,
-                       self.stack, self.program_counter)
+# Fixed-size little-endian records: step, pc, opcode id, next pc and operand count,
+# followed by kind, operand value and value after execution for each operand. Values
+# are stored as 64-bit ints, wrapped like to_int64.
+class BinaryTraceSink:
+    MAGIC = b'ASMT\x02'
+    RECORD = struct.Struct('<QIBIB')
+    OPERAND = struct.Struct('<Bqq')
 
-    def load_program(self, filename):
-        with open(filename, "r") as file:
-            lines = file.readlines()
+    def __init__(self, file, buffer_size=1 << 20):
+        self.file = open(file, 'wb', buffering=buffer_size)
+        self.file.write(self.MAGIC)
 
-        state = "start"
-        program = []
-        memory = {}
-        labels = {}
+    def write(self, step, pc, instruction, next_pc, operands):
+        if operands is None:
+            self.file.write(self.RECORD.pack(step, pc, instruction.op, next_pc, 0))
+            return
+        self.file.write(self.RECORD.pack(step, pc, instruction.op, next_pc, len(operands)))
+        for kind, value, current in operands:
+            self.file.write(self.OPERAND.pack(ord(kind), to_int64(value), to_int64(current)))
+
+    def close(self):
+        self.file.close()
+
+    # Yields (step, pc, opcode, next_pc, operands) for every record of a binary trace
+    @classmethod
+    def read(cls, file):
+        with open(file, 'rb') as trace:
+            if trace.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise SimulatorError("%s is not a binary trace" % file)
+            while True:
+                header = trace.read(cls.RECORD.size)
+                if not header:
+                    return
+                step, pc, op, next_pc, count = cls.RECORD.unpack(header)
+                operands = [cls.OPERAND.unpack(trace.read(cls.OPERAND.size))
+                            for _ in range(count)]
+                yield step, pc, OPCODES[op], next_pc, [
+                    (chr(kind), value, current) for kind, value, current in operands]
+
+
+TRACE_SINKS = {'jsonl': JsonlTraceSink, 'binary': BinaryTraceSink}
+
+
+def to_int64(value):
+    return (value + (1 << 63)) % (1 << 64) - (1 << 63)
+
+
+class Tracer:
+    def __init__(self, simulator, sink, level=TRACE_INSTRUCTION):
+        self.simulator = simulator
+        self.sink = sink
+        self.level = level
+        self.count = 0
+
+    def observe(self, pc, instruction):
+        self.count += 1
+        operands = None
+        if self.level >= TRACE_OPERAND:
+            operands = [[operand.kind, operand.value, self.simulator.operand_value(operand)]
+                        for operand in instruction.operands]
+        self.sink.write(self.count, pc, instruction,
+                        self.simulator.program_counter.pc, operands)
+
+    def resume(self):
+        pass
 
-        i = 0
-        for line in lines:
-            line = line.strip()
-            if not line or line.startswith("!"):
-                continue
+    def close(self):
+        self.sink.close()
+
+
+# What executing an instruction changes besides the program counter: nothing, one
+# register, one memory word, a push, or a pop into a register.
+
+EFFECT_NONE = 0
+EFFECT_REGISTER = 1
+EFFECT_MEMORY = 2
+EFFECT_PUSH = 3
+EFFECT_POP = 4
+
+
+def effect(instruction):
+    opcode = instruction.opcode
+    if opcode in COMPARISONS or opcode in ('JMP', 'HLT', 'NOP'):
+        return EFFECT_NONE, None
+    if opcode == 'STR':
+        return EFFECT_MEMORY, instruction.args[0]
+    if opcode == 'PUSH':
+        return EFFECT_PUSH, None
+    if opcode == 'POP':
+        return EFFECT_POP, instruction.args[0]
+    return EFFECT_REGISTER, instruction.args[0]
+
+
+# Observer collecting what executed instructions changed, so a view can redraw only
+# that. take() returns the dirty registers, dirty memory addresses and whether the
+# stack changed, and starts a new change set.
+class ChangeSet:
+    def __init__(self, simulator):
+        self.effects = [effect(instruction) for instruction in simulator.code]
+        self.register_count = len(simulator.registers)
+        self.registers = set()
+        self.addresses = set()
+        self.stack = False
+
+    def resume(self):
+        pass
 
-            if line.startswith("#DATA"):
-                state = "data"
-                continue
+    def observe(self, pc, instruction):
+        self.mark(pc)
+
+    def mark(self, pc):
+        kind, target = self.effects[pc]
+        if kind == EFFECT_REGISTER:
+            self.registers.add(target)
+        elif kind == EFFECT_MEMORY:
+            self.addresses.add(target)
+        elif kind == EFFECT_PUSH:
+            self.stack = True
+        elif kind == EFFECT_POP:
+            self.registers.add(target)
+            self.stack = True
+
+    # Registers and stack may all have changed, after steps that were not observed
+    def mark_all(self):
+        self.registers.update(range(self.register_count))
+        self.stack = True
+
+    def take(self):
+        changes = self.registers, self.addresses, self.stack
+        self.registers = set()
+        self.addresses = set()
+        self.stack = False
+        return changes
+
+
+# Reverse execution. Before each instruction executes, the undo log records only what
+# the instruction is about to change: one register, one memory word or the stack, and
+# the program counter. Full checkpoints every checkpoint_interval steps let seek() jump
+# far back without undoing every step. Both are kept within a memory budget in bytes:
+# the oldest undo entries are dropped, and checkpoints are thinned out.
+
+
+class UndoLog:
+    # Rough size of one entry: a 4-tuple and its ints
+    ENTRY_BYTES = 128
+
+    def __init__(self, simulator, budget=64 << 20, checkpoint_interval=10000):
+        self.simulator = simulator
+        self.budget = budget
+        self.checkpoint_interval = checkpoint_interval
+        self.entries = deque(maxlen=max(1, budget // 2 // self.ENTRY_BYTES))
+        self.checkpoints = deque()
+        self.checkpoint_bytes = 0
+        self.position = simulator.steps
+        self.effects = [effect(instruction) for instruction in simulator.code]
+        self.checkpoint()
+
+    # Called with the instruction about to execute at pc
+    def record(self, pc):
+        if self.position % self.checkpoint_interval == 0 and \
+                (not self.checkpoints or self.checkpoints[-1][0] != self.position):
+            self.checkpoint()
+
+        simulator = self.simulator
+        kind, target = self.effects[pc]
+        if kind == EFFECT_REGISTER or kind == EFFECT_POP:
+            old = simulator.registers[target].value
+        elif kind == EFFECT_MEMORY:
+            old = simulator.memory.read(target)
+        elif kind == EFFECT_PUSH:
+            stack = simulator.stack
+            target = stack.sp
+            old = stack.stack[target] if target < len(stack.stack) else 0
+        else:
+            old = None
+        self.entries.append((pc, kind, target, old))
+        self.position += 1
+
+    # Account for steps that ran without being recorded. The entries before them no
+    # longer lead back from the current state, so a checkpoint is taken instead and
+    # earlier steps are reached with seek().
+    def skip(self, steps):
+        if not steps:
+            return
+        self.entries.clear()
+        self.position += steps
+        self.checkpoint()
+
+    # Forget the last record, for an instruction that faulted instead of executing
+    def discard(self):
+        if self.entries:
+            self.entries.pop()
+        self.position -= 1
+
+    # Step back one instruction; returns False when there is no history left
+    def undo(self):
+        if not self.entries:
+            return False
+
+        simulator = self.simulator
+        pc, kind, target, old = self.entries.pop()
+        if kind == EFFECT_REGISTER:
+            simulator.registers[target].value = old
+        elif kind == EFFECT_MEMORY:
+            simulator.memory.write(target, old)
+        elif kind == EFFECT_PUSH:
+            simulator.stack.stack[target] = old
+            simulator.stack.sp = target
+        elif kind == EFFECT_POP:
+            simulator.registers[target].value = old
+            simulator.stack.sp += 1
+        simulator.program_counter.pc = pc
+        simulator.steps -= 1
+        self.position -= 1
+
+        while self.checkpoints and self.checkpoints[-1][0] > self.position:
+            self.drop_checkpoint(-1)
+        return True
+
+    # Move to the state after the given number of executed steps
+    def seek(self, step):
+        if step >= self.position:
+            self.simulator.run(step - self.position)
+            return
 
-            if line.startswith("#CODE"):
-                state = "code"
-                continue
+        checkpoint = None
+        for candidate in reversed(self.checkpoints):
+            if candidate[0] <= step:
+                checkpoint = candidate
+                break
+
+        oldest = self.position - len(self.entries)
+        if step >= oldest and (checkpoint is None or
+                               self.position - step <= step - checkpoint[0]):
+            while self.position > step:
+                self.undo()
+            return
 
-            if line.startswith("HLT"):
-                state = "end"
+        if checkpoint is None:
+            raise SimulatorError("step %d is no longer in the history" % step)
+        self.restore(checkpoint)
+        self.simulator.run(step - self.position)
+
+    def checkpoint(self):
+        simulator = self.simulator
+        memory = simulator.memory.snapshot()
+        stack = simulator.stack.stack.tobytes()
+        size = len(stack) + (len(memory) if isinstance(memory, bytes) else
+                             sum(len(page) for page in memory.values()))
+        self.checkpoints.append((self.position, size, simulator.program_counter.pc,
+                                 [r.value for r in simulator.registers],
+                                 memory, stack, simulator.stack.sp))
+        self.checkpoint_bytes += size
+
+        # Over budget: keep every other checkpoint and take them half as often, so
+        # that any step can still be reached from a checkpoint
+        while self.checkpoint_bytes > self.budget // 2 and len(self.checkpoints) > 1:
+            self.checkpoints = deque(list(self.checkpoints)[::2])
+            self.checkpoint_bytes = sum(checkpoint[1] for checkpoint in self.checkpoints)
+            self.checkpoint_interval *= 2
+
+    def drop_checkpoint(self, index):
+        self.checkpoint_bytes -= self.checkpoints[index][1]
+        del self.checkpoints[index]
+
+    def restore(self, checkpoint):
+        step, size, pc, registers, memory, stack, sp = checkpoint
+        simulator = self.simulator
+        for register, value in zip(simulator.registers, registers):
+            register.value = value
+        simulator.memory.restore(memory)
+        memoryview(simulator.stack.stack).cast('B')[:] = stack
+        simulator.stack.sp = sp
+        simulator.program_counter.pc = pc
+        simulator.steps = step
+
+        # The history after the checkpoint no longer applies
+        if self.position - step >= len(self.entries):
+            self.entries.clear()
+        else:
+            for _ in range(self.position - step):
+                self.entries.pop()
+        self.position = step
+        while self.checkpoints[-1][0] > step:
+            self.drop_checkpoint(-1)
+
+
+# Profiling. The profiler is an observer counting executions and time per program
+# counter, and taken branches; opcode, label region and flame graph views are derived
+# from those counts when a report is made. Time is measured between consecutive
+# instructions of a run, so profiled runs are slower than unobserved ones.
+class Profiler:
+    def __init__(self, simulator):
+        self.simulator = simulator
+        code = simulator.code
+        self.counts = [0] * len(code)
+        self.times = [0.0] * len(code)
+        self.taken = [0] * len(code)
+        self.branch = [instruction.opcode in COMPARISONS for instruction in code]
+        self.last = time.perf_counter()
+
+        # The region of an instruction is the last label at or before it
+        starts = sorted((index, label) for label, index in simulator.labels.items())
+        self.regions = []
+        region = '(start)'
+        for pc in range(len(code)):
+            while starts and starts[0][0] <= pc:
+                region = starts.pop(0)[1]
+            self.regions.append(region)
+
+    def resume(self):
+        self.last = time.perf_counter()
+
+    def observe(self, pc, instruction):
+        now = time.perf_counter()
+        self.counts[pc] += 1
+        self.times[pc] += now - self.last
+        self.last = now
+        if self.branch[pc] and self.simulator.program_counter.pc != pc + 1:
+            self.taken[pc] += 1
+
+    def opcodes(self):
+        result = {}
+        for pc, instruction in enumerate(self.simulator.code):
+            count, seconds = result.get(instruction.opcode, (0, 0.0))
+            result[instruction.opcode] = (count + self.counts[pc], seconds + self.times[pc])
+        return result
+
+    def label_regions(self):
+        result = {}
+        for pc, region in enumerate(self.regions):
+            count, seconds = result.get(region, (0, 0.0))
+            result[region] = (count + self.counts[pc], seconds + self.times[pc])
+        return result
+
+    # (pc, executions, taken, not taken) for every conditional branch that executed
+    def branches(self):
+        return [(pc, self.counts[pc], self.taken[pc], self.counts[pc] - self.taken[pc])
+                for pc in range(len(self.counts)) if self.branch[pc] and self.counts[pc]]
+
+    # The most executed sequences of length adjacent instructions that ran one after
+    # the other, as [(opcodes, executions)], for FusedEngine.fuse
+    def sequences(self, length=2, top=10):
+        code = self.simulator.code
+        # Executions of pc followed by pc + 1
+        through = [0 if instruction.opcode in ('JMP', 'HLT') else
+                   self.counts[pc] - self.taken[pc]
+                   for pc, instruction in enumerate(code)]
+        result = {}
+        for pc in range(len(code) - length + 1):
+            count = min(through[pc:pc + length - 1] + [self.counts[pc + length - 1]])
+            if count:
+                opcodes = tuple(instruction.opcode for instruction in code[pc:pc + length])
+                result[opcodes] = result.get(opcodes, 0) + count
+        return sorted(result.items(), key=lambda item: item[1], reverse=True)[:top]
+
+    def report(self, top=20):
+        code = self.simulator.code
+        total = sum(self.counts) or 1
+        lines = ["%-6s %-24s %12s %7s %10s" % ("pc", "instruction", "count", "%", "seconds")]
+        hot = sorted(range(len(code)), key=lambda pc: self.counts[pc], reverse=True)
+        for pc in hot[:top]:
+            if not self.counts[pc]:
+                break
+            lines.append("%-6d %-24s %12d %6.2f%% %10.4f" % (
+                pc, code[pc].text or code[pc].opcode, self.counts[pc],
+                100.0 * self.counts[pc] / total, self.times[pc]))
+
+        lines.append("")
+        lines.append("%-10s %12s %7s %10s" % ("opcode", "count", "%", "seconds"))
+        for opcode, (count, seconds) in sorted(self.opcodes().items(),
+                                               key=lambda item: item[1][0], reverse=True):
+            if count:
+                lines.append("%-10s %12d %6.2f%% %10.4f" % (
+                    opcode, count, 100.0 * count / total, seconds))
+
+        lines.append("")
+        lines.append("%-10s %12s %7s %10s" % ("region", "count", "%", "seconds"))
+        for region, (count, seconds) in sorted(self.label_regions().items(),
+                                               key=lambda item: item[1][1], reverse=True):
+            if count:
+                lines.append("%-10s %12d %6.2f%% %10.4f" % (
+                    region, count, 100.0 * count / total, seconds))
+
+        branches = self.branches()
+        if branches:
+            lines.append("")
+            lines.append("%-6s %-24s %12s %12s %12s" % (
+                "pc", "branch", "executed", "taken", "not taken"))
+            for pc, count, taken, not_taken in branches:
+                lines.append("%-6d %-24s %12d %12d %12d" % (
+                    pc, code[pc].text, count, taken, not_taken))
+        return "\n".join(lines)
+
+    # Collapsed stacks (program;region;instruction value), the input format of
+    # flamegraph.pl and speedscope. weight is 'count' or 'time' (microseconds).
+    def collapsed(self, weight='count'):
+        lines = []
+        for pc, instruction in enumerate(self.simulator.code):
+            if not self.counts[pc]:
                 continue
+            value = self.counts[pc] if weight == 'count' else int(self.times[pc] * 1e6)
+            lines.append("program;%s;%d %s %d" % (
+                self.regions[pc], pc, instruction.text or instruction.opcode, value))
+        return "\n".join(lines) + "\n"
+
+
+# Timing model for a simple in-order pipeline. Every instruction issues in one cycle;
+# opcodes with a latency above one stall the pipeline for the extra cycles, every
+# memory or stack access adds memory_latency cycles, and a taken branch (BEQ, BNE,
+# BBG, BSM, JMP) flushes branch_penalty cycles. The pipeline takes depth - 1 cycles to
+# fill. The static cost of each instruction is computed once, so while running the
+# model only counts executions and taken branches. Label lines (NOP) are not
+# instructions and cost nothing. With a branch predictor attached, conditional
+# branches cost branch_penalty cycles when mispredicted instead of when taken.
+class TimingModel:
+    LATENCIES = {'MUL': 3, 'DIV': 20, 'MOD': 20, 'NOP': 0}
+
+    def __init__(self, simulator, latencies=None, memory_latency=2, branch_penalty=2,
+                 depth=5):
+        self.simulator = simulator
+        self.latencies = dict(self.LATENCIES, **(latencies or {}))
+        self.memory_latency = memory_latency
+        self.branch_penalty = branch_penalty
+        self.depth = depth
+
+        code = simulator.code
+        self.counts = [0] * len(code)
+        self.taken = [0] * len(code)
+        self.branch = [instruction.opcode in COMPARISONS for instruction in code]
+        self.execute_stalls = [max(0, self.latencies.get(instruction.opcode, 1) - 1)
+                               for instruction in code]
+        self.accesses = [self.memory_accesses(instruction) for instruction in code]
+        # Other models adding stall cycles, as objects with a stalls() method
+        # returning {kind: cycles}
+        self.components = []
+        # BranchPrediction whose first predictor decides which branches stall
+        self.prediction = None
+
+    def memory_accesses(self, instruction):
+        if instruction.opcode in ('PUSH', 'POP'):
+            return 1 + sum(operand.kind == MEM for operand in instruction.operands)
+        return sum(operand.kind == MEM for operand in instruction.operands)
+
+    def resume(self):
+        pass
 
-            if state == "data":
-                variable, value = re.split(r'\s+', line)
-                memory[variable] = {'value': int(value), 'indice': i}
-                i += 1
-            elif state == "code":
-                # Check if the line contains a label
-                label_match = re.match(r'(\w+):', line)
-                if label_match:
-                    print('found label')
-                    label = label_match.group(1)
-                    # Store the label and its location
-                    labels[label] = len(program)
-                    # Remove the label from the line
-                    line = line.replace(label + ":", "").strip()
-
-                program.append(line)
-
-        # Initialize memory with the loaded variable values
-        for var, value in memory.items():
-            self.memory.write(value['indice'], value['value'])
-
-        print("program loaded")
-
-        return program, memory, labels
-
-    def execute_program(self, program, memory, labels):
-        self.program_counter.pc = self.program_counter.pc
-
-        instruction = program[self.program_counter.pc]
-        tokens = re.split(r'\s+', instruction)
-
-        if tokens[0] == "HLT":
-            return
-
-        operation = tokens[0]
-        print('labels: ', labels)
+    def observe(self, pc, instruction):
+        self.counts[pc] += 1
+        if self.branch[pc] and self.simulator.program_counter.pc != pc + 1:
+            self.taken[pc] += 1
 
-        for i in range(1, len(tokens)):
-            print("token: ", tokens[i])
+    # Branch executions that flush the pipeline: conditional branches that jumped (or
+    # were mispredicted), JMP and HLT
+    def branches_flushed(self):
+        if self.prediction is not None:
+            flushed = self.prediction.mispredictions()
+        else:
+            flushed = sum(self.taken)
+        for pc, instruction in enumerate(self.simulator.code):
+            if instruction.opcode in ('JMP', 'HLT'):
+                flushed += self.counts[pc]
+        return flushed
+
+    def stalls(self):
+        counts = self.counts
+        stalls = {'execute': sum(c * s for c, s in zip(counts, self.execute_stalls)),
+                  'memory': self.memory_latency * sum(
+                      c * a for c, a in zip(counts, self.accesses)),
+                  'branch': self.branch_penalty * self.branches_flushed()}
+        for component in self.components:
+            for kind, cycles in component.stalls().items():
+                stalls[kind] = stalls.get(kind, 0) + cycles
+        return stalls
+
+    def summary(self):
+        code = self.simulator.code
+        instructions = sum(count for count, instruction in zip(self.counts, code)
+                           if instruction.opcode != 'NOP')
+        stalls = self.stalls()
+        if instructions:
+            stalls['fill'] = self.depth - 1
+        cycles = instructions + sum(stalls.values())
+        return {'instructions': instructions,
+                'cycles': cycles,
+                'cpi': cycles / instructions if instructions else 0.0,
+                'stalls': stalls}
+
+    def report(self):
+        summary = self.summary()
+        lines = ["instructions %12d" % summary['instructions'],
+                 "cycles       %12d" % summary['cycles'],
+                 "CPI          %12.3f" % summary['cpi'],
+                 "",
+                 "%-10s %12s %7s" % ("stall", "cycles", "%")]
+        for kind, cycles in sorted(summary['stalls'].items(), key=lambda item: -item[1]):
+            lines.append("%-10s %12d %6.2f%%" % (
+                kind, cycles, 100.0 * cycles / summary['cycles'] if summary['cycles'] else 0))
+        return "\n".join(lines)
+
+
+# Cache simulation. Memory operand addresses are resolved by the decoder, so the words
+# every instruction reads or writes are known before the program runs; the cache
+# hierarchy replays the accesses of executed instructions through each level, either
+# observing them one at a time or replaying the blocks of a TracingEngine in batches.
+# Stack accesses (PUSH/POP) do not go through Memory and are not cached.
+
+CACHE_POLICIES = ('lru', 'fifo', 'random')
+
+
+# One set-associative level. Tags and use stamps are kept in flat arrays indexed by
+# set * associativity + way, with a dict from resident line to slot so that a hit is
+# a single lookup; the set is only scanned to choose a victim on a miss. Another
+# access to the line used last, the common case, skips even the lookup.
+class CacheLevel:
+    def __init__(self, name, size, line_size, associativity, latency, policy='lru', seed=0):
+        if line_size & (line_size - 1) or line_size < 4:
+            raise SimulatorError("cache line size must be a power of two of at least 4 bytes")
+        sets = size // (line_size * associativity)
+        if sets < 1:
+            raise SimulatorError("cache %s is smaller than one set" % name)
+        if policy not in CACHE_POLICIES:
+            raise SimulatorError("unknown cache policy %s" % policy)
+        self.name = name
+        self.size = size
+        self.line_size = line_size
+        self.associativity = associativity
+        self.latency = latency
+        self.policy = policy
+        self.sets = sets
+        # Memory addresses are of 4-byte words
+        self.shift = line_size.bit_length() - 3
+        self.tags = array('q', [-1]) * (sets * associativity)
+        self.stamps = array('q', bytes(8 * sets * associativity))
+        self.dirty = array('b', bytes(sets * associativity))
+        self.slots = {}
+        self.lru = policy == 'lru'
+        # The line accessed last and its slot
+        self.last = -1
+        self.last_slot = 0
+        self.clock = 0
+        self.random = random.Random(seed)
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+
+    # Returns True on a hit. On a miss the line is brought in (write-allocate).
+    def access(self, address, write):
+        line = address >> self.shift
+        if line == self.last:
+            # Already the most recently used line, so no stamp changes
+            self.hits += 1
+            if write:
+                self.dirty[self.last_slot] = 1
+            return True
+        self.clock += 1
+        slot = self.slots.get(line)
+        if slot is not None:
+            self.hits += 1
+            if self.lru:
+                self.stamps[slot] = self.clock
+            if write:
+                self.dirty[slot] = 1
+            self.last = line
+            self.last_slot = slot
+            return True
+
+        self.misses += 1
+        slot = self.victim(line % self.sets * self.associativity)
+        old = self.tags[slot]
+        if old != -1:
+            del self.slots[old]
+            if self.dirty[slot]:
+                self.writebacks += 1
+        self.tags[slot] = line
+        self.stamps[slot] = self.clock
+        self.dirty[slot] = 1 if write else 0
+        self.slots[line] = slot
+        self.last = line
+        self.last_slot = slot
+        return False
+
+    def victim(self, base):
+        end = base + self.associativity
+        tags = self.tags
+        for slot in range(base, end):
+            if tags[slot] == -1:
+                return slot
+        if self.policy == 'random':
+            return base + self.random.randrange(self.associativity)
+        stamps = self.stamps
+        return min(range(base, end), key=stamps.__getitem__)
+
+
+class CacheHierarchy:
+    LEVELS = ({'name': 'L1', 'size': 1024, 'line_size': 32, 'associativity': 2, 'latency': 1},
+              {'name': 'L2', 'size': 8192, 'line_size': 64, 'associativity': 4, 'latency': 10})
+
+    # levels are dicts of CacheLevel arguments, fastest first. A miss in a level costs
+    # the latency of the next one, and a miss in the last level costs memory_penalty.
+    def __init__(self, simulator, levels=None, policy='lru', memory_penalty=100):
+        self.simulator = simulator
+        self.levels = [CacheLevel(policy=policy, **level) for level in (levels or self.LEVELS)]
+        self.memory_penalty = memory_penalty
+
+        code = simulator.code
+        self.accesses = [self.memory_accesses(instruction) for instruction in code]
+        self.misses = [array('q', bytes(8 * len(code))) for _ in self.levels]
+        self.first = self.levels[0].access
+        self.first_misses = self.misses[0]
+        self.lower = list(zip(self.levels[1:], self.misses[1:]))
+        # Access streams of traced blocks, see replay
+        self.streams = {}
+
+    def memory_accesses(self, instruction):
+        operands = instruction.operands
+        if instruction.opcode == 'STR':
+            return ((operands[0].value, True),) + tuple(
+                (operand.value, False) for operand in operands[1:] if operand.kind == MEM)
+        return tuple((operand.value, False) for operand in operands if operand.kind == MEM)
+
+    def resume(self):
+        pass
 
-            # Check if a token is a label
-            if tokens[i] in labels:
-                print("found label")
-                tokens[i] = labels[tokens[i]]
-                print("label index: ", tokens[i])
+    def observe(self, pc, instruction):
+        for address, write in self.accesses[pc]:
+            if self.first(address, write):
+                continue
+            self.first_misses[pc] += 1
+            for level, misses in self.lower:
+                if level.access(address, write):
+                    break
+                misses[pc] += 1
+
+    # The accesses of a TracingEngine trace entry, with each run of consecutive
+    # accesses to one first-level line merged into (pc, address, write, written,
+    # repeats): only the first access of a run can miss, the repeats all hit the most
+    # recently used line, and written tells whether any access of the run writes.
+    # Returns (merged accesses, number of accesses).
+    def stream(self, key, blocks):
+        if key < 0:
+            pcs = [~key]
+        else:
+            pcs = range(key, key + blocks[key][1])
+        shift = self.levels[0].shift
+        merged = []
+        count = 0
+        for pc in pcs:
+            for address, write in self.accesses[pc]:
+                count += 1
+                if merged and merged[-1][1] >> shift == address >> shift:
+                    first_pc, first, first_write, written, repeats = merged[-1]
+                    merged[-1] = (first_pc, first, first_write, written or write, repeats + 1)
+                else:
+                    merged.append((pc, address, write, write, 0))
+        return tuple(merged), count
+
+    # Replay a TracingEngine trace. Once a stream has replayed without a first-level
+    # miss, the contents of the caches only change on a later miss, so until then it
+    # would hit again: its accesses are counted as hits, and under LRU the lines it
+    # uses are stamped in order of use before the next stream that is replayed.
+    def replay(self, trace, blocks):
+        streams = self.streams
+        first = self.levels[0]
+        access = first.access
+        first_misses = self.first_misses
+        lower = self.lower
+        hitting = set()
+        pending = {}
+        for key in trace:
+            stream = streams.get(key)
+            if stream is None:
+                stream = streams[key] = self.stream(key, blocks)
+            merged, count = stream
+            if key in hitting:
+                first.hits += count
+                if first.lru:
+                    pending.pop(key, None)
+                    pending[key] = merged
+                continue
+            if pending:
+                self.touch(pending)
+            misses = first.misses
+            for pc, address, write, written, repeats in merged:
+                if not access(address, written):
+                    first_misses[pc] += 1
+                    for level, level_misses in lower:
+                        if level.access(address, write):
+                            break
+                        level_misses[pc] += 1
+                first.hits += repeats
+            if first.misses == misses:
+                hitting.add(key)
+            else:
+                hitting.clear()
+        if pending:
+            self.touch(pending)
+
+    # Stamp the first-level lines of streams counted as hits, in order of last use
+    def touch(self, pending):
+        first = self.levels[0]
+        shift = first.shift
+        slots = first.slots
+        stamps = first.stamps
+        for merged in pending.values():
+            for pc, address, write, written, repeats in merged:
+                first.clock += 1
+                stamps[slots[address >> shift]] = first.clock
+        first.last = -1
+        pending.clear()
+
+    # Miss penalties, for TimingModel
+    def stalls(self):
+        cycles = 0
+        for i, level in enumerate(self.levels):
+            penalty = (self.levels[i + 1].latency if i + 1 < len(self.levels)
+                       else self.memory_penalty)
+            cycles += level.misses * penalty
+        return {'cache': cycles}
+
+    def summary(self):
+        return {'levels': [{'name': level.name,
+                            'hits': level.hits,
+                            'misses': level.misses,
+                            'hit_rate': level.hits / (level.hits + level.misses)
+                            if level.hits + level.misses else 0.0,
+                            'writebacks': level.writebacks}
+                           for level in self.levels],
+                'stall_cycles': self.stalls()['cache']}
+
+    def report(self, top=10):
+        lines = ["%-6s %12s %12s %8s %12s" % ("level", "hits", "misses", "hit %", "writebacks")]
+        for level in self.summary()['levels']:
+            lines.append("%-6s %12d %12d %7.2f%% %12d" % (
+                level['name'], level['hits'], level['misses'], 100.0 * level['hit_rate'],
+                level['writebacks']))
+
+        code = self.simulator.code
+        worst = sorted(range(len(code)), key=lambda pc: self.misses[0][pc], reverse=True)
+        worst = [pc for pc in worst[:top] if self.misses[0][pc]]
+        if worst:
+            lines.append("")
+            lines.append("%-6s %-24s" % ("pc", "instruction") + "".join(
+                " %10s" % ("%s miss" % level.name) for level in self.levels))
+            for pc in worst:
+                lines.append("%-6d %-24s" % (pc, code[pc].text) + "".join(
+                    " %10d" % misses[pc] for misses in self.misses))
+        return "\n".join(lines)
+
+
+# Branch prediction. Predictors watch the outcome of every conditional branch (BEQ,
+# BNE, BBG, BSM) and count, per branch program counter, how often they predicted it
+# wrong. Their tables are arrays of small counters indexed by the low bits of the
+# program counter. Several predictors can observe the same run, so a sweep over
+# configurations needs a single execution.
+
+class StaticPredictor:
+    def __init__(self, size, taken=False):
+        self.name = 'static-taken' if taken else 'static'
+        self.taken = taken
+        self.mispredicts = array('q', bytes(8 * size))
+
+    def record(self, pc, taken):
+        if taken != self.taken:
+            self.mispredicts[pc] += 1
+
+
+# Remembers the last outcome of each branch
+class OneBitPredictor:
+    def __init__(self, size, bits=10):
+        self.name = '1bit:%d' % bits
+        self.mask = (1 << bits) - 1
+        self.table = array('b', bytes(1 << bits))
+        self.mispredicts = array('q', bytes(8 * size))
+
+    def record(self, pc, taken):
+        index = pc & self.mask
+        if self.table[index] != taken:
+            self.mispredicts[pc] += 1
+            self.table[index] = taken
+
+
+# Saturating counters from 0 (strongly not taken) to 3 (strongly taken), starting
+# weakly not taken
+class TwoBitPredictor:
+    def __init__(self, size, bits=10):
+        self.name = '2bit:%d' % bits
+        self.mask = (1 << bits) - 1
+        self.table = array('b', [1]) * (1 << bits)
+        self.mispredicts = array('q', bytes(8 * size))
+
+    def record(self, pc, taken):
+        index = pc & self.mask
+        counter = self.table[index]
+        if (counter >= 2) != taken:
+            self.mispredicts[pc] += 1
+        if taken:
+            if counter < 3:
+                self.table[index] = counter + 1
+        elif counter > 0:
+            self.table[index] = counter - 1
+
+
+# Two-bit counters indexed by the program counter xor the global history of the
+# last `history` branch outcomes
+class GsharePredictor(TwoBitPredictor):
+    def __init__(self, size, bits=10, history=8):
+        super().__init__(size, bits)
+        self.name = 'gshare:%d:%d' % (bits, history)
+        self.history_mask = (1 << history) - 1
+        self.history = 0
+
+    def record(self, pc, taken):
+        index = (pc ^ self.history) & self.mask
+        counter = self.table[index]
+        if (counter >= 2) != taken:
+            self.mispredicts[pc] += 1
+        if taken:
+            if counter < 3:
+                self.table[index] = counter + 1
+        elif counter > 0:
+            self.table[index] = counter - 1
+        self.history = ((self.history << 1) | taken) & self.history_mask
+
+
+# Predictor from a specification: static, static-taken, 1bit[:BITS], 2bit[:BITS] or
+# gshare[:BITS[:HISTORY]]
+def make_predictor(spec, size):
+    name, *fields = spec.split(':')
+    try:
+        fields = [int(field) for field in fields]
+        if name == 'static' and not fields:
+            return StaticPredictor(size)
+        if name == 'static-taken' and not fields:
+            return StaticPredictor(size, taken=True)
+        if name == '1bit' and len(fields) <= 1:
+            return OneBitPredictor(size, *fields)
+        if name == '2bit' and len(fields) <= 1:
+            return TwoBitPredictor(size, *fields)
+        if name == 'gshare' and len(fields) <= 2:
+            return GsharePredictor(size, *fields)
+    except ValueError:
+        pass
+    raise SimulatorError("invalid branch predictor %s" % spec)
 
-            # Check if a token is a register
-            elif re.match(r'T\d+', tokens[i]):
-                print("found register")
 
-            # Check if a token is a variable (start with a letter)
-            elif re.match(r'[a-zA-Z]+', tokens[i]):
-                print("found variable")
+class BranchPrediction:
+    def __init__(self, simulator, specs=('2bit',), penalty=2):
+        self.simulator = simulator
+        self.penalty = penalty
+        code = simulator.code
+        self.predictors = [make_predictor(spec, len(code)) for spec in specs]
+        self.branch = [instruction.opcode in COMPARISONS for instruction in code]
+        self.counts = array('q', bytes(8 * len(code)))
 
-                # Check if it is A+n or A-n (indirect addressing)
-                if re.match(r'[a-zA-Z]+\+\d+', tokens[i]):
-                    print("found indirect addressing")
-                    var, value = re.split(r'\+', tokens[i])
-                    tokens[i] = str(memory[var]['indice'] + int(value))
-                elif re.match(r'[a-zA-Z]+\-\d+', tokens[i]):
-                    print("found indirect addressing")
-                    var, value = re.split(r'\-', tokens[i])
-                    tokens[i] = str(memory[var]['indice'] - int(value))
+    def resume(self):
+        pass
 
+    def observe(self, pc, instruction):
+        if self.branch[pc]:
+            taken = self.simulator.program_counter.pc != pc + 1
+            self.counts[pc] += 1
+            for predictor in self.predictors:
+                predictor.record(pc, taken)
+
+    # Mispredictions of the first predictor, for TimingModel
+    def mispredictions(self):
+        return sum(self.predictors[0].mispredicts)
+
+    def summary(self):
+        branches = sum(self.counts)
+        result = []
+        for predictor in self.predictors:
+            mispredicts = sum(predictor.mispredicts)
+            result.append({'predictor': predictor.name,
+                           'branches': branches,
+                           'mispredictions': mispredicts,
+                           'accuracy': 1.0 - mispredicts / branches if branches else 1.0,
+                           'penalty_cycles': mispredicts * self.penalty})
+        return result
+
+    def report(self):
+        lines = ["%-16s %12s %12s %9s %14s" % (
+            "predictor", "branches", "mispredicts", "accuracy", "penalty cycles")]
+        for entry in self.summary():
+            lines.append("%-16s %12d %12d %8.2f%% %14d" % (
+                entry['predictor'], entry['branches'], entry['mispredictions'],
+                100.0 * entry['accuracy'], entry['penalty_cycles']))
+
+        code = self.simulator.code
+        lines.append("")
+        lines.append("%-6s %-24s %10s" % ("pc", "branch", "executed") + "".join(
+            " %14s" % predictor.name for predictor in self.predictors))
+        for pc, count in enumerate(self.counts):
+            if count:
+                lines.append("%-6d %-24s %10d" % (pc, code[pc].text, count) + "".join(
+                    " %13.2f%%" % (100.0 - 100.0 * predictor.mispredicts[pc] / count)
+                    for predictor in self.predictors))
+        return "\n".join(lines)
+
+
+# Static optimizer. The decoded program is split into basic blocks, which start at
+# branch targets and after branches, and linked into a control-flow graph. Constant
+# propagation runs forward over the graph, following only the branch edges that can
+# be taken, and tracks the T registers and every memory address the program names.
+# Registers start at zero; memory starts unknown, since #DATA values can be
+# overridden. Instructions with a known result become LDA of a constant, known
+# operands become constants and branches with a known outcome become JMP or are
+# dropped. A backward liveness pass then removes instructions whose register or STR
+# result is overwritten before being read; everything is live when the program ends.
+# Unreachable blocks and label lines are removed and branch targets renumbered.
+
+# Folded constants stay within 64 bits
+FOLD_LIMIT = 1 << 63
+
+
+class Optimizer:
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.instructions = len(simulator.code)
+        self.folded = 0
+        self.unreachable = 0
+        self.dead = 0
+
+    # Program counters that can execute after the instruction at pc
+    @staticmethod
+    def successors(pc, instruction):
+        if instruction.opcode in ('JMP', 'HLT'):
+            return (instruction.args[0] + 1,)
+        if instruction.opcode in COMPARISONS:
+            return (pc + 1, instruction.args[2] + 1)
+        return (pc + 1,)
+
+    # Basic blocks as {start: end}
+    def blocks(self, code):
+        leaders = {0}
+        for pc, instruction in enumerate(code):
+            if instruction.opcode in COMPARISONS or instruction.opcode in ('JMP', 'HLT'):
+                leaders.update(self.successors(pc, instruction))
+                leaders.add(pc + 1)
+        starts = sorted(pc for pc in leaders if pc < len(code))
+        return dict(zip(starts, starts[1:] + [len(code)]))
+
+    def optimize(self):
+        code = self.simulator.code
+        rewritten, reached = self.propagate(code)
+        code, labels = self.compact(rewritten, reached, self.simulator.labels)
+        keep = self.live(code)
+        self.dead = keep.count(False)
+        code, labels = self.compact(code, keep, labels)
+        return [instruction.text for instruction in code], labels, code
+
+    def stats(self):
+        return {'instructions': self.instructions,
+                'folded': self.folded,
+                'unreachable': self.unreachable,
+                'dead': self.dead}
+
+    # Constant propagation
+
+    @staticmethod
+    def value(state, operand):
+        registers, memory = state
+        if operand.kind == REG:
+            return registers[operand.value]
+        if operand.kind == MEM:
+            return memory.get(operand.value)
+        return operand.value
+
+    # Value written to the first operand register, if known
+    def result(self, state, instruction):
+        opcode = instruction.opcode
+        operands = instruction.operands
+        if opcode == 'LDA':
+            return self.value(state, operands[1])
+        current = self.value(state, operands[0])
+        if opcode == 'POP' or current is None:
+            return None
+
+        if opcode in ARITHMETIC or opcode in REVERSED_ARITHMETIC:
+            src = self.value(state, operands[1])
+            if src is None:
+                return None
+            if opcode in ARITHMETIC:
+                result = ARITHMETIC[opcode](current, src)
+            elif opcode in ('DIV', 'MOD') and current == 0:
+                return None
+            else:
+                result = REVERSED_ARITHMETIC[opcode](src, current)
+        elif opcode == 'NOT':
+            result = ~current
+        elif opcode == 'INC':
+            result = current + 1
+        elif opcode == 'DEC':
+            result = current - 1
+        elif opcode == 'SRL' and operands[1].value < 64:
+            result = current << operands[1].value
+        elif opcode == 'SRR':
+            result = current >> operands[1].value
+        else:
+            return None
+        return result if -FOLD_LIMIT <= result < FOLD_LIMIT else None
+
+    def execute(self, state, instruction):
+        registers, memory = state
+        opcode = instruction.opcode
+        if opcode == 'STR':
+            value = self.value(state, instruction.operands[1])
+            if value is None:
+                memory.pop(instruction.args[0], None)
+            else:
+                memory[instruction.args[0]] = to_word(value)
+        elif opcode not in ('PUSH', 'NOP', 'JMP', 'HLT') and opcode not in COMPARISONS:
+            registers[instruction.args[0]] = self.result(state, instruction)
+
+    # True or False when the branch at the end of a block is known to be taken or not
+    def outcome(self, state, instruction):
+        if instruction.opcode not in COMPARISONS:
+            return None
+        first = self.value(state, instruction.operands[0])
+        second = self.value(state, instruction.operands[1])
+        if first is None or second is None:
+            return None
+        return COMPARISONS[instruction.opcode](first, second)
+
+    @staticmethod
+    def meet(state, incoming):
+        if state is None:
+            return list(incoming[0]), dict(incoming[1])
+        registers = [value if value == other else None
+                     for value, other in zip(state[0], incoming[0])]
+        memory = {address: value for address, value in state[1].items()
+                  if incoming[1].get(address) == value}
+        return registers, memory
+
+    # Rewrites the program from the constants known at every reachable instruction;
+    # returns the new instructions (None where dropped) and which ones are reachable
+    def propagate(self, code):
+        blocks = self.blocks(code)
+        entry = dict.fromkeys(blocks)
+        if code:
+            entry[0] = ([0] * len(self.simulator.registers), {})
+        worklist = [0] if code else []
+        while worklist:
+            start = worklist.pop()
+            state = list(entry[start][0]), dict(entry[start][1])
+            for pc in range(start, blocks[start] - 1):
+                self.execute(state, code[pc])
+            last = blocks[start] - 1
+            successors = self.successors(last, code[last])
+            taken = self.outcome(state, code[last])
+            if taken is not None:
+                successors = successors[1:] if taken else successors[:1]
+            self.execute(state, code[last])
+            for successor in successors:
+                if successor < len(code):
+                    merged = self.meet(entry[successor], state)
+                    if merged != entry[successor]:
+                        entry[successor] = merged
+                        worklist.append(successor)
+
+        rewritten = list(code)
+        reached = [False] * len(code)
+        for start, end in blocks.items():
+            if entry[start] is None:
+                self.unreachable += end - start
+                continue
+            state = list(entry[start][0]), dict(entry[start][1])
+            for pc in range(start, end):
+                reached[pc] = True
+                rewritten[pc] = self.rewrite(state, code[pc])
+                self.execute(state, code[pc])
+        return rewritten, reached
+
+    def rewrite(self, state, instruction):
+        opcode = instruction.opcode
+        operands = list(instruction.operands)
+        tokens = instruction.text.split()
+
+        taken = self.outcome(state, instruction)
+        if taken is False:
+            self.folded += 1
+            return None
+        if taken:
+            self.folded += 1
+            return self.instruction('JMP', [operands[2]], ['JMP', tokens[3]], instruction)
+
+        if opcode not in ('STR', 'PUSH', 'POP', 'NOP', 'JMP', 'HLT') and \
+                opcode not in COMPARISONS:
+            result = self.result(state, instruction)
+            if result is not None:
+                if opcode == 'LDA' and operands[1].kind == IMM:
+                    return instruction
+                self.folded += 1
+                return self.instruction('LDA', [operands[0], Operand(IMM, result)],
+                                        ['LDA', tokens[1], str(result)], instruction)
+
+        # Operands read as sources that can be constants instead
+        if opcode in ('STR', 'LDA') or opcode in ARITHMETIC or opcode in REVERSED_ARITHMETIC:
+            sources = (1,)
+        elif opcode == 'PUSH':
+            sources = (0,)
+        elif opcode in COMPARISONS:
+            sources = (0, 1)
+        else:
+            sources = ()
+        changed = False
+        for index in sources:
+            value = self.value(state, operands[index])
+            if operands[index].kind != IMM and value is not None:
+                operands[index] = Operand(IMM, value)
+                tokens[index + 1] = str(value)
+                changed = True
+        if not changed:
+            return instruction
+        self.folded += 1
+        return self.instruction(opcode, operands, tokens, instruction)
+
+    def instruction(self, opcode, operands, tokens, original):
+        instruction = Instruction(opcode, operands, ' '.join(tokens), original.line)
+        self.simulator.bind(instruction)
+        return instruction
+
+    # Liveness
+
+    @staticmethod
+    def reads(instruction):
+        opcode = instruction.opcode
+        operands = instruction.operands
+        if opcode in ('LDA', 'STR'):
+            operands = operands[1:]
+        elif opcode in ('POP', 'JMP', 'HLT', 'NOP'):
+            operands = ()
+        elif opcode in COMPARISONS:
+            operands = operands[:2]
+        return [(operand.kind, operand.value) for operand in operands
+                if operand.kind in (REG, MEM)]
+
+    # The register or memory word written by an instruction that does nothing else
+    @staticmethod
+    def writes(instruction):
+        opcode = instruction.opcode
+        if opcode in ('PUSH', 'POP', 'DIV', 'MOD', 'NOP', 'JMP', 'HLT') or \
+                opcode in COMPARISONS:
+            return None
+        operand = instruction.operands[0]
+        return operand.kind, operand.value
+
+    # Which instructions to keep: those whose result may be read, or that do more
+    # than write a register or memory word
+    def live(self, code):
+        everything = {(REG, index) for index in range(len(self.simulator.registers))}
+        everything.update((MEM, operand.value) for instruction in code
+                          for operand in instruction.operands if operand.kind == MEM)
+        blocks = self.blocks(code)
+        predecessors = {start: [] for start in blocks}
+        for start, end in blocks.items():
+            for successor in self.successors(end - 1, code[end - 1]):
+                if successor < len(code):
+                    predecessors[successor].append(start)
+
+        def live_out(start):
+            live = set()
+            for successor in self.successors(blocks[start] - 1, code[blocks[start] - 1]):
+                live |= live_in[successor] if successor < len(code) else everything
+            return live
+
+        live_in = dict.fromkeys(blocks, frozenset())
+        worklist = list(blocks)
+        while worklist:
+            start = worklist.pop()
+            live = live_out(start)
+            for pc in range(blocks[start] - 1, start - 1, -1):
+                written = self.writes(code[pc])
+                if written is not None:
+                    if written not in live:
+                        continue
+                    live.discard(written)
+                live.update(self.reads(code[pc]))
+            if live != live_in[start]:
+                live_in[start] = frozenset(live)
+                worklist.extend(predecessors[start])
+
+        keep = [True] * len(code)
+        for start, end in blocks.items():
+            live = live_out(start)
+            for pc in range(end - 1, start - 1, -1):
+                written = self.writes(code[pc])
+                if written is not None:
+                    if written not in live:
+                        keep[pc] = False
+                        continue
+                    live.discard(written)
+                live.update(self.reads(code[pc]))
+        return keep
+
+    # The instructions to keep, with branch targets and labels renumbered. A branch
+    # to label index l continues at l + 1, so it now points just before the first
+    # instruction kept from l + 1 on; a NOP is kept first if that would be -1.
+    def compact(self, code, keep, labels):
+        kept = [instruction is not None and keep[pc] and instruction.opcode != 'NOP'
+                for pc, instruction in enumerate(code)]
+        index = [0]
+        for flag in kept:
+            index.append(index[-1] + flag)
+        targets = [instruction.args[0 if instruction.opcode in ('JMP', 'HLT') else 2] + 1
+                   for pc, instruction in enumerate(code) if kept[pc] and (
+                       instruction.opcode in ('JMP', 'HLT') or instruction.opcode in COMPARISONS)]
+        targets.extend(label + 1 for label in labels.values())
+        lead = any(index[target] == 0 for target in targets)
+
+        result = []
+        if lead:
+            result.append(Instruction('NOP', [], '', min(
+                (instruction.line for instruction in code if instruction is not None),
+                default=0)))
+            self.simulator.bind(result[0])
+        for pc, instruction in enumerate(code):
+            if not kept[pc]:
+                continue
+            opcode = instruction.opcode
+            if opcode in ('JMP', 'HLT') or opcode in COMPARISONS:
+                operands = list(instruction.operands)
+                operands[-1] = Operand(LABEL, index[operands[-1].value + 1] - 1 + lead)
+                instruction = self.instruction(opcode, operands, instruction.text.split(),
+                                               instruction)
+            result.append(instruction)
+        return result, {label: index[value + 1] - 1 + lead for label, value in labels.items()}
+
+
+# Execution engines. An engine is built from a loaded simulator and runs its decoded
+# program: run(limit) executes up to limit instructions (-1 for no limit) starting at
+# the program counter, leaves the program counter on the next instruction and returns
+# the number of instructions executed. When an instruction faults, every engine leaves
+# the same state as the interpreter, with the program counter on that instruction,
+# and lets the error propagate.
+
+# Leave the simulator on the instruction that raised error, counting the steps of the
+# run before it. A block of translated code sets error.executed to the number of its
+# instructions that completed before the fault.
+def stop_at_fault(simulator, pc, steps, error):
+    executed = getattr(error, 'executed', 0)
+    simulator.program_counter.pc = pc + executed
+    simulator.steps += steps + executed
+
+
+class Interpreter:
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def run(self, limit):
+        code = self.simulator.code
+        program_counter = self.simulator.program_counter
+        end = len(code)
+        steps = 0
+        try:
+            while program_counter.pc < end and steps != limit:
+                instruction = code[program_counter.pc]
+                instruction.handler(*instruction.args)
+                program_counter.pc += 1
+                steps += 1
+        except SimulatorError as error:
+            stop_at_fault(self.simulator, program_counter.pc, steps, error)
+            raise
+        return steps
+
+    def stats(self):
+        return {}
+
+
+# Compiles every instruction into a closure over its registers, addresses and
+# constants that executes it and returns the next program counter.
+class ClosureEngine:
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.code = [self.compile(pc, instruction)
+                     for pc, instruction in enumerate(simulator.code)]
+
+    def run(self, limit):
+        code = self.code
+        program_counter = self.simulator.program_counter
+        end = len(code)
+        pc = program_counter.pc
+        steps = 0
+        try:
+            while pc < end and steps != limit:
+                pc = code[pc]()
+                steps += 1
+        except SimulatorError as error:
+            stop_at_fault(self.simulator, pc, steps, error)
+            raise
+        program_counter.pc = pc
+        return steps
+
+    def stats(self):
+        return {}
+
+    def compile(self, pc, instruction):
+        simulator = self.simulator
+        registers = simulator.registers
+        read = simulator.memory.read
+        write = simulator.memory.write
+        opcode = instruction.opcode
+        modes = ''.join(operand.kind for operand in instruction.operands)
+        args = instruction.args
+        next_pc = pc + 1
+
+        if opcode == 'NOP':
+            return lambda: next_pc
+
+        # Branch targets are label indices; execution continues after the label line
+        if opcode in ('JMP', 'HLT'):
+            target = args[0] + 1
+            return lambda: target
+
+        if opcode in COMPARISONS:
+            return self.compile_branch(COMPARISONS[opcode], modes, args, next_pc)
+
+        if opcode == 'STR':
+            var, src = args
+            if modes == 'MR':
+                r = registers[src]
+
+                def run():
+                    write(var, r.value)
+                    return next_pc
+            else:
+                def run():
+                    write(var, src)
+                    return next_pc
+            return run
+
+        if opcode == 'PUSH':
+            push = simulator.stack.push
+            src = args[0]
+            if modes == 'R':
+                r = registers[src]
+
+                def run():
+                    push(r.value)
+                    return next_pc
+            elif modes == 'M':
+                def run():
+                    push(read(src))
+                    return next_pc
+            else:
+                def run():
+                    push(src)
+                    return next_pc
+            return run
+
+        # Every remaining instruction writes its first operand, a register
+        r1 = registers[args[0]]
+
+        if opcode == 'POP':
+            pop = simulator.stack.pop
+
+            def run():
+                r1.value = pop()
+                return next_pc
+        elif opcode == 'NOT':
+            def run():
+                r1.value = ~r1.value
+                return next_pc
+        elif opcode == 'INC':
+            def run():
+                r1.value += 1
+                return next_pc
+        elif opcode == 'DEC':
+            def run():
+                r1.value -= 1
+                return next_pc
+        elif opcode == 'SRL':
+            const = args[1]
+
+            def run():
+                r1.value <<= const
+                return next_pc
+        elif opcode == 'SRR':
+            const = args[1]
+
+            def run():
+                r1.value >>= const
+                return next_pc
+        elif opcode == 'LDA':
+            run = self.compile_load(r1, modes, args[1], next_pc)
+        else:
+            run = self.compile_arithmetic(opcode, r1, modes, args[1], next_pc)
+        return run
+
+    def compile_load(self, r1, modes, src, next_pc):
+        if modes == 'RR':
+            r2 = self.simulator.registers[src]
+
+            def run():
+                r1.value = r2.value
+                return next_pc
+        elif modes == 'RM':
+            read = self.simulator.memory.read
+
+            def run():
+                r1.value = read(src)
+                return next_pc
+        else:
+            def run():
+                r1.value = src
+                return next_pc
+        return run
+
+    def compile_arithmetic(self, opcode, r1, modes, src, next_pc):
+        read = self.simulator.memory.read
+        if opcode in ARITHMETIC:
+            function = ARITHMETIC[opcode]
+            if modes == 'RR':
+                r2 = self.simulator.registers[src]
+
+                def run():
+                    r1.value = function(r1.value, r2.value)
+                    return next_pc
+            elif modes == 'RM':
+                def run():
+                    r1.value = function(r1.value, read(src))
+                    return next_pc
+            else:
+                def run():
+                    r1.value = function(r1.value, src)
+                    return next_pc
+        elif opcode in ('DIV', 'MOD'):
+            return self.compile_division(REVERSED_ARITHMETIC[opcode], r1, modes, src, next_pc)
+        else:
+            function = REVERSED_ARITHMETIC[opcode]
+            if modes == 'RR':
+                r2 = self.simulator.registers[src]
+
+                def run():
+                    r1.value = function(r2.value, r1.value)
+                    return next_pc
+            elif modes == 'RM':
+                def run():
+                    r1.value = function(read(src), r1.value)
+                    return next_pc
+            else:
+                def run():
+                    r1.value = function(src, r1.value)
+                    return next_pc
+        return run
+
+    # DIV and MOD, which fault on a zero divisor
+    def compile_division(self, function, r1, modes, src, next_pc):
+        if modes == 'RR':
+            r2 = self.simulator.registers[src]
+
+            def run():
+                if not r1.value:
+                    raise SimulatorFault("division by zero")
+                r1.value = function(r2.value, r1.value)
+                return next_pc
+        elif modes == 'RM':
+            read = self.simulator.memory.read
+
+            def run():
+                if not r1.value:
+                    raise SimulatorFault("division by zero")
+                r1.value = function(read(src), r1.value)
+                return next_pc
+        else:
+            def run():
+                if not r1.value:
+                    raise SimulatorFault("division by zero")
+                r1.value = function(src, r1.value)
+                return next_pc
+        return run
+
+    def compile_branch(self, compare, modes, args, next_pc):
+        registers = self.simulator.registers
+        read = self.simulator.memory.read
+        a, b, label = args
+        target = label + 1
+
+        if modes == 'RRL':
+            ra, rb = registers[a], registers[b]
+            return lambda: target if compare(ra.value, rb.value) else next_pc
+        if modes == 'RML':
+            ra = registers[a]
+            return lambda: target if compare(ra.value, read(b)) else next_pc
+        if modes == 'RIL':
+            ra = registers[a]
+            return lambda: target if compare(ra.value, b) else next_pc
+        if modes == 'MRL':
+            rb = registers[b]
+            return lambda: target if compare(read(a), rb.value) else next_pc
+        if modes == 'MML':
+            return lambda: target if compare(read(a), read(b)) else next_pc
+        if modes == 'MIL':
+            return lambda: target if compare(read(a), b) else next_pc
+        if modes == 'IRL':
+            rb = registers[b]
+            return lambda: target if compare(a, rb.value) else next_pc
+        if modes == 'IML':
+            return lambda: target if compare(a, read(b)) else next_pc
+        taken = target if compare(a, b) else next_pc
+        return lambda: taken
+
+
+# Translates basic blocks into Python functions. The first time execution reaches a
+# program counter, the straight-line code from there up to the next branch or label is
+# turned into Python source with the registers held in locals, compiled, and cached
+# under its entry program counter. Instructions it cannot translate are run by the
+# interpreter.
+class BlockEngine:
+    SYMBOLS = {'AND': '&', 'OR': '|', 'ADD': '+', 'MUL': '*',
+               'SUB': '-', 'DIV': '//', 'MOD': '%',
+               'BEQ': '==', 'BNE': '!=', 'BBG': '>', 'BSM': '<'}
+    TRANSLATABLE = set(SYMBOLS) | {'LDA', 'STR', 'PUSH', 'POP', 'NOT', 'INC', 'DEC',
+                                   'SRL', 'SRR', 'JMP', 'HLT', 'NOP'}
+    CONTROL = {'BEQ', 'BNE', 'BBG', 'BSM', 'JMP', 'HLT'}
+    # Instructions that can raise SimulatorFault
+    FAULTING = {'PUSH', 'POP', 'DIV', 'MOD'}
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        # Execution continues on the line after a label
+        self.leaders = {index + 1 for index in simulator.labels.values()}
+        self.blocks = {}
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+    def run(self, limit):
+        code = self.simulator.code
+        program_counter = self.simulator.program_counter
+        blocks = self.blocks
+        end = len(code)
+        pc = program_counter.pc
+        steps = 0
+        try:
+            while pc < end and steps != limit:
+                block = blocks.get(pc)
+                if block is None:
+                    block = blocks[pc] = self.translate(pc)
+                    self.misses += 1
                 else:
-                    tokens[i] = str(memory[tokens[i]]['indice'])
-
-            # Check if a token is a constant (start with a number)
+                    self.hits += 1
+
+                function, size = block
+                if function is None or (limit != -1 and steps + size > limit):
+                    if function is None:
+                        self.fallbacks += 1
+                    instruction = code[pc]
+                    program_counter.pc = pc
+                    instruction.handler(*instruction.args)
+                    pc = program_counter.pc + 1
+                    steps += 1
+                else:
+                    pc = function()
+                    steps += size
+        except SimulatorError as error:
+            stop_at_fault(self.simulator, pc, steps, error)
+            raise
+        program_counter.pc = pc
+        return steps
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'blocks': len(self.blocks),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'fallbacks': self.fallbacks}
+
+    # Returns (function, number of instructions), or (None, 1) if the instruction at
+    # pc cannot be translated. With count, at most count instructions are translated.
+    def translate(self, pc, count=None):
+        code = self.simulator.code
+        body = []
+        used = set()
+        written = set()
+        exit_lines = None
+        faulting = False
+
+        index = pc
+        while index < len(code) and index - pc != count:
+            instruction = code[index]
+            if instruction.opcode not in self.TRANSLATABLE:
+                break
+            if index != pc and index in self.leaders:
+                break
+            for operand in instruction.operands:
+                if operand.kind == REG:
+                    used.add(operand.value)
+            index += 1
+            if instruction.opcode in self.CONTROL:
+                exit_lines = self.translate_exit(instruction, index)
+                break
+            if instruction.opcode not in ('STR', 'PUSH', 'NOP'):
+                written.add(instruction.args[0])
+            if instruction.opcode in self.FAULTING:
+                body.append('n = %d' % (index - 1 - pc))
+                faulting = True
+            body.extend(self.translate_instruction(instruction))
+
+        size = index - pc
+        if size == 0:
+            return None, 1
+        if exit_lines is None:
+            exit_lines = ['return %d' % index]
+
+        # A fault stores the registers written so far and tells the engine how many
+        # instructions of the block completed
+        store = ['R%d.value = t%d' % (r, r) for r in sorted(written)]
+        lines = ['t%d = R%d.value' % (r, r) for r in sorted(used)]
+        if faulting:
+            lines.append('try:')
+            lines.extend('    ' + line for line in body)
+            lines.append('except SimulatorError as error:')
+            lines.extend('    ' + line for line in store)
+            lines.extend(['    error.executed = n', '    raise'])
+        else:
+            lines.extend(body)
+        lines.extend(store)
+        lines.extend(exit_lines)
+
+        source = 'def block(%s):\n%s\n' % (
+            ', '.join(['R%d=R%d' % (r, r) for r in sorted(used)] +
+                      ['read=read', 'write=write', 'push=push', 'pop=pop']),
+            '\n'.join('    ' + line for line in lines))
+
+        simulator = self.simulator
+        namespace = {'SimulatorError': SimulatorError,
+                     'SimulatorFault': SimulatorFault,
+                     'read': simulator.memory.read,
+                     'write': simulator.memory.write,
+                     'push': simulator.stack.push,
+                     'pop': simulator.stack.pop}
+        for r in used:
+            namespace['R%d' % r] = simulator.registers[r]
+        exec(compile(source, '<block %d>' % pc, 'exec'), namespace)
+        function = namespace['block']
+        function.source = source
+        return function, size
+
+    def value(self, operand):
+        if operand.kind == REG:
+            return 't%d' % operand.value
+        if operand.kind == MEM:
+            return 'read(%d)' % operand.value
+        return repr(operand.value)
+
+    def translate_instruction(self, instruction):
+        opcode = instruction.opcode
+        operands = instruction.operands
+        if opcode == 'NOP':
+            return []
+        if opcode == 'STR':
+            return ['write(%d, %s)' % (operands[0].value, self.value(operands[1]))]
+        if opcode == 'PUSH':
+            return ['push(%s)' % self.value(operands[0])]
+
+        target = self.value(operands[0])
+        if opcode == 'POP':
+            return ['%s = pop()' % target]
+        if opcode == 'NOT':
+            return ['%s = ~%s' % (target, target)]
+        if opcode == 'INC':
+            return ['%s += 1' % target]
+        if opcode == 'DEC':
+            return ['%s -= 1' % target]
+        if opcode == 'SRL':
+            return ['%s <<= %d' % (target, operands[1].value)]
+        if opcode == 'SRR':
+            return ['%s >>= %d' % (target, operands[1].value)]
+
+        src = self.value(operands[1])
+        if opcode == 'LDA':
+            return ['%s = %s' % (target, src)]
+        if opcode in ('DIV', 'MOD'):
+            return ['if not %s:' % target,
+                    '    raise SimulatorFault("division by zero")',
+                    '%s = %s %s %s' % (target, src, self.SYMBOLS[opcode], target)]
+        if opcode in REVERSED_ARITHMETIC:
+            return ['%s = %s %s %s' % (target, src, self.SYMBOLS[opcode], target)]
+        return ['%s = %s %s %s' % (target, target, self.SYMBOLS[opcode], src)]
+
+    def translate_exit(self, instruction, next_pc):
+        operands = instruction.operands
+        if instruction.opcode in ('JMP', 'HLT'):
+            return ['return %d' % (operands[0].value + 1)]
+        return ['if %s %s %s:' % (self.value(operands[0]),
+                                  self.SYMBOLS[instruction.opcode],
+                                  self.value(operands[1])),
+                '    return %d' % (operands[2].value + 1),
+                'return %d' % next_pc]
+
+
+# BlockEngine that records what it runs in trace: the first pc of every whole block,
+# or ~pc for an instruction run on its own. Observers that only need the executed
+# instructions in order, the caches, replay the trace in batches instead of being
+# called for every instruction; see Simulator.run_traced.
+class TracingEngine(BlockEngine):
+    def __init__(self, simulator):
+        super().__init__(simulator)
+        self.trace = []
+
+    def run(self, limit):
+        code = self.simulator.code
+        program_counter = self.simulator.program_counter
+        blocks = self.blocks
+        record = self.trace.append
+        end = len(code)
+        pc = program_counter.pc
+        steps = 0
+        try:
+            while pc < end and steps != limit:
+                block = blocks.get(pc)
+                if block is None:
+                    block = blocks[pc] = self.translate(pc)
+                    self.misses += 1
+                else:
+                    self.hits += 1
+
+                function, size = block
+                if function is None or (limit != -1 and steps + size > limit):
+                    if function is None:
+                        self.fallbacks += 1
+                    instruction = code[pc]
+                    program_counter.pc = pc
+                    instruction.handler(*instruction.args)
+                    record(~pc)
+                    pc = program_counter.pc + 1
+                    steps += 1
+                else:
+                    start = pc
+                    pc = function()
+                    record(start)
+                    steps += size
+        except SimulatorError as error:
+            # The instructions of the block before the fault did run
+            for index in range(getattr(error, 'executed', 0)):
+                record(~(pc + index))
+            stop_at_fault(self.simulator, pc, steps, error)
+            raise
+        program_counter.pc = pc
+        return steps
+
+
+# Superinstructions. Adjacent instructions whose opcodes form one of the patterns, a
+# fixed table of common sequences or the hot ones from Profiler.sequences, are fused
+# into one function, generated as by BlockEngine, that runs them all for a single
+# dispatch. A group ends at its first branch and never spans a branch target. Every
+# instruction keeps its own closure, which runs when a jump lands inside a group or
+# a run must stop inside one; Simulator.step never uses fused code.
+
+SUPERINSTRUCTIONS = (('LDA', 'ADD', 'STR'), ('LDA', 'SUB', 'STR'), ('LDA', 'MUL', 'STR'),
+                     ('LDA', 'ADD'), ('ADD', 'STR'), ('SUB', 'STR'), ('LDA', 'STR'),
+                     ('LDA', 'LDA'), ('PUSH', 'PUSH'), ('POP', 'POP'),
+                     ('INC', 'BSM'), ('INC', 'BNE'), ('DEC', 'BNE'), ('DEC', 'BBG'),
+                     ('ADD', 'BSM'), ('ADD', 'BNE'), ('STR', 'JMP'), ('INC', 'JMP'))
+
+
+class FusedEngine(ClosureEngine):
+    def __init__(self, simulator, patterns=SUPERINSTRUCTIONS):
+        super().__init__(simulator)
+        self.single = self.code
+        self.translator = BlockEngine(simulator)
+        self.fuse(patterns)
+
+    # Fuse the groups matching patterns, longest patterns first, from the start of
+    # the program on
+    def fuse(self, patterns):
+        code = self.simulator.code
+        patterns = sorted({tuple(pattern) for pattern in patterns}, key=len, reverse=True)
+        self.code = list(self.single)
+        self.sizes = [1] * len(code)
+        self.groups = 0
+        pc = 0
+        while pc < len(code):
+            for pattern in patterns:
+                size = len(pattern)
+                if tuple(instruction.opcode for instruction in code[pc:pc + size]) != pattern:
+                    continue
+                function, translated = self.translator.translate(pc, size)
+                if function is not None and translated == size:
+                    self.code[pc] = function
+                    self.sizes[pc] = size
+                    self.groups += 1
+                    pc += size
+                    break
             else:
-                print("found constant")
-                tokens[i] = int(tokens[i])
-
-        print(tokens[1:])
-
-        # Look if operations are in the list of operations in ALU and execute the corresponding function
-        if operation in self.alu.operations.keys():
-            self.alu.operations[operation](
-                *tokens[1:])
+                pc += 1
+
+    def run(self, limit):
+        code = self.code
+        single = self.single
+        sizes = self.sizes
+        program_counter = self.simulator.program_counter
+        end = len(code)
+        pc = program_counter.pc
+        steps = 0
+        try:
+            if limit == -1:
+                while pc < end:
+                    size = sizes[pc]
+                    pc = code[pc]()
+                    steps += size
+            else:
+                while pc < end and steps != limit:
+                    if steps + sizes[pc] > limit:
+                        pc = single[pc]()
+                        steps += 1
+                    else:
+                        size = sizes[pc]
+                        pc = code[pc]()
+                        steps += size
+        except SimulatorError as error:
+            stop_at_fault(self.simulator, pc, steps, error)
+            raise
+        program_counter.pc = pc
+        return steps
+
+    def stats(self):
+        return {'superinstructions': self.groups,
+                'fused': sum(size for size in self.sizes if size > 1)}
+
+
+# Loop fast-forwarding. A counting loop ends with a conditional branch back to a label,
+# its body only adds constants or loop invariants to registers (ADD, INC, DEC) and
+# stores registers or constants (STR), and the branch compares a register the body
+# changes with an invariant, by BSM, BBG or BNE. Every pass adds the same amount to
+# each register, so when execution reaches the loop the number of passes left follows
+# from the comparison, and the registers, stored words, program counter and step
+# count are set to what running them would give. A loop that would never exit runs
+# as usual, and under a step limit only the passes that fit are skipped.
+
+class CountingLoop:
+    # Comparisons of the branch as (induction register) op (bound)
+    FLIPPED = {'BSM': 'BBG', 'BBG': 'BSM', 'BNE': 'BNE'}
+
+    def __init__(self, simulator, head, branch):
+        self.simulator = simulator
+        self.head = head
+        self.branch = branch
+        self.size = branch - head + 1
+        # Increments of each register, as operands, and the stores, as (address,
+        # source operand, increments of its register made before it in the pass)
+        self.increments = {}
+        self.stores = []
+
+    # The loop ending with the branch at pc, or None if it is not a counting loop
+    @classmethod
+    def find(cls, simulator, pc):
+        code = simulator.code
+        branch = code[pc]
+        if branch.opcode not in cls.FLIPPED or not branch.args[2] + 1 <= pc:
+            return None
+        loop = cls(simulator, branch.args[2] + 1, pc)
+
+        written = set()
+        for instruction in code[loop.head:pc]:
+            opcode = instruction.opcode
+            operands = instruction.operands
+            if opcode == 'NOP':
+                continue
+            if opcode == 'STR':
+                source = operands[1]
+                before = list(loop.increments.get(source.value, ())) \
+                    if source.kind == REG else []
+                loop.stores.append((operands[0].value, source, before))
+                written.add((MEM, operands[0].value))
+            elif opcode in ('INC', 'DEC'):
+                loop.increments.setdefault(operands[0].value, []).append(
+                    Operand(IMM, 1 if opcode == 'INC' else -1))
+            elif opcode == 'ADD':
+                loop.increments.setdefault(operands[0].value, []).append(operands[1])
+            else:
+                return None
+        written.update((REG, register) for register in loop.increments)
+
+        # Increments and bounds must not change during the loop
+        invariants = [operand for operands in loop.increments.values()
+                      for operand in operands]
+        for operand in invariants:
+            if (operand.kind, operand.value) in written:
+                return None
+
+        first, second = branch.operands[:2]
+        loop.compare = branch.opcode
+        if first.kind == REG and first.value in loop.increments:
+            loop.register, loop.bound = first.value, second
+        elif second.kind == REG and second.value in loop.increments:
+            loop.register, loop.bound = second.value, first
+            loop.compare = cls.FLIPPED[branch.opcode]
         else:
-            print("Error: Operation not found")
-
-        print('register')
-        for r in self.registers:
-            print(r.value)
+            return None
+        if (loop.bound.kind, loop.bound.value) in written:
+            return None
+        return loop
+
+    # Number of passes until the branch falls through, starting with value in the
+    # induction register and adding delta per pass; None if that never happens
+    def passes(self, value, delta, bound):
+        first = value + delta
+        if self.compare == 'BSM':
+            if not first < bound:
+                return 1
+            return -(-(bound - value) // delta) if delta > 0 else None
+        if self.compare == 'BBG':
+            if not first > bound:
+                return 1
+            return -(-(value - bound) // -delta) if delta < 0 else None
+        if first == bound:
+            return 1
+        if delta == 0 or (bound - value) % delta or (bound - value) // delta < 1:
+            return None
+        return (bound - value) // delta
+
+    # Run up to limit instructions (-1 for no limit) of the loop as whole passes;
+    # returns the number of instructions skipped
+    def forward(self, limit):
+        simulator = self.simulator
+        value = simulator.operand_value
+        deltas = {register: sum(value(operand) for operand in operands)
+                  for register, operands in self.increments.items()}
+        total = self.passes(simulator.registers[self.register].value,
+                            deltas[self.register], value(self.bound))
+        if total is None:
+            return 0
+        passes = total if limit == -1 else min(total, limit // self.size)
+        if not passes:
+            return 0
+
+        for address, source, before in self.stores:
+            stored = value(source)
+            if source.kind == REG:
+                stored += (passes - 1) * deltas.get(source.value, 0) + sum(
+                    value(operand) for operand in before)
+            simulator.memory.write(address, stored)
+        for register, delta in deltas.items():
+            simulator.registers[register].value += passes * delta
+        simulator.program_counter.pc = self.branch + 1 if passes == total else self.head
+        return passes * self.size
+
+
+class LoopEngine(ClosureEngine):
+    def __init__(self, simulator):
+        super().__init__(simulator)
+        # The counting loop starting at each pc, if any
+        self.loops = [None] * len(simulator.code)
+        for pc in range(len(simulator.code)):
+            loop = CountingLoop.find(simulator, pc)
+            if loop is not None and self.loops[loop.head] is None:
+                self.loops[loop.head] = loop
+        self.skipped = 0
+
+    def run(self, limit):
+        code = self.code
+        loops = self.loops
+        program_counter = self.simulator.program_counter
+        end = len(code)
+        pc = program_counter.pc
+        steps = 0
+        try:
+            while pc < end and steps != limit:
+                loop = loops[pc]
+                if loop is not None:
+                    program_counter.pc = pc
+                    skipped = loop.forward(-1 if limit == -1 else limit - steps)
+                    if skipped:
+                        self.skipped += skipped
+                        steps += skipped
+                        pc = program_counter.pc
+                        continue
+                pc = code[pc]()
+                steps += 1
+        except SimulatorError as error:
+            stop_at_fault(self.simulator, pc, steps, error)
+            raise
+        program_counter.pc = pc
+        return steps
+
+    def stats(self):
+        return {'loops': sum(loop is not None for loop in self.loops),
+                'skipped': self.skipped}
+
+
+ENGINES = {'interpreter': Interpreter,
+           'closure': ClosureEngine,
+           'block': BlockEngine,
+           'fused': FusedEngine,
+           'loop': LoopEngine}
+
+
+# Object files. An assembled program is stored after a header as little-endian
+# sections: one fixed-size word per instruction (opcode id, operand count, operand
+# kinds and values), the initial value and address of every variable, the address of
+# every label, the source line of every instruction, then the names of the variables
+# and labels and the instruction texts as newline separated UTF-8. Object files are
+# read through mmap. Simulator.load can keep them in a cache directory under the hash
+# of their source, so an unchanged program is only parsed once.
+
+OBJECT_MAGIC = b'ASMO\x01'
+# magic, instructions, variables, labels, string bytes
+OBJECT_HEADER = struct.Struct('<5s3xIIII')
+INSTRUCTION_WORD = struct.Struct('<BB3s3x3q')
+OBJECT_CACHE_DIR = os.environ.get('ASMSIM_CACHE') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'architecture-simulator')
+
+
+# Write a program image (see Simulator.image) to file
+def write_object(image, file):
+    code = image['code']
+    variables = image['variables']
+    labels = image['labels']
+
+    words = bytearray(INSTRUCTION_WORD.size * len(code))
+    for index, (opcode, operands, text, line) in enumerate(code):
+        kinds = ''.join(kind for kind, _ in operands).encode()
+        values = [value for _, value in operands] + [0] * (3 - len(operands))
+        try:
+            INSTRUCTION_WORD.pack_into(words, index * INSTRUCTION_WORD.size,
+                                       OPCODE_IDS[opcode], len(operands), kinds, *values)
+        except struct.error:
+            raise SimulatorError("line %d: constant too large for an object file" % line)
+    try:
+        values = array('q', [value['value'] for value in variables.values()])
+    except OverflowError:
+        raise SimulatorError("initial value too large for an object file")
+    indices = array('i', [value['indice'] for value in variables.values()])
+    addresses = array('i', labels.values())
+    lines = array('i', [line for _, _, _, line in code])
+    strings = '\n'.join([*variables, *labels, *image['program']]).encode()
+
+    with open(file, 'wb') as output:
+        output.write(OBJECT_HEADER.pack(OBJECT_MAGIC, len(code), len(variables),
+                                        len(labels), len(strings)))
+        for section in (words, values, indices, addresses, lines, strings):
+            output.write(section)
+
+
+# Read an object file back into a program image. Sections are decoded straight from
+# the map, through views that do not outlive it.
+def read_object(file):
+    with open(file, 'rb') as source:
+        if os.fstat(source.fileno()).st_size < OBJECT_HEADER.size:
+            raise SimulatorError("%s is not an object file" % file)
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                memoryview(data) as view:
+            magic, count, variable_count, label_count, string_size = \
+                OBJECT_HEADER.unpack_from(view)
+            if magic != OBJECT_MAGIC:
+                raise SimulatorError("%s is not an object file" % file)
+
+            sizes = (INSTRUCTION_WORD.size * count, 8 * variable_count,
+                     4 * variable_count, 4 * label_count, 4 * count, string_size)
+            if OBJECT_HEADER.size + sum(sizes) != len(data):
+                raise SimulatorError("%s is truncated" % file)
+            sections = []
+            offset = OBJECT_HEADER.size
+            for size in sizes:
+                sections.append(slice(offset, offset + size))
+                offset += size
+            words, values, indices, addresses, lines, strings = sections
+
+            values = view[values].cast('q').tolist()
+            indices = view[indices].cast('i').tolist()
+            addresses = view[addresses].cast('i').tolist()
+            lines = view[lines].cast('i').tolist()
+            strings = (str(view[strings], 'utf-8').split('\n')
+                       if count + variable_count + label_count else [])
+            names = strings[:variable_count]
+            label_names = strings[variable_count:variable_count + label_count]
+            program = strings[variable_count + label_count:]
+
+            # Programs repeat the same few instructions, so every distinct word is
+            # decoded once
+            decoded = {}
+            code = []
+            for index, word in enumerate(INSTRUCTION_WORD.iter_unpack(view[words])):
+                instruction = decoded.get(word)
+                if instruction is None:
+                    op, operand_count, kinds, *operands = word
+                    instruction = decoded[word] = (OPCODES[op], tuple(zip(
+                        kinds.decode()[:operand_count], operands[:operand_count])))
+                code.append((*instruction, program[index], lines[index]))
+    return {'program': program,
+            'variables': {name: {'value': value, 'indice': indice}
+                          for name, value, indice in zip(names, values, indices)},
+            'labels': dict(zip(label_names, addresses)),
+            'code': code}
+
+
+# Instructions run by a TracingEngine between replays
+TRACE_BATCH = 1 << 16
 
-        print('memory')
-        for i in range(0, 3):
-            print(self.memory.read(i))
 
-        # Handle instructions ...
-        self.program_counter.next()
-
-        # Update memory variable
-        for var, value in memory.items():
-            memory[var]['value'] = self.memory.read(value['indice'])
+class Simulator:
+    def __init__(self, engine='interpreter', memory_size=4096, stack_size=4096,
+                 memory='flat'):
+        if engine not in ENGINES:
+            raise SimulatorError("unknown engine %s" % engine)
+        if memory not in MEMORIES:
+            raise SimulatorError("unknown memory %s" % memory)
+        self.engine_name = engine
+        self.engine = None
+        # TracingEngine for runs observed only by caches, made on first use
+        self.tracing = None
+        # Arguments, to build another machine like this one
+        self.options = {'engine': engine, 'memory_size': memory_size,
+                        'stack_size': stack_size, 'memory': memory}
+        self.registers = [Register() for _ in range(4)]
+        self.memory = MEMORIES[memory](memory_size)
+        self.stack = Stack(stack_size)
+        self.program_counter = ProgramCounter()
+        self.alu = ALU(self.registers, self.memory,
+                       self.stack, self.program_counter)
+        self.program = []
+        # Declared variables with their values in memory, updated by sync_variables,
+        # and with their initial values, which image() saves
+        self.variables = {}
+        self.initial = {}
+        self.labels = {}
+        self.code = []
+        self.steps = 0
+        self.seconds = 0.0
+        # Called after every instruction, see Tracer
+        self.observers = []
+        self.undo = None
+
+    # Two-pass assembler reading the file lazily, line by line: the first pass collects
+    # the variables and the label addresses, the second decodes every instruction.
+    # Identical lines are decoded once and share their text, operands and bound
+    # handler, and variable and label names are interned.
 
-        return memory
+    def load_program(self, filename):
+        memory = {}
+        labels = {}
+        count = 0
+        i = 0
+        for number, state, line in self.source_lines(filename):
+            if state == "data":
+                fields = line.split()
+                if len(fields) != 2:
+                    raise AssemblerError(
+                        "line %d: expected a variable and its value" % number)
+                try:
+                    value = int(fields[1])
+                except ValueError:
+                    raise AssemblerError("line %d: invalid value %s" % (number, fields[1]))
+                memory[sys.intern(fields[0])] = {'value': value, 'indice': i}
+                i += 1
+            else:
+                # Store the label and its location
+                label_match = LABEL_PATTERN.match(line)
+                if label_match:
+                    labels[sys.intern(label_match.group(1))] = count
+                count += 1
 
+        if len(memory) > len(self.memory):
+            raise AssemblerError("%d variables do not fit in %d words of memory" % (
+                len(memory), len(self.memory)))
 
-def main():
+        program = []
+        code = []
+        decoded = {}
+        for number, state, line in self.source_lines(filename):
+            if state != "code":
+                continue
+            # Remove the label from the line
+            label_match = LABEL_PATTERN.match(line)
+            if label_match:
+                line = line[label_match.end():].strip()
+
+            shared = decoded.get(line)
+            if shared is None:
+                shared = decoded[line] = self.decode_instruction(
+                    line, memory, labels, number, count)
+            instruction = Instruction(shared.opcode, shared.operands, shared.text, number)
+            instruction.handler = shared.handler
+            instruction.args = shared.args
+            program.append(shared.text)
+            code.append(instruction)
+
+        self.install(program, memory, labels, code)
+        return self.program, self.variables, self.labels
+
+    # The data and code lines of an assembly file as (line number, section, text),
+    # without comments and blank lines. Nothing after HLT is read until the next
+    # section header.
+
+    @staticmethod
+    def source_lines(filename):
+        state = "start"
+        with open(filename, "r") as file:
+            for number, line in enumerate(file, 1):
+                line = line.strip()
+                if not line or line.startswith("!"):
+                    continue
+
+                if line.startswith("#DATA"):
+                    state = "data"
+                elif line.startswith("#CODE"):
+                    state = "code"
+                elif line.startswith("HLT"):
+                    state = "end"
+                elif state in ("data", "code"):
+                    yield number, state, line
+
+    # Load an assembly or object file. With cache_dir, assembled programs are kept
+    # there as object files named after the hash of their source.
+
+    def load(self, filename, cache_dir=None):
+        with open(filename, 'rb') as file:
+            magic = file.read(len(OBJECT_MAGIC))
+            if magic != OBJECT_MAGIC and cache_dir is not None:
+                digest = hashlib.sha256(OBJECT_MAGIC + magic)
+                for chunk in iter(lambda: file.read(1 << 16), b''):
+                    digest.update(chunk)
+        if magic == OBJECT_MAGIC:
+            self.load_image(read_object(filename))
+            return self.program, self.variables, self.labels
+        if cache_dir is None:
+            return self.load_program(filename)
+
+        path = os.path.join(cache_dir, digest.hexdigest() + '.obj')
+        if os.path.exists(path):
+            try:
+                self.load_image(read_object(path))
+                return self.program, self.variables, self.labels
+            except (OSError, SimulatorError):
+                pass
+        result = self.load_program(filename)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temporary = '%s.%d.tmp' % (path, os.getpid())
+            write_object(self.image(), temporary)
+            os.replace(temporary, path)
+        except (OSError, SimulatorError):
+            pass
+        return result
+
+    def install(self, program, memory, labels, code):
+        # Initialize memory with the loaded variable values
+        for var, value in memory.items():
+            self.memory.write(value['indice'], value['value'])
 
-    simulator = Simulator()
+        self.program = program
+        self.initial = memory
+        self.variables = {var: dict(value) for var, value in memory.items()}
+        self.labels = labels
+        self.code = code
+        self.engine = ENGINES[self.engine_name](self)
+        self.tracing = None
+        self.program_counter.pc = 0
+        if self.undo is not None:
+            self.enable_undo(self.undo.budget, self.undo.checkpoint_interval)
+
+    # The decoded program as plain tuples, which unlike bound handlers can be
+    # pickled, so a program parsed once can be sent to other processes. Variables
+    # keep their initial values, whatever a run has stored in them since.
+
+    def image(self):
+        return {'program': list(self.program),
+                'variables': {var: dict(value) for var, value in self.initial.items()},
+                'labels': dict(self.labels),
+                'code': [(instruction.opcode,
+                          tuple((operand.kind, operand.value)
+                                for operand in instruction.operands),
+                          instruction.text, instruction.line)
+                         for instruction in self.code]}
+
+    # Load a program from image(), with the initial values of some variables
+    # replaced by data ({variable: value}).
+
+    def load_image(self, image, data=None):
+        memory = {var: dict(value) for var, value in image['variables'].items()}
+        for var, value in (data or {}).items():
+            if var not in memory:
+                raise SimulatorError("unknown variable %s" % var)
+            memory[var]['value'] = value
+        for value in memory.values():
+            if value['indice'] >= len(self.memory):
+                raise AssemblerError("%d variables do not fit in %d words of memory" % (
+                    len(memory), len(self.memory)))
+
+        # Identical instructions share their operands and bound handler
+        bound = {}
+        code = []
+        for opcode, operands, text, line in image['code']:
+            shared = bound.get((opcode, operands))
+            if shared is None:
+                for kind, value in operands:
+                    if kind == MEM and value >= len(self.memory):
+                        raise AssemblerError("line %d: address %d out of memory" % (
+                            line, value))
+                shared = Instruction(opcode, [Operand(kind, value)
+                                              for kind, value in operands], text, line)
+                self.bind(shared)
+                bound[opcode, operands] = shared
+            instruction = Instruction(opcode, shared.operands, text, line)
+            instruction.handler = shared.handler
+            instruction.args = shared.args
+            code.append(instruction)
+        self.install(list(image['program']), memory, dict(image['labels']), code)
+
+    # Decode the text of one instruction of a program of length instructions. Every
+    # operand is resolved once, so that executing the instruction is a single call to
+    # its bound ALU handler.
+    def decode_instruction(self, text, memory, labels, line, length):
+        tokens = text.split()
+        if not tokens:
+            tokens = ['NOP']
+
+        opcode = tokens[0]
+        if opcode not in OPCODE_IDS:
+            raise AssemblerError(
+                "line %d: unknown operation %s" % (line, opcode))
+
+        operands = [self.decode_operand(token, memory, labels, line)
+                    for token in tokens[1:]]
+        if opcode == 'HLT':
+            operands = [Operand(LABEL, length - 1)]
+
+        instruction = Instruction(opcode, operands, text, line)
+        self.bind(instruction)
+        return instruction
+
+    def decode_operand(self, token, memory, labels, line):
+        # Check if a token is a label
+        if token in labels:
+            return Operand(LABEL, labels[token])
+
+        # Check if a token is a register
+        if re.match(r'T\d+$', token):
+            index = int(token[1:])
+            if index >= len(self.registers):
+                raise AssemblerError(
+                    "line %d: unknown register %s" % (line, token))
+            return Operand(REG, index)
+
+        # Check if a token is a variable (start with a letter), or A+n / A-n
+        # (indirect addressing)
+        match = re.match(r'([a-zA-Z]\w*)(?:([+-])(\d+))?$', token)
+        if match:
+            var, sign, offset = match.groups()
+            if var not in memory:
+                raise AssemblerError(
+                    "line %d: unknown variable or label %s" % (line, var))
+            address = memory[var]['indice']
+            if sign == '+':
+                address += int(offset)
+            elif sign == '-':
+                address -= int(offset)
+            if not 0 <= address < len(self.memory):
+                raise AssemblerError(
+                    "line %d: address %s out of memory" % (line, token))
+            return Operand(MEM, address)
+
+        # Otherwise a token is a constant
+        try:
+            return Operand(IMM, int(token))
+        except ValueError:
+            raise AssemblerError(
+                "line %d: invalid operand %s" % (line, token))
+
+    def bind(self, instruction):
+        modes = ''.join(operand.kind for operand in instruction.operands)
+        handlers = self.alu.operations[instruction.opcode]
+        if modes not in handlers:
+            raise AssemblerError("line %d: invalid operands for %s" % (
+                instruction.line, instruction.opcode))
+        instruction.handler = handlers[modes]
+        instruction.args = tuple(operand.value
+                                 for operand in instruction.operands)
+        if instruction.opcode in ('SRL', 'SRR') and instruction.args[1] < 0:
+            raise AssemblerError("line %d: negative shift %d" % (
+                instruction.line, instruction.args[1]))
+
+    def step(self):
+        pc = self.program_counter.pc
+        instruction = self.code[pc]
+        for observer in self.observers:
+            observer.resume()
+        if self.undo is not None:
+            self.undo.record(pc)
+            try:
+                instruction.handler(*instruction.args)
+            except BaseException:
+                self.undo.discard()
+                raise
+        else:
+            instruction.handler(*instruction.args)
+        self.program_counter.next()
+        self.steps += 1
+        for observer in self.observers:
+            observer.observe(pc, instruction)
+
+    # Keep an undo log so that execution can be stepped back, see UndoLog
+    def enable_undo(self, budget=64 << 20, checkpoint_interval=10000):
+        self.undo = UndoLog(self, budget, checkpoint_interval)
+        return self.undo
+
+    def step_back(self):
+        if self.undo is None:
+            return False
+        if not self.undo.undo():
+            # No entries left, e.g. after an unobserved run: go through a checkpoint
+            try:
+                self.undo.seek(self.undo.position - 1)
+            except SimulatorError:
+                return False
+        self.sync_variables()
+        return True
+
+    def halted(self):
+        return self.program_counter.pc >= len(self.code)
+
+    # Replace the program just loaded with an optimized one, see Optimizer. With
+    # verify, the original and the optimized program are run on new machines for up
+    # to max_steps instructions, and must end in the same registers, memory and stack.
+
+    def optimize(self, verify=False, max_steps=None):
+        image = self.image()
+        optimizer = Optimizer(self)
+        program, labels, code = optimizer.optimize()
+        self.install(program, self.initial, labels, code)
+        if verify:
+            self.verify(image, max_steps)
+        stats = optimizer.stats()
+        stats['optimized'] = len(code)
+        return stats
+
+    def verify(self, image, max_steps=None):
+        outcomes = []
+        for source in (image, self.image()):
+            simulator = Simulator(**self.options)
+            simulator.load_image(source)
+            try:
+                simulator.run(max_steps)
+            except (SimulatorError, ArithmeticError, ValueError) as error:
+                outcomes.append(repr(error))
+                continue
+            if not simulator.halted():
+                raise SimulatorError("cannot verify a program that does not halt "
+                                     "within %s steps" % max_steps)
+            state = simulator.state()
+            del state['pc']
+            state['words'] = simulator.memory.snapshot()
+            outcomes.append(state)
+        if outcomes[0] != outcomes[1]:
+            raise SimulatorError("optimized program differs: %r != %r" % (
+                outcomes[1], outcomes[0]))
+
+    # Run until the program halts, or until max_steps instructions have executed.
+    # Returns True if the program halted. With observed=False the run uses the engine
+    # even when observers or the undo log are attached: observers do not see its
+    # steps, and the undo log only reaches back past them through checkpoints.
+
+    def run(self, max_steps=None, observed=True):
+        if max_steps is not None and max_steps < 0:
+            raise SimulatorError("max_steps must not be negative, got %d" % max_steps)
+        limit = -1 if max_steps is None else max_steps
+
+        before = self.steps
+        start = time.perf_counter()
+        try:
+            if observed and self.undo is None and self.observers and all(
+                    isinstance(observer, CacheHierarchy) for observer in self.observers):
+                self.steps += self.run_traced(limit)
+            elif observed and (self.observers or self.undo is not None):
+                self.steps += self.run_observed(limit)
+            else:
+                self.steps += self.engine.run(limit)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.sync_variables()
+            if not observed and self.undo is not None:
+                self.undo.skip(self.steps - before)
+        return self.halted()
+
+    # Interpreter loop used whenever an observer or the undo log is attached,
+    # whatever the engine.
+
+    def run_observed(self, limit):
+        code = self.code
+        program_counter = self.program_counter
+        observers = self.observers
+        record = self.undo.record if self.undo is not None else None
+        end = len(code)
+        steps = 0
+        for observer in observers:
+            observer.resume()
+        try:
+            while program_counter.pc < end and steps != limit:
+                pc = program_counter.pc
+                instruction = code[pc]
+                if record is not None:
+                    record(pc)
+                try:
+                    instruction.handler(*instruction.args)
+                except BaseException:
+                    # The instruction did not execute, so neither did its record
+                    if record is not None:
+                        self.undo.discard()
+                    raise
+                program_counter.pc += 1
+                steps += 1
+                for observer in observers:
+                    observer.observe(pc, instruction)
+        except BaseException:
+            self.steps += steps
+            raise
+        return steps
+
+    # Run on a TracingEngine, TRACE_BATCH instructions at a time, and replay each
+    # batch through the caches, the only observers.
+
+    def run_traced(self, limit):
+        if self.tracing is None:
+            self.tracing = TracingEngine(self)
+        engine = self.tracing
+        end = len(self.code)
+        steps = 0
+        try:
+            while self.program_counter.pc < end and steps != limit:
+                steps += engine.run(TRACE_BATCH if limit == -1
+                                    else min(TRACE_BATCH, limit - steps))
+                self.replay()
+        except BaseException:
+            self.replay()
+            self.steps += steps
+            raise
+        return steps
+
+    def replay(self):
+        trace = self.tracing.trace
+        for observer in self.observers:
+            observer.replay(trace, self.tracing.blocks)
+        trace.clear()
+
+    # Start writing a trace of the execution to file, in the 'jsonl' or 'binary' format.
+    # Level 'off' attaches nothing, so the run loop stays untraced.
+
+    def trace(self, file, level='instruction', format='jsonl'):
+        if TRACE_LEVELS[level] == TRACE_OFF:
+            return None
+        tracer = Tracer(self, TRACE_SINKS[format](file), TRACE_LEVELS[level])
+        self.observers.append(tracer)
+        return tracer
+
+    # Start counting executions per instruction, see Profiler
+    def profile(self):
+        profiler = Profiler(self)
+        self.observers.append(profiler)
+        return profiler
+
+    # Estimate cycles with a TimingModel; keyword arguments configure it
+    def timing(self, **options):
+        model = TimingModel(self, **options)
+        model.components.extend(observer for observer in self.observers
+                                if isinstance(observer, CacheHierarchy))
+        for observer in self.observers:
+            if isinstance(observer, BranchPrediction) and model.prediction is None:
+                model.prediction = observer
+        self.observers.append(model)
+        return model
+
+    # Run branch predictors on every conditional branch, see BranchPrediction.
+    # specs are predictor specifications, e.g. ('static', '2bit:10', 'gshare:12:8');
+    # the first one drives the branch stalls of the timing model.
+    def predict(self, specs=('2bit',), penalty=2):
+        prediction = BranchPrediction(self, specs, penalty)
+        for observer in self.observers:
+            if isinstance(observer, TimingModel) and observer.prediction is None:
+                observer.prediction = prediction
+        self.observers.append(prediction)
+        return prediction
+
+    # Simulate caches in front of memory, see CacheHierarchy. Miss penalties are
+    # added to the cycles of the timing model.
+    def cache(self, levels=None, policy='lru', memory_penalty=100):
+        hierarchy = CacheHierarchy(self, levels, policy, memory_penalty)
+        for observer in self.observers:
+            if isinstance(observer, TimingModel):
+                observer.components.append(hierarchy)
+        self.observers.append(hierarchy)
+        return hierarchy
+
+    def operand_value(self, operand):
+        if operand.kind == REG:
+            return self.registers[operand.value].value
+        if operand.kind == MEM:
+            return self.memory.read(operand.value)
+        return operand.value
+
+    def stats(self):
+        return {'steps': self.steps,
+                'seconds': self.seconds,
+                'ips': self.steps / self.seconds if self.seconds else 0.0,
+                'engine': self.engine_name,
+                **(self.engine.stats() if self.engine else {})}
+
+    def state(self):
+        return {'pc': self.program_counter.pc,
+                'halted': self.halted(),
+                'registers': {'T' + str(i): r.value for i, r in enumerate(self.registers)},
+                'memory': {var: self.memory.read(value['indice'])
+                           for var, value in self.variables.items()},
+                'stack': self.stack.contents().tolist()}
+
+    # Copy the current memory contents back into the declared variables.
+
+    def sync_variables(self):
+        for var, value in self.variables.items():
+            value['value'] = self.memory.read(value['indice'])
+        return self.variables
+
+    def execute_program(self):
+        self.step()
+        return self.sync_variables()
+
+
+# The GUI. Keyword arguments are passed to Simulator for every loaded program.
+
+def main(**options):
+    import tkinter as tk
+    from tkinter import filedialog
+    from tkinter import ttk
+
+    simulator = Simulator(**options)
+    changes = None
     root = tk.Tk()
     root.title("Assembly Simulator")
 
     # Add this button to the interface
 
-    program, memory, previous_states = [], [], []
-    labels = {}
+    program = []
+    # names of the declared variables by address
+    variable_names = {}
 
     instructions_frame = ttk.LabelFrame(root, text="Instructions")
     instructions_label = ttk.Label(root, text="next state : None")
@@ -688,11 +3272,26 @@ def main():
     instructions_text = tk.Text(
         instructions_frame, wrap=tk.WORD, height=10, width=30)
     instructions_text.pack(padx=10, pady=10)
-    for i in program:
-        instructions_text.insert(tk.END, i + "\n")
-
-    memory_text = tk.Text(memory_frame, wrap=tk.WORD, height=10, width=30)
-    memory_text.pack(padx=10, pady=10)
+    instructions_text.tag_configure('current', background='yellow')
+
+    # The memory view only draws the MEMORY_ROWS words it shows, whatever the size of
+    # the address space. Words written in the last RECENT_FRAMES redraws are highlighted.
+    MEMORY_ROWS = 10
+    ROW_HEIGHT = 18
+    RECENT_FRAMES = 5
+    memory_top = 0
+    memory_frame_number = 0
+    recent_writes = {}
+    hex_values = tk.BooleanVar(value=False)
+
+    memory_canvas = tk.Canvas(memory_frame, width=250, height=MEMORY_ROWS * ROW_HEIGHT,
+                              background='white', highlightthickness=0)
+    memory_canvas.grid(row=0, column=0, columnspan=3, padx=(10, 0), pady=10)
+    memory_scroll = ttk.Scrollbar(memory_frame, orient=tk.VERTICAL)
+    memory_scroll.grid(row=0, column=3, sticky='ns', pady=10, padx=(0, 10))
+
+    jump_entry = ttk.Entry(memory_frame, width=12)
+    jump_entry.grid(row=1, column=0, padx=(10, 0), pady=(0, 10))
 
     registers_text = tk.Text(
         registers_frame, wrap=tk.WORD, height=10, width=30)
@@ -703,37 +3302,86 @@ def main():
         stack_frame, wrap=tk.WORD, height=10, width=30)
     stack_text.pack(padx=10, pady=10)
     stack_text.insert(
-        tk.END, [s for s in simulator.alu.stack.stack if s != None])
-
-    def on_step_click():
-
-        if simulator.program_counter.pc == len(program):
-            print("Program terminated")
+        tk.END, simulator.stack.contents().tolist())
+
+    def draw_memory():
+        memory_canvas.delete('all')
+        size = len(simulator.memory)
+        hex_mode = hex_values.get()
+        for row in range(MEMORY_ROWS):
+            address = memory_top + row
+            if address >= size:
+                break
+            y = row * ROW_HEIGHT
+            if memory_frame_number - recent_writes.get(address, -RECENT_FRAMES) < RECENT_FRAMES:
+                memory_canvas.create_rectangle(0, y, 250, y + ROW_HEIGHT,
+                                               fill='#ffe08a', width=0)
+            value = simulator.memory.read(address)
+            if hex_mode:
+                line = '%06X %-8s %08X' % (address, variable_names.get(address, ''),
+                                          value & 0xFFFFFFFF)
+            else:
+                line = '%6d %-8s %d' % (address, variable_names.get(address, ''), value)
+            memory_canvas.create_text(4, y + 2, anchor='nw', text=line, font='TkFixedFont')
+        memory_scroll.set(memory_top / size, min(1.0, (memory_top + MEMORY_ROWS) / size))
+
+    def scroll_memory_to(address):
+        nonlocal memory_top
+        memory_top = max(0, min(address, len(simulator.memory) - MEMORY_ROWS))
+        draw_memory()
+
+    # Scrollbar commands: ('moveto', fraction) or ('scroll', count, 'units'/'pages')
+    def on_memory_scroll(*args):
+        if args[0] == 'moveto':
+            scroll_memory_to(int(float(args[1]) * len(simulator.memory)))
+        elif args[0] == 'scroll':
+            rows = MEMORY_ROWS if args[2] == 'pages' else 1
+            scroll_memory_to(memory_top + int(args[1]) * rows)
+
+    def on_memory_wheel(event):
+        if event.num == 4 or event.delta > 0:
+            scroll_memory_to(memory_top - 3)
+        else:
+            scroll_memory_to(memory_top + 3)
+
+    # Jump to an address, decimal or 0x hexadecimal, or to a variable (A, A+n, A-n)
+    def on_jump_click():
+        target = jump_entry.get().strip()
+        addresses = {name: address for address, name in variable_names.items()}
+        match = re.match(r'([a-zA-Z]\w*)(?:([+-])(\d+))?$', target)
+        try:
+            if match and match.group(1) in addresses:
+                var, sign, offset = match.groups()
+                address = addresses[var] + (int(offset) if sign == '+' else
+                                            -int(offset) if sign == '-' else 0)
+            else:
+                address = int(target, 0)
+        except ValueError:
             return
-
-        nonlocal memory, previous_states, labels
-
-        # saving current states
-        current_state = {
-            'program': list(program),
-            'mem': copy.deepcopy(memory),
-            'sim_mem': copy.deepcopy(simulator.memory),
-            'registers': [r.value for r in simulator.registers],
-        }
-
-        previous_states.append(current_state)
-
-        # Handle instructions ...
-
-        memory = simulator.execute_program(program, memory, labels)
-
-        # Clear the existing content of the Text widgets
+        scroll_memory_to(address)
+
+    memory_scroll.config(command=on_memory_scroll)
+    memory_canvas.bind('<MouseWheel>', on_memory_wheel)
+    memory_canvas.bind('<Button-4>', on_memory_wheel)
+    memory_canvas.bind('<Button-5>', on_memory_wheel)
+    jump_entry.bind('<Return>', lambda event: on_jump_click())
+    jump_button = ttk.Button(memory_frame, text="Go", width=4, command=on_jump_click)
+    jump_button.grid(row=1, column=1, pady=(0, 10))
+    hex_button = ttk.Checkbutton(memory_frame, text="Hex", variable=hex_values,
+                                 command=draw_memory)
+    hex_button.grid(row=1, column=2, pady=(0, 10))
+
+    # Replace line number (1-based) of a Text widget
+    def set_line(text, number, content):
+        text.delete('%d.0' % number, '%d.end' % number)
+        text.insert('%d.0' % number, content)
+
+    # Draw everything, after a program is loaded
+    def render():
         instructions_text.delete('1.0', tk.END)
-        memory_text.delete('1.0', tk.END)
         registers_text.delete('1.0', tk.END)
+        stack_text.delete('1.0', tk.END)
 
-        # Update the Text widgets with the new content
-        keys = list(memory.keys())
         # update instructions
         for i in program:
             instructions_text.insert(tk.END, i + "\n")
@@ -744,173 +3392,197 @@ def main():
                 simulator.registers[i].value) + "\n")
 
         # update memory
-        for i in range(0, len(keys)):
-            memory_text.insert(tk.END, keys[i] + " " + str(
-                memory[keys[i]]['value']) + "\n")
+        recent_writes.clear()
+        scroll_memory_to(0)
 
         # update stack
-        stack_text.delete('1.0', tk.END)
         stack_text.insert(
-            tk.END, [s for s in simulator.alu.stack.stack if s != None])
-
-        # update program counter label
-        count.config(text="step " + str(simulator.program_counter.pc))
-
-        # update instruction step
-        instructions_label.config(
-            text="next state : " + program[simulator.program_counter.pc] if simulator.program_counter.pc < len(program) else "Program terminated")
+            tk.END, simulator.stack.contents().tolist())
 
-        pass
+        update_position()
 
-    def on_reverse_step_click():
-        nonlocal memory, previous_states, simulator, program
-
-        if simulator.program_counter.pc == 0:
-            return
-        if not previous_states:
+    # Redraw only what the last instructions changed
+    def refresh():
+        nonlocal memory_frame_number
+        if changes is None:
             return
+        registers, addresses, stack = changes.take()
 
-        last_state = previous_states.pop()
-        program[:] = last_state['program']
-        simulator.memory = last_state['sim_mem']
-        for i, register_value in enumerate(last_state['registers']):
-            simulator.registers[i].value = register_value
+        for i in registers:
+            set_line(registers_text, i + 1, "T" + str(i) + " " + str(
+                simulator.registers[i].value))
 
-        # Clear the existing content of the Text widgets
-        instructions_text.delete('1.0', tk.END)
-        memory_text.delete('1.0', tk.END)
-        registers_text.delete('1.0', tk.END)
-
-        simulator.program_counter.pc = simulator.program_counter.pc - 1
+        memory_frame_number += 1
+        for address in addresses:
+            recent_writes[address] = memory_frame_number
+        draw_memory()
 
-        # Update the Text widgets with the new content
-        # update instructions
-        for i in program:
-            instructions_text.insert(tk.END, i + "\n")
-
-        # update registers
-        for i in range(0, len(simulator.registers)):
-            registers_text.insert(tk.END, "T" + str(i) + " " + str(
-                simulator.registers[i].value) + "\n")
+        if stack:
+            stack_text.delete('1.0', tk.END)
+            stack_text.insert(
+                tk.END, simulator.stack.contents().tolist())
 
-        keys = list(memory.keys())
+        update_position()
 
-        # update memory
-        for i in range(0, len(keys)):
-            memory_text.insert(tk.END, keys[i] + " " + str(
-                last_state['mem'][keys[i]]['value']) + "\n")
-
-        # update stack
-        stack_text.delete('1.0', tk.END)
-        stack_text.insert(
-            tk.END, [s for s in simulator.alu.stack.stack if s != None])
+    # Move the highlight to the next instruction and update the labels
+    def update_position():
+        pc = simulator.program_counter.pc
+        instructions_text.tag_remove('current', '1.0', tk.END)
+        if pc < len(program):
+            instructions_text.tag_add('current', '%d.0' % (pc + 1), '%d.0' % (pc + 2))
+            instructions_text.see('%d.0' % (pc + 1))
 
         # update program counter label
-        count.config(text="step " + str(simulator.program_counter.pc))
+        count.config(text="step " + str(pc))
 
         # update instruction step
         instructions_label.config(
-            text="next state : " + program[simulator.program_counter.pc])
+            text="next state : " + program[pc] if pc < len(program) else "Program terminated")
 
-    def load_file_button_click():
-        nonlocal program, memory, labels, simulator
-        file_path = filedialog.askopenfilename(
-            filetypes=[("Assembly files", "*.asm"), ("All files", "*.*")])
+    def on_step_click():
 
-        if file_path:
-            simulator = Simulator()
-            program, memory, labels = simulator.load_program(file_path)
+        if running or simulator.halted():
+            print("Program terminated")
+            return
 
-            # Clear the existing content of the Text widgets
-            instructions_text.delete('1.0', tk.END)
-            memory_text.delete('1.0', tk.END)
-            registers_text.delete('1.0', tk.END)
-            stack_text.delete('1.0', tk.END)
-            count.config(text="step " + str(simulator.program_counter.pc))
+        # Handle instructions ...
 
-            # Update the Text widgets with the new content
-            keys = list(memory.keys())
-            # update instructions
-            for i in program:
-                instructions_text.insert(tk.END, i + "\n")
+        try:
+            simulator.step()
+        except Exception as error:
+            refresh()
+            instructions_label.config(text="error : %s" % error)
+            return
+        refresh()
 
-            # update registers
-            for i in range(0, len(simulator.registers)):
-                registers_text.insert(tk.END, "T" + str(i) + " " + str(
-                    simulator.registers[i].value) + "\n")
+    def on_reverse_step_click():
+        if running or not simulator.step_back():
+            return
+        # Stepping back past an unobserved run restores a checkpoint
+        changes.mark(simulator.program_counter.pc)
+        changes.mark_all()
+        refresh()
 
-            # update memory
-            for i in range(0, len(memory)):
-                memory_text.insert(tk.END, keys[i] + " " + str(
-                    simulator.memory.read(i)) + "\n")
+    def load_file_button_click():
+        nonlocal program, simulator, changes, variable_names
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Assembly files", "*.asm"), ("All files", "*.*")])
 
-            # update stack
-            stack_text.insert(
-                tk.END, [s for s in simulator.alu.stack.stack if s != None])
+        if file_path:
+            stop_running()
+            loaded = Simulator(**options)
+            try:
+                program, memory, labels = loaded.load_program(file_path)
+            except SimulatorError as error:
+                instructions_label.config(text="error : %s" % error)
+                return
+            simulator = loaded
+            simulator.enable_undo()
+            changes = ChangeSet(simulator)
+            simulator.observers.append(changes)
+            variable_names = {value['indice']: var for var, value in memory.items()}
+            ips_label.config(text="")
+            render()
+
+    # Run executes the program in chunks of about RUN_SLICE seconds scheduled with
+    # root.after, so the window stays responsive, and redraws at most FRAME_RATE
+    # times per second. Chunks run unobserved on the simulator's engine; the undo log
+    # takes a checkpoint after each one, and the registers, the stack and the memory
+    # words on screen are compared to find what to redraw. Pause suspends the run,
+    # Run resumes it, and Stop ends it and rewinds the program to its first
+    # instruction.
+
+    RUN_SLICE = 0.02
+    FRAME_RATE = 30
+    running = False
+    # The root.after id of the next chunk
+    pending = None
+    chunk = 1000
+    last_frame = 0.0
+    frame_steps = 0
+
+    # Mark what a chunk changed, given the memory words on screen before it
+    def mark_chunk(top, shown):
+        changes.mark_all()
+        now = simulator.memory.dump(top, len(shown))
+        for offset, (old, new) in enumerate(zip(shown, now)):
+            if old != new:
+                changes.addresses.add(top + offset)
+
+    def run_chunk():
+        nonlocal running, pending, chunk, last_frame, frame_steps
+        pending = None
+        if not running:
+            return
 
-            # update instruction step
-        instructions_label.config(
-            text="next state : " + program[simulator.program_counter.pc] if simulator.program_counter.pc < len(program) else "Program terminated")
+        top = memory_top
+        shown = simulator.memory.dump(top, min(MEMORY_ROWS, len(simulator.memory) - top))
+        start = time.perf_counter()
+        try:
+            simulator.run(chunk, observed=False)
+        except Exception as error:
+            running = False
+            mark_chunk(top, shown)
+            refresh()
+            instructions_label.config(text="error : %s" % error)
+            return
+        now = time.perf_counter()
+        mark_chunk(top, shown)
+
+        # Aim for RUN_SLICE seconds per chunk
+        if now - start < RUN_SLICE / 2:
+            chunk *= 2
+        elif now - start > RUN_SLICE * 2 and chunk > 1:
+            chunk //= 2
+
+        if simulator.halted():
+            running = False
+
+        if not running or now - last_frame >= 1 / FRAME_RATE:
+            ips_label.config(text="%.0f instructions/s" % (
+                (simulator.steps - frame_steps) / (now - last_frame)))
+            last_frame = now
+            frame_steps = simulator.steps
+            refresh()
+
+        if running:
+            pending = root.after(1, run_chunk)
+
+    def stop_running():
+        nonlocal running, pending
+        running = False
+        if pending is not None:
+            root.after_cancel(pending)
+            pending = None
 
     # run every instruction
 
     def on_run_click():
+        nonlocal running, pending, last_frame, frame_steps
 
-        if simulator.program_counter.pc == len(program):
+        if running or pending is not None:
+            return
+        if simulator.halted():
             print("Program terminated")
             return
 
-        nonlocal memory, previous_states
-
-        # saving current states
-        current_state = {
-            'program': list(program),
-            'mem': copy.deepcopy(memory),
-            'sim_mem': copy.deepcopy(simulator.memory),
-            'registers': [r.value for r in simulator.registers],
-        }
+        running = True
+        last_frame = time.perf_counter()
+        frame_steps = simulator.steps
+        pending = root.after(1, run_chunk)
 
-        previous_states.append(current_state)
-
-        # Handle instructions ...
+    def on_pause_click():
+        stop_running()
+        refresh()
 
-        while simulator.program_counter.pc != len(program):
-            memory = simulator.execute_program(program, memory, labels)
-
-        # Clear the existing content of the Text widgets
-        instructions_text.delete('1.0', tk.END)
-        memory_text.delete('1.0', tk.END)
-        registers_text.delete('1.0', tk.END)
-
-        # Update the Text widgets with the new content
-        keys = list(memory.keys())
-        # update instructions
-        for i in program:
-            instructions_text.insert(tk.END, i + "\n")
-
-        # update registers
-        for i in range(0, len(simulator.registers)):
-            registers_text.insert(tk.END, "T" + str(i) + " " + str(
-                simulator.registers[i].value) + "\n")
-
-        # update memory
-        for i in range(0, len(keys)):
-            memory_text.insert(tk.END, keys[i] + " " + str(
-                memory[keys[i]]['value']) + "\n")
-
-        # update stack
-        stack_text.delete('1.0', tk.END)
-        stack_text.insert(
-            tk.END, [s for s in simulator.alu.stack.stack if s != None])
-
-        # update program counter label
-        count.config(text="step " + str(simulator.program_counter.pc))
-
-        # update instruction step
-        instructions_label.config(
-            text="next state : " + program[simulator.program_counter.pc] if simulator.program_counter.pc < len(program) else "Program terminated")
-
-        pass
+    def on_stop_click():
+        stop_running()
+        if simulator.undo is None:
+            return
+        simulator.undo.seek(0)
+        simulator.sync_variables()
+        changes.take()
+        render()
 
     step_button = ttk.Button(root, text="Step", command=on_step_click)
     step_button.grid(row=3, column=0, pady=10)
@@ -918,19 +3590,817 @@ def main():
     load_button = tk.Button(root, text="Load File",
                             command=load_file_button_click)
     load_button.grid(row=4, column=0, padx=10, pady=10)
-    # reverse_step_button = ttk.Button(
-    #     root, text="Reverse Step", command=on_reverse_step_click)
-    # reverse_step_button.grid(row=2, column=1, pady=10)
+    reverse_step_button = ttk.Button(
+        root, text="Reverse Step", command=on_reverse_step_click)
+    reverse_step_button.grid(row=4, column=1, pady=10)
 
     run_button = ttk.Button(root, text="Run", command=on_run_click)
     run_button.grid(row=2, column=1, pady=10)
 
+    pause_button = ttk.Button(root, text="Pause", command=on_pause_click)
+    pause_button.grid(row=5, column=0, pady=10)
+
+    stop_button = ttk.Button(root, text="Stop", command=on_stop_click)
+    stop_button.grid(row=5, column=1, pady=10)
+
     count = ttk.Label(root, text="step 0")
     count.grid(row=3, column=1, pady=10)
 
+    ips_label = ttk.Label(root, text="")
+    ips_label.grid(row=6, column=1, pady=10)
+
     root.mainloop()
 
 
+# Benchmarks. Every workload in benchmarks/ is run headlessly on each engine; the best
+# of `repeat` runs gives the wall time and instructions per second, and a separate
+# run under tracemalloc gives the peak memory of loading and running it. Each result
+# also records whether the final state agrees with the first engine's.
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+
+def benchmark(paths, engines, repeat=3):
+    import tracemalloc
+
+    results = []
+    for path in paths:
+        reference = None
+        for engine in engines:
+            seconds = None
+            for _ in range(repeat):
+                simulator = Simulator(engine)
+                simulator.load_program(path)
+                simulator.run()
+                if seconds is None or simulator.seconds < seconds:
+                    seconds = simulator.seconds
+            state = simulator.state()
+            state['steps'] = simulator.steps
+            if reference is None:
+                reference = state
+
+            tracemalloc.start()
+            measured = Simulator(engine)
+            measured.load_program(path)
+            measured.run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results.append({'workload': os.path.splitext(os.path.basename(path))[0],
+                            'engine': engine,
+                            'steps': simulator.steps,
+                            'seconds': seconds,
+                            'ips': simulator.steps / seconds if seconds else 0.0,
+                            'peak_bytes': peak,
+                            'agrees': state == reference})
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_benchmark(results, baseline=None, file=sys.stderr):
+    previous = {}
+    if baseline is not None:
+        previous = {(r['workload'], r['engine']): r for r in baseline['results']}
+
+    print("%-10s %-12s %10s %10s %12s %10s" % (
+        "workload", "engine", "steps", "seconds", "ips", "peak KiB"), file=file)
+    for r in results:
+        line = "%-10s %-12s %10d %10.3f %12.0f %10.0f" % (
+            r['workload'], r['engine'], r['steps'], r['seconds'], r['ips'],
+            r['peak_bytes'] / 1024)
+        old = previous.get((r['workload'], r['engine']))
+        if old is not None and old['ips']:
+            line += "  x%.2f" % (r['ips'] / old['ips'])
+        if not r['agrees']:
+            line += "  FINAL STATE DIFFERS"
+        print(line, file=file)
+
+
+# Vectorized batch execution. A VectorMachine runs one program over many lanes, each
+# with its own initial #DATA values, keeping the state of every lane in NumPy arrays:
+# registers (lanes, 4), memory (lanes, addresses) and the stack (lanes, depth). Each
+# step executes one instruction for every lane whose program counter is the lowest,
+# so lanes that diverge at a branch are masked out and reconverge when their program
+# counters meet again.
+#
+# Registers are int64, while a Simulator's registers are unbounded ints. A lane that
+# could leave the int64 range, or that would fail (division by zero, stack overflow or
+# underflow), is set aside and rerun on its own Simulator, so each lane gets exactly
+# the result of a separate run. Every memory address is known after decoding, so
+# memory only has a column for each address the program uses.
+
+INT64_MIN = -1 << 63
+INT64_MAX = (1 << 63) - 1
+
+# NumPy is optional, and only imported once a VectorMachine is built
+numpy = None
+
+
+def import_numpy():
+    global numpy
+    try:
+        import numpy
+    except ImportError:
+        raise SimulatorError("the vector engine needs numpy")
+
+
+VECTOR_ARITHMETIC = ('AND', 'OR', 'ADD', 'SUB', 'DIV', 'MUL', 'MOD')
+VECTOR_BRANCH_MODES = ('RRL', 'RML', 'RIL', 'MRL', 'MML', 'MIL', 'IRL', 'IML', 'IIL')
+
+
+# Handlers take the array of lanes to execute and the operands as (kind, value)
+# pairs, with memory operands as column numbers. They return a boolean array of
+# the lanes that must be rerun on a Simulator, or None.
+class VectorALU:
+    def __init__(self, registers, memory, stack, sp, pcs, stack_size):
+        self.registers = registers
+        self.memory = memory
+        self.stack = stack
+        self.sp = sp
+        self.pcs = pcs
+        self.stack_size = stack_size
+        # Same opcodes and operand modes as ALU.operations
+        self.operations = {'LDA': dict.fromkeys(('RR', 'RM', 'RI'), self.lda),
+                           'STR': dict.fromkeys(('MR', 'MI'), self.str_),
+                           'PUSH': dict.fromkeys(('R', 'M', 'I'), self.push),
+                           'POP': {'R': self.pop},
+                           'NOT': {'R': self.not_},
+                           'INC': {'R': self.inc},
+                           'DEC': {'R': self.dec},
+                           'JMP': {'L': self.jmp},
+                           'HLT': {'L': self.jmp},
+                           'SRR': {'RI': self.srr},
+                           'SRL': {'RI': self.srl},
+                           'NOP': {'': self.nop}}
+        for opcode in VECTOR_ARITHMETIC:
+            self.operations[opcode] = dict.fromkeys(('RR', 'RM', 'RI'),
+                                                    self.arithmetic(opcode))
+        for opcode, compare in COMPARISONS.items():
+            self.operations[opcode] = dict.fromkeys(VECTOR_BRANCH_MODES,
+                                                    self.branch(compare))
+
+    def value(self, lanes, operand):
+        kind, value = operand
+        if kind == REG:
+            return self.registers[lanes, value]
+        if kind == MEM:
+            return self.memory[lanes, value].astype(numpy.int64)
+        return value
+
+    def lda(self, lanes, reg, src):
+        self.registers[lanes, reg[1]] = self.value(lanes, src)
+
+    def str_(self, lanes, var, src):
+        self.memory[lanes, var[1]] = numpy.asarray(
+            self.value(lanes, src), numpy.int64).astype(numpy.int32)
+
+    def push(self, lanes, src):
+        value = numpy.asarray(self.value(lanes, src), numpy.int64).astype(numpy.int32)
+        sp = self.sp[lanes]
+        failed = sp >= self.stack_size
+        sp[failed] = 0
+        if sp.max() >= self.stack.shape[1]:
+            grown = numpy.zeros((len(self.stack), min(self.stack_size,
+                                                       2 * self.stack.shape[1])),
+                                numpy.int32)
+            grown[:, :self.stack.shape[1]] = self.stack
+            self.stack = grown
+        self.stack[lanes, sp] = value
+        self.sp[lanes] = sp + 1
+        return failed
+
+    def pop(self, lanes, reg):
+        sp = self.sp[lanes] - 1
+        failed = sp < 0
+        sp[failed] = 0
+        self.registers[lanes, reg[1]] = self.stack[lanes, sp]
+        self.sp[lanes] = sp
+        return failed
+
+    def arithmetic(self, opcode):
+        registers = self.registers
+        if opcode in ARITHMETIC:
+            func = ARITHMETIC[opcode]
+        else:
+            func = REVERSED_ARITHMETIC[opcode]
+
+        def run(lanes, reg, src):
+            x = registers[lanes, reg[1]]
+            y = self.value(lanes, src)
+            if opcode in REVERSED_ARITHMETIC:
+                x, y = y, x
+            result = func(x, y)
+            failed = None
+            if opcode == 'ADD':
+                failed = ((x ^ result) & (y ^ result)) < 0
+            elif opcode == 'SUB':
+                failed = ((x ^ y) & (x ^ result)) < 0
+            elif opcode == 'MUL':
+                failed = numpy.abs(numpy.multiply(x, y, dtype=numpy.float64)) >= 2.0 ** 62
+            elif opcode in ('DIV', 'MOD'):
+                failed = (y == 0) | ((x == INT64_MIN) & (y == -1))
+            registers[lanes, reg[1]] = result
+            return failed
+        return run
+
+    def not_(self, lanes, reg):
+        self.registers[lanes, reg[1]] = ~self.registers[lanes, reg[1]]
+
+    def inc(self, lanes, reg):
+        value = self.registers[lanes, reg[1]]
+        self.registers[lanes, reg[1]] = value + 1
+        return value == INT64_MAX
+
+    def dec(self, lanes, reg):
+        value = self.registers[lanes, reg[1]]
+        self.registers[lanes, reg[1]] = value - 1
+        return value == INT64_MIN
+
+    def srl(self, lanes, reg, const):
+        value = self.registers[lanes, reg[1]]
+        if const[1] >= 63:
+            self.registers[lanes, reg[1]] = 0
+            return value != 0
+        result = value << const[1]
+        self.registers[lanes, reg[1]] = result
+        return (result >> const[1]) != value
+
+    def srr(self, lanes, reg, const):
+        self.registers[lanes, reg[1]] >>= min(const[1], 63)
+
+    def branch(self, compare):
+        pcs = self.pcs
+
+        def run(lanes, first, second, label):
+            taken = compare(self.value(lanes, first), self.value(lanes, second))
+            if isinstance(taken, numpy.ndarray):
+                pcs[lanes[taken]] = label[1]
+            elif taken:
+                pcs[lanes] = label[1]
+        return run
+
+    def jmp(self, lanes, label):
+        self.pcs[lanes] = label[1]
+
+    def nop(self, lanes):
+        pass
+
+    # Instructions with constants a lane cannot hold always fall back to a Simulator
+    def fallback(self, lanes, *operands):
+        return numpy.ones(len(lanes), bool)
+
+
+# Runs the program in image (see Simulator.image) once per entry of data, a list of
+# {variable: initial value}. Keyword arguments are the machine options of Simulator.
+class VectorMachine:
+    def __init__(self, image, data, **machine):
+        import_numpy()
+        # Reports the same errors as loading the program on a Simulator
+        Simulator(**machine).load_image(image)
+
+        self.image = image
+        self.data = [dict(values or {}) for values in data]
+        self.machine = machine
+        self.max_steps = None
+        self.seconds = 0.0
+        lanes = len(self.data)
+        variables = image['variables']
+
+        addresses = {value['indice'] for value in variables.values()}
+        addresses.update(value for _, operands, _, _ in image['code']
+                         for kind, value in operands if kind == MEM)
+        self.columns = {address: column for column, address in enumerate(sorted(addresses))}
+
+        memory = numpy.zeros((lanes, len(self.columns)), numpy.int32)
+        for value in variables.values():
+            memory[:, self.columns[value['indice']]] = to_word(value['value'])
+        self.fallbacks = numpy.zeros(lanes, bool)
+        for lane, values in enumerate(self.data):
+            for var, value in values.items():
+                if var not in variables:
+                    self.fallbacks[lane] = True
+                    continue
+                memory[lane, self.columns[variables[var]['indice']]] = to_word(value)
+
+        self.pcs = numpy.zeros(lanes, numpy.int64)
+        self.steps = numpy.zeros(lanes, numpy.int64)
+        self.alu = VectorALU(numpy.zeros((lanes, 4), numpy.int64), memory,
+                             numpy.zeros((lanes, 16), numpy.int32),
+                             numpy.zeros(lanes, numpy.int64), self.pcs,
+                             machine.get('stack_size', 4096))
+
+        # Execution continues on the line after a label, as in BlockEngine
+        self.leaders = {index + 1 for index in image['labels'].values()}
+        self.control = [opcode in BlockEngine.CONTROL for opcode, _, _, _ in image['code']]
+        self.blocks = {}
+        self.code = []
+        for opcode, operands, text, line in image['code']:
+            modes = ''.join(kind for kind, _ in operands)
+            handler = self.alu.operations[opcode][modes]
+            args = tuple((kind, self.columns[value] if kind == MEM else value)
+                         for kind, value in operands)
+            if any(kind == IMM and not INT64_MIN <= value <= INT64_MAX
+                   for kind, value in args):
+                handler = self.alu.fallback
+            self.code.append((handler, args))
+
+    # Run every lane until it halts or has executed max_steps instructions
+    def run(self, max_steps=None):
+        blocks = self.blocks
+        pcs = self.pcs
+        steps = self.steps
+        end = len(self.code)
+        self.max_steps = max_steps
+
+        start = time.perf_counter()
+        active = (pcs < end) & ~self.fallbacks
+        if max_steps is not None:
+            active &= steps < max_steps
+        with numpy.errstate(all='ignore'):
+            while True:
+                running = numpy.flatnonzero(active)
+                if not len(running):
+                    break
+                running_pcs = pcs[running]
+                pc = running_pcs.min()
+                if running_pcs.max() == pc:
+                    lanes = running
+                else:
+                    lanes = running[running_pcs == pc]
+
+                block = blocks.get(pc)
+                if block is None:
+                    block = blocks[pc] = self.block(pc)
+                if max_steps is not None and steps[lanes].max() + len(block) > max_steps:
+                    block = block[:1]
+
+                # Only the last instruction of a block can branch. Lanes that fail
+                # part way run the rest of the block, but their results are dropped.
+                if len(block) > 1:
+                    pcs[lanes] = pc + len(block) - 1
+                failed = None
+                for handler, args in block:
+                    result = handler(lanes, *args)
+                    if result is not None:
+                        failed = result if failed is None else failed | result
+                pcs[lanes] += 1
+                steps[lanes] += len(block)
+
+                stopped = pcs[lanes] >= end
+                if max_steps is not None:
+                    stopped |= steps[lanes] >= max_steps
+                if failed is not None:
+                    self.fallbacks[lanes[failed]] = True
+                    stopped |= failed
+                active[lanes[stopped]] = False
+        self.seconds += time.perf_counter() - start
+
+    # The instructions from pc to the end of its basic block, which all run for a
+    # single selection of lanes
+    def block(self, pc):
+        end = pc + 1
+        while end < len(self.code) and end not in self.leaders and not self.control[end - 1]:
+            end += 1
+        return self.code[pc:end]
+
+    # Final state of every lane, as Simulator.state() plus 'steps', or 'error'
+    def results(self):
+        alu = self.alu
+        variables = self.image['variables']
+        memory_columns = [(var, self.columns[value['indice']])
+                          for var, value in variables.items()]
+        registers = alu.registers.tolist()
+        memory = alu.memory.tolist()
+        stack = alu.stack.tolist()
+        sp = alu.sp.tolist()
+        pcs = self.pcs.tolist()
+        steps = self.steps.tolist()
+        end = len(self.code)
+
+        results = []
+        for lane, fallback in enumerate(self.fallbacks.tolist()):
+            if fallback:
+                result = run_variant(self.image, {'data': self.data[lane]},
+                                     self.machine, self.max_steps)
+                del result['data']
+                results.append(result)
+                continue
+            results.append({'pc': pcs[lane],
+                            'halted': pcs[lane] >= end,
+                            'registers': {'T' + str(i): value
+                                          for i, value in enumerate(registers[lane])},
+                            'memory': {var: memory[lane][column]
+                                       for var, column in memory_columns},
+                            'stack': stack[lane][:sp[lane]],
+                            'steps': steps[lane]})
+        return results
+
+    def stats(self):
+        steps = int(self.steps.sum())
+        return {'lanes': len(self.data),
+                'fallbacks': int(self.fallbacks.sum()),
+                'steps': steps,
+                'seconds': self.seconds,
+                'ips': steps / self.seconds if self.seconds else 0.0}
+
+
+# Parameter sweeps. The program is parsed once and its image() is sent to every
+# process of a multiprocessing pool; each variant gives initial #DATA values
+# ('data'), and optionally an engine and machine options, for one run. Results come
+# back as soon as they are done, tagged with the index of their variant. Variants
+# with the 'vector' engine are run in batches of lanes on a VectorMachine.
+
+SWEEP_OPTIONS = ('engine', 'memory', 'memory_size', 'stack_size')
+
+# Most lanes run together on a VectorMachine
+VECTOR_LANES = 4096
+
+# Image and options of the sweep, in each worker process
+sweep_worker = {}
+
+
+def sweep_init(image, machine, max_steps):
+    sweep_worker.update(image=image, machine=machine, max_steps=max_steps)
+
+
+# Run one variant on its own Simulator. A run that faults reports the state it
+# stopped in along with the error, and never stops the rest of the sweep.
+def run_variant(image, variant, machine, max_steps):
+    result = dict(variant)
+    options = dict(machine)
+    options.update((key, variant[key]) for key in SWEEP_OPTIONS if key in variant)
+    try:
+        simulator = Simulator(**options)
+        simulator.load_image(image, variant.get('data'))
+    except SimulatorError as error:
+        result['error'] = str(error)
+        return result
+    try:
+        simulator.run(max_steps)
+        error = None
+    except SimulatorError as fault:
+        error = str(fault)
+    except Exception as fault:
+        error = '%s: %s' % (type(fault).__name__, fault)
+    result.update(simulator.state())
+    result['steps'] = simulator.steps
+    if error is not None:
+        result['error'] = error
+    return result
+
+
+# Run a batch of (index, variant) pairs, all on the vector engine or none
+def sweep_run(batch):
+    image = sweep_worker['image']
+    machine = sweep_worker['machine']
+    max_steps = sweep_worker['max_steps']
+    if batch[0][1].get('engine') != 'vector':
+        return [{'variant': index, **run_variant(image, variant, machine, max_steps)}
+                for index, variant in batch]
+
+    try:
+        vector = VectorMachine(image, [variant.get('data') for _, variant in batch],
+                               **machine)
+        vector.run(max_steps)
+    except SimulatorError as error:
+        return [{'variant': index, **variant, 'error': str(error)}
+                for index, variant in batch]
+    return [{'variant': index, **variant, **result}
+            for (index, variant), result in zip(batch, vector.results())]
+
+
+# Every combination of the data values ({variable: [values]}) and engines
+def sweep_grid(data, engines=('interpreter',)):
+    combinations = [{}]
+    for var, values in data.items():
+        combinations = [dict(combination, **{var: value})
+                        for combination in combinations for value in values]
+    return [{'data': combination, 'engine': engine}
+            for combination in combinations for engine in engines]
+
+
+# Run every variant of the program at path, yielding results as they complete.
+# Keyword arguments are the machine options of Simulator.
+
+def sweep(path, variants, processes=None, max_steps=None, cache_dir=None, **machine):
+    simulator = Simulator(**machine)
+    simulator.load(path, cache_dir)
+    image = simulator.image()
+
+    scalar = []
+    vector = []
+    for index, variant in enumerate(variants):
+        if variant.get('engine') != 'vector':
+            scalar.append((index, variant))
+        elif any(key in variant for key in SWEEP_OPTIONS if key != 'engine'):
+            raise SimulatorError("vector variants can only change data")
+        else:
+            vector.append((index, variant))
+
+    workers = processes or os.cpu_count() or 1
+    batches = []
+    for tasks, size in ((scalar, len(scalar) // (4 * workers)),
+                        (vector, min(VECTOR_LANES, -(-len(vector) // workers)))):
+        size = max(1, size)
+        batches.extend(tasks[i:i + size] for i in range(0, len(tasks), size))
+
+    with multiprocessing.Pool(processes, sweep_init, (image, machine, max_steps)) as pool:
+        for results in pool.imap_unordered(sweep_run, batches):
+            yield from results
+
+
+# Values of a --set option: a comma separated list, or a range START:STOP[:STEP]
+def sweep_values(text):
+    try:
+        if ':' in text:
+            return list(range(*map(int, text.split(':'))))
+        return [int(value) for value in text.split(',')]
+    except (TypeError, ValueError):
+        raise SimulatorError("invalid values %s" % text)
+
+
+# Type of the --max-steps options
+def step_count(text):
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid step count %s" % text)
+    if value < 0:
+        raise argparse.ArgumentTypeError("step count %s is negative" % text)
+    return value
+
+
+# Headless entry point: `python main.py run prog.asm` runs the program without
+# loading tkinter and prints the final state as JSON. Without a command the GUI starts.
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Assembly Simulator")
+    commands = parser.add_subparsers(dest='command')
+
+    # Options shared by the commands that build a Simulator
+    machine = argparse.ArgumentParser(add_help=False)
+    machine.add_argument('--memory', choices=list(MEMORIES), default='flat',
+                         help="flat array, or sparse pages allocated on first write")
+    machine.add_argument('--memory-size', type=int, default=4096, help="memory size in words")
+    machine.add_argument('--stack-size', type=int, default=4096, help="stack size in words")
+
+    gui_parser = commands.add_parser('gui', parents=[machine], help="start the GUI (the default)")
+    gui_parser.add_argument('--engine', choices=list(ENGINES), default='interpreter',
+                            help="engine that Run uses")
+
+    # Options of the commands that load a program
+    loading = argparse.ArgumentParser(add_help=False)
+    loading.add_argument('--object-cache', action='store_true',
+                         help="reuse assembled object files, cached by source hash in "
+                              "$ASMSIM_CACHE or ~/.cache/architecture-simulator")
+
+    run_parser = commands.add_parser('run', parents=[machine, loading],
+                                     help="run a program headlessly")
+    run_parser.add_argument('program', help="assembly or object file to run")
+    run_parser.add_argument('--max-steps', type=step_count, default=None,
+                            help="stop after this many instructions")
+    run_parser.add_argument('--engine', choices=list(ENGINES), default='interpreter')
+    run_parser.add_argument('--fuse', metavar='OP,OP[,OP]', action='append', default=[],
+                            help="opcode sequence to fuse with --engine fused, instead "
+                                 "of the built-in table; may be repeated")
+    run_parser.add_argument('--optimize', action='store_true',
+                            help="optimize the program before running it")
+    run_parser.add_argument('--verify', action='store_true',
+                            help="with --optimize, check that the optimized program "
+                                 "ends in the same state as the original")
+    run_parser.add_argument('--indent', type=int, default=None,
+                            help="indent the JSON output")
+    run_parser.add_argument('--profile', action='store_true',
+                            help="print a hot-spot report to stderr")
+    run_parser.add_argument('--collapsed', metavar='FILE', default=None,
+                            help="write profile collapsed stacks for flame graphs to FILE")
+    run_parser.add_argument('--timing', action='store_true',
+                            help="estimate cycles and CPI with the pipeline timing model")
+    run_parser.add_argument('--latency', metavar='OPCODE=CYCLES', action='append', default=[],
+                            help="cycle latency of an opcode for --timing")
+    run_parser.add_argument('--memory-latency', type=int, default=2,
+                            help="cycles added per memory access for --timing")
+    run_parser.add_argument('--branch-penalty', type=int, default=2,
+                            help="cycles lost per taken branch for --timing")
+    run_parser.add_argument('--cache', action='store_true',
+                            help="simulate the cache hierarchy (default L1 and L2)")
+    run_parser.add_argument('--cache-level', metavar='NAME:SIZE:LINE:WAYS:LATENCY',
+                            action='append', default=[],
+                            help="cache level, fastest first; sizes in bytes")
+    run_parser.add_argument('--cache-policy', choices=CACHE_POLICIES, default='lru')
+    run_parser.add_argument('--memory-penalty', type=int, default=100,
+                            help="cycles lost per miss in the last cache level")
+    run_parser.add_argument('--predictor', metavar='SPEC', action='append', default=[],
+                            help="branch predictor: static, static-taken, 1bit[:BITS], "
+                                 "2bit[:BITS] or gshare[:BITS[:HISTORY]]; may be repeated")
+    run_parser.add_argument('--trace', metavar='FILE', default=None,
+                            help="write an execution trace to FILE")
+    run_parser.add_argument('--trace-level', choices=list(TRACE_LEVELS),
+                            default='instruction')
+    run_parser.add_argument('--trace-format', choices=list(TRACE_SINKS),
+                            default='jsonl')
+
+    bench_parser = commands.add_parser('bench', help="run the benchmark workloads")
+    bench_parser.add_argument('workloads', nargs='*',
+                              help="assembly files (default: every file in benchmarks/)")
+    bench_parser.add_argument('--engines', nargs='+', choices=list(ENGINES),
+                              default=list(ENGINES))
+    bench_parser.add_argument('--repeat', type=int, default=3)
+    bench_parser.add_argument('--output', metavar='FILE', default=None,
+                              help="save the results as JSON")
+    bench_parser.add_argument('--compare', metavar='FILE', default=None,
+                              help="show the speedup against results saved earlier")
+
+    sweep_parser = commands.add_parser('sweep', parents=[machine, loading],
+                                       help="run a program over a grid of data values")
+    sweep_parser.add_argument('program', help="assembly or object file to run")
+    sweep_parser.add_argument('--set', metavar='VAR=VALUES', action='append', default=[],
+                              help="initial values of a variable, as V1,V2,... or "
+                                   "START:STOP[:STEP]; every combination is run")
+    sweep_parser.add_argument('--engines', nargs='+', choices=list(ENGINES) + ['vector'],
+                              default=['interpreter'],
+                              help="'vector' runs the variants in batches with NumPy")
+    sweep_parser.add_argument('--grid', metavar='FILE', default=None,
+                              help="JSONL file of variants, e.g. "
+                                   "{\"data\": {\"N\": 5}, \"engine\": \"block\"}, "
+                                   "instead of --set and --engines")
+    sweep_parser.add_argument('--processes', type=int, default=None,
+                              help="worker processes (default: one per CPU)")
+    sweep_parser.add_argument('--max-steps', type=step_count, default=None,
+                              help="stop each run after this many instructions")
+    sweep_parser.add_argument('--output', metavar='FILE', default=None,
+                              help="write the JSONL results to FILE instead of stdout")
+
+    assemble_parser = commands.add_parser('assemble', parents=[machine],
+                                          help="write a program as an object file")
+    assemble_parser.add_argument('program', help="assembly file")
+    assemble_parser.add_argument('-o', '--output', default=None,
+                                 help="object file (default: the program with .obj)")
+
+    args = parser.parse_args(argv)
+    if args.command == 'assemble':
+        return assemble(args)
+    if args.command == 'bench':
+        return bench(args)
+    if args.command == 'sweep':
+        return sweep_command(args)
+    if args.command is None:
+        main()
+        return 0
+    if args.command == 'gui':
+        main(engine=args.engine, memory_size=args.memory_size, stack_size=args.stack_size,
+             memory=args.memory)
+        return 0
+
+    simulator = Simulator(args.engine, args.memory_size, args.stack_size, args.memory)
+    tracer = profiler = timing = cache = prediction = optimized = None
+    try:
+        latencies = {}
+        for latency in args.latency:
+            opcode, _, cycles = latency.partition('=')
+            if opcode not in OPCODE_IDS or not cycles.isdigit():
+                raise SimulatorError("invalid latency %s" % latency)
+            latencies[opcode] = int(cycles)
+
+        levels = []
+        for level in args.cache_level:
+            fields = level.split(':')
+            if len(fields) != 5 or not all(field.isdigit() for field in fields[1:]):
+                raise SimulatorError("invalid cache level %s" % level)
+            levels.append(dict(zip(('size', 'line_size', 'associativity', 'latency'),
+                                   map(int, fields[1:])), name=fields[0]))
+
+        simulator.load(args.program, OBJECT_CACHE_DIR if args.object_cache else None)
+        if args.optimize:
+            optimized = simulator.optimize(args.verify, args.max_steps)
+        if args.fuse:
+            if args.engine != 'fused':
+                raise SimulatorError("--fuse needs --engine fused")
+            patterns = [pattern.split(',') for pattern in args.fuse]
+            for pattern in patterns:
+                if not all(opcode in OPCODE_IDS for opcode in pattern):
+                    raise SimulatorError("invalid sequence %s" % ','.join(pattern))
+            simulator.engine.fuse(patterns)
+        if args.cache or levels:
+            cache = simulator.cache(levels or None, args.cache_policy, args.memory_penalty)
+        if args.predictor:
+            prediction = simulator.predict(args.predictor, args.branch_penalty)
+        if args.timing:
+            timing = simulator.timing(latencies=latencies,
+                                      memory_latency=args.memory_latency,
+                                      branch_penalty=args.branch_penalty)
+        if args.trace:
+            tracer = simulator.trace(args.trace, args.trace_level, args.trace_format)
+        if args.profile or args.collapsed:
+            profiler = simulator.profile()
+        simulator.run(args.max_steps)
+    except (SimulatorError, OSError) as error:
+        print("error: %s" % error, file=sys.stderr)
+        return 1
+    finally:
+        if tracer is not None:
+            tracer.close()
+
+    if args.profile:
+        print(profiler.report(), file=sys.stderr)
+    if args.collapsed:
+        with open(args.collapsed, 'w') as file:
+            file.write(profiler.collapsed())
+
+    result = simulator.state()
+    result['stats'] = simulator.stats()
+    if optimized is not None:
+        result['optimizer'] = optimized
+    if prediction is not None:
+        print(prediction.report(), file=sys.stderr)
+        result['prediction'] = prediction.summary()
+    if cache is not None:
+        print(cache.report(), file=sys.stderr)
+        result['cache'] = cache.summary()
+    if timing is not None:
+        print(timing.report(), file=sys.stderr)
+        result['timing'] = timing.summary()
+    json.dump(result, sys.stdout, indent=args.indent)
+    sys.stdout.write("\n")
+    return 0
+
+
+def bench(args):
+    paths = args.workloads or sorted(
+        os.path.join(BENCHMARK_DIR, name) for name in os.listdir(BENCHMARK_DIR)
+        if name.endswith('.asm'))
+    results = benchmark(paths, args.engines, args.repeat)
+    report = {'revision': git_revision(),
+              'python': platform.python_version(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_benchmark(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 0 if all(r['agrees'] for r in results) else 1
+
+
+def assemble(args):
+    output = args.output or os.path.splitext(args.program)[0] + '.obj'
+    try:
+        simulator = Simulator(memory=args.memory, memory_size=args.memory_size,
+                              stack_size=args.stack_size)
+        simulator.load_program(args.program)
+        write_object(simulator.image(), output)
+    except (SimulatorError, OSError) as error:
+        print("error: %s" % error, file=sys.stderr)
+        return 1
+    return 0
+
+
+def sweep_command(args):
+    try:
+        if args.grid:
+            with open(args.grid) as file:
+                variants = [json.loads(line) for line in file if line.strip()]
+        else:
+            data = {}
+            for setting in args.set:
+                var, _, values = setting.partition('=')
+                data[var] = sweep_values(values)
+            variants = sweep_grid(data, args.engines)
+
+        output = open(args.output, 'w') if args.output else sys.stdout
+        failed = 0
+        try:
+            for result in sweep(args.program, variants, args.processes, args.max_steps,
+                                OBJECT_CACHE_DIR if args.object_cache else None,
+                                memory=args.memory, memory_size=args.memory_size,
+                                stack_size=args.stack_size):
+                failed += 'error' in result
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    except (SimulatorError, OSError) as error:
+        print("error: %s" % error, file=sys.stderr)
+        return 1
+    if failed:
+        print("%d of %d variants failed" % (failed, len(variants)), file=sys.stderr)
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
 
-    main()
+    sys.exit(cli())
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+from tests.test_engines import FAULTS, PROGRAMS
+
+# Small caches, so that programs conflict and evict
+LEVELS = [{'name': 'L1', 'size': 64, 'line_size': 16, 'associativity': 2, 'latency': 1},
+          {'name': 'L2', 'size': 256, 'line_size': 32, 'associativity': 4, 'latency': 5}]
+# Two lines in one set: blocks that keep hitting V2 and V3 change their LRU order
+# between misses
+LRU_ORDER = ("#DATA\nV0 0\nV1 0\nV2 0\nV3 0\nN 36\n#CODE\nLDA T0 0\nTOP:\n"
+             "LDA T2 T0\nAND T2 3\nBEQ T2 1 S0\nADD T1 V3\nS0:\nADD T1 V3\n"
+             "LDA T2 T0\nAND T2 1\nBEQ T2 0 S1\nADD T1 V2\nS1:\nADD T1 V3\n"
+             "INC T0\nBSM T0 N TOP\nHLT\n")
+TWO_LINES = [{'name': 'L1', 'size': 8, 'line_size': 4, 'associativity': 2, 'latency': 1}]
+
+
+class CacheReplayTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.directory)
+
+    # Caches fed by replaying traced blocks, or by observing every instruction when
+    # a profiler is attached too
+    def run_cached(self, path, observed, levels, policy='lru', max_steps=None, **options):
+        simulator = main.Simulator('closure', **options)
+        simulator.load_program(path)
+        cache = simulator.cache(levels, policy)
+        if observed:
+            simulator.profile()
+        error = None
+        try:
+            simulator.run(max_steps)
+        except main.SimulatorError as fault:
+            error = str(fault)
+        return {'summary': cache.summary(),
+                'misses': [misses.tolist() for misses in cache.misses],
+                'steps': simulator.steps,
+                'pc': simulator.program_counter.pc,
+                'error': error}
+
+    def assert_same(self, path, levels, max_steps=None, **options):
+        for policy in main.CACHE_POLICIES:
+            with self.subTest(program=os.path.basename(path), policy=policy):
+                self.assertEqual(
+                    self.run_cached(path, False, levels, policy, max_steps, **options),
+                    self.run_cached(path, True, levels, policy, max_steps, **options))
+
+    def test_programs(self):
+        for path in PROGRAMS:
+            self.assert_same(path, LEVELS, 100000)
+
+    def test_faults(self):
+        for name, (source, options) in FAULTS.items():
+            path = os.path.join(self.directory, name + '.asm')
+            with open(path, 'w') as file:
+                file.write(source)
+            self.assert_same(path, LEVELS, 1000, **options)
+
+    def test_lru_order(self):
+        path = os.path.join(self.directory, 'lru.asm')
+        with open(path, 'w') as file:
+            file.write(LRU_ORDER)
+        self.assert_same(path, TWO_LINES)
+
+    def test_batches(self):
+        simulator = main.Simulator()
+        simulator.load_program(PROGRAMS[0])
+        cache = simulator.cache(LEVELS)
+        while not simulator.run(7):
+            pass
+        self.assertEqual(cache.summary(), self.run_cached(PROGRAMS[0], True, LEVELS)['summary'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROGRAMS = [os.path.join(ROOT, 'test.asm')] + sorted(
+    os.path.join(main.BENCHMARK_DIR, name) for name in os.listdir(main.BENCHMARK_DIR)
+    if name.endswith('.asm'))
+
+# Programs that fault part way through, with the machine options to run them with
+FAULTS = {
+    # The second POP underflows in the middle of a basic block
+    'underflow': ("#DATA\n#CODE\nPUSH 9\nLDA T1 3\nPOP T0\nINC T1\nPOP T2\nHLT\n", {}),
+    # Divides by a counter until it reaches zero
+    'division': ("#DATA\nN 5\nRES 0\n#CODE\nLDA T0 N\nLOOP:\nLDA T1 T0\nDIV T1 100\n"
+                 "ADD T2 T1\nSTR RES T2\nDEC T0\nBBG T0 -1 LOOP\nHLT\n", {}),
+    'modulo': ("#DATA\nA 7\n#CODE\nLDA T1 2\nPUSH T1\nMOD T0 A\nHLT\n", {}),
+    'overflow': ("#DATA\n#CODE\nLOOP:\nINC T0\nPUSH T0\nJMP LOOP\nHLT\n",
+                 {'stack_size': 8}),
+}
+
+
+# Final state of a run, with the whole memory and the step count
+def final_state(simulator):
+    state = simulator.state()
+    state['words'] = simulator.memory.snapshot()
+    state['steps'] = simulator.steps
+    return state
+
+
+class EngineEquivalenceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.directory)
+
+    def run_program(self, engine, path, max_steps=None, **options):
+        simulator = main.Simulator(engine, **options)
+        simulator.load_program(path)
+        simulator.run(max_steps)
+        return final_state(simulator)
+
+    def test_programs(self):
+        for path in PROGRAMS:
+            expected = self.run_program('interpreter', path)
+            self.assertTrue(expected['halted'])
+            for engine in main.ENGINES:
+                with self.subTest(program=os.path.basename(path), engine=engine):
+                    self.assertEqual(self.run_program(engine, path), expected)
+
+    def test_faults(self):
+        for name, (source, options) in FAULTS.items():
+            path = os.path.join(self.directory, name + '.asm')
+            with open(path, 'w') as file:
+                file.write(source)
+            states = {}
+            for engine in main.ENGINES:
+                with self.subTest(program=name, engine=engine):
+                    simulator = main.Simulator(engine, **options)
+                    simulator.load_program(path)
+                    with self.assertRaises(main.SimulatorFault):
+                        simulator.run()
+                    states[engine] = final_state(simulator)
+                    self.assertEqual(states[engine], states['interpreter'])
+
+    def test_underflow_state(self):
+        path = os.path.join(self.directory, 'underflow.asm')
+        with open(path, 'w') as file:
+            file.write(FAULTS['underflow'][0])
+        for engine in main.ENGINES:
+            with self.subTest(engine=engine):
+                simulator = main.Simulator(engine)
+                simulator.load_program(path)
+                with self.assertRaises(main.SimulatorFault):
+                    simulator.run()
+                self.assertEqual([r.value for r in simulator.registers], [9, 4, 0, 0])
+                self.assertEqual(simulator.program_counter.pc, 4)
+                self.assertEqual(simulator.steps, 4)
+
+    def test_negative_limit(self):
+        simulator = main.Simulator()
+        simulator.load_program(PROGRAMS[0])
+        with self.assertRaises(main.SimulatorError):
+            simulator.run(-5)
+        self.assertEqual(simulator.steps, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+
+from tests.test_engines import PROGRAMS, final_state
+
+# Counting loops the loop engine fast-forwards, by name
+LOOPS = {
+    'bsm': "#DATA\nN 10000\nSUM 0\n#CODE\nLDA T0 0\nLOOP:\nINC T0\nADD T1 3\n"
+           "STR SUM T1\nBSM T0 N LOOP\nPUSH T0\nHLT\n",
+    'bbg': "#DATA\nN 5000\nSTEP 7\nLAST 0\n#CODE\nLDA T0 N\nLOOP:\nDEC T0\nADD T2 STEP\n"
+           "STR LAST T0\nBBG T0 0 LOOP\nSTR N T2\nHLT\n",
+    'bne': "#DATA\n#CODE\nLDA T3 -2\nLOOP:\nADD T0 2\nADD T1 T3\nBNE T0 6000 LOOP\nHLT\n",
+    'flipped': "#DATA\nOUT 0\n#CODE\nLDA T0 3001\nLOOP:\nSTR OUT 1\nDEC T0\nBSM 0 T0 LOOP\n"
+               "STR OUT T0\nHLT\n",
+    'nested': "#DATA\nSUM 0\n#CODE\nLDA T2 0\nOUTER:\nLDA T0 0\nINNER:\nINC T0\nADD T1 T2\n"
+              "BSM T0 50 INNER\nSTR SUM T1\nINC T2\nBSM T2 40 OUTER\nHLT\n",
+}
+
+# Step limits, some of which stop part way through a loop that is fast-forwarded
+LIMITS = (None, 0, 1, 2, 7, 1000, 4003, 9999, 19998)
+
+
+class LoopEngineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, directory)
+        cls.loops = {}
+        for name, source in LOOPS.items():
+            path = cls.loops[name] = os.path.join(directory, name + '.asm')
+            with open(path, 'w') as file:
+                file.write(source)
+
+    def compare(self, path, limit):
+        expected = main.Simulator('interpreter')
+        expected.load_program(path)
+        expected.run(limit)
+        simulator = main.Simulator('loop')
+        simulator.load_program(path)
+        simulator.run(limit)
+        self.assertEqual(final_state(simulator), final_state(expected))
+
+        # Running on from where the limit stopped gives the same end state
+        expected.run()
+        simulator.run()
+        self.assertEqual(final_state(simulator), final_state(expected))
+        return simulator
+
+    def test_loops(self):
+        for name, path in self.loops.items():
+            for limit in LIMITS:
+                with self.subTest(loop=name, max_steps=limit):
+                    simulator = self.compare(path, limit)
+                    self.assertTrue(simulator.halted())
+            simulator = main.Simulator('loop')
+            simulator.load_program(path)
+            simulator.run()
+            self.assertGreater(simulator.engine.stats()['skipped'], 0, name)
+
+    def test_limit_inside_loop(self):
+        # 4003 steps stop two instructions into a pass of the four-instruction bsm loop
+        simulator = main.Simulator('loop')
+        simulator.load_program(self.loops['bsm'])
+        self.assertFalse(simulator.run(4003))
+        self.assertEqual(simulator.steps, 4003)
+        self.assertGreater(simulator.engine.stats()['skipped'], 0)
+        self.compare(self.loops['bsm'], 4003)
+
+    def test_programs(self):
+        for path in PROGRAMS:
+            for limit in (None, 4099):
+                with self.subTest(program=os.path.basename(path), max_steps=limit):
+                    self.compare(path, limit)
+
+
+if __name__ == '__main__':
+    unittest.main()
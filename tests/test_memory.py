@@ -0,0 +1,192 @@
+import os
+import tempfile
+import unittest
+
+import main
+
+PROGRAM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test.asm')
+
+
+class MemoryTest(unittest.TestCase):
+    def test_read_write(self):
+        memory = main.Memory(8)
+        self.assertEqual(len(memory), 8)
+        self.assertEqual(memory.dump(0, 8), [0] * 8)
+        memory.write(3, -7)
+        self.assertEqual(memory.read(3), -7)
+
+    def test_wrap(self):
+        memory = main.Memory(4)
+        memory.write(0, 0x7FFFFFFF + 1)
+        memory.write(1, -0x80000000 - 1)
+        memory.write(2, 1 << 40)
+        memory.load(3, [0xFFFFFFFF])
+        self.assertEqual(memory.dump(0, 4), [-0x80000000, 0x7FFFFFFF, 0, -1])
+
+    def test_load_dump_view(self):
+        memory = main.Memory(8)
+        memory.load(2, [1, 2, 3])
+        self.assertEqual(memory.dump(0, 8), [0, 0, 1, 2, 3, 0, 0, 0])
+        self.assertEqual(memory.view(2, 3).tolist(), [1, 2, 3])
+        # A view shares the words of the memory
+        memory.write(3, 9)
+        self.assertEqual(memory.view(2, 3).tolist(), [1, 9, 3])
+
+    def test_out_of_range(self):
+        memory = main.Memory(8)
+        with self.assertRaises(IndexError):
+            memory.load(6, [1, 2, 3, 4])
+        self.assertEqual(len(memory), 8)
+        self.assertEqual(memory.dump(0, 8), [0] * 8)
+        with self.assertRaises(IndexError):
+            memory.dump(4, 5)
+        with self.assertRaises(IndexError):
+            memory.view(-1, 2)
+        with self.assertRaises(IndexError):
+            memory.write(8, 1)
+
+    def test_snapshot_restore(self):
+        memory = main.Memory(16)
+        memory.load(0, range(16))
+        snapshot = memory.snapshot()
+        self.assertEqual(len(snapshot), 64)
+        memory.load(4, [-1] * 8)
+        memory.restore(snapshot)
+        self.assertEqual(memory.dump(0, 16), list(range(16)))
+
+        copy = memory.copy()
+        copy.write(0, 42)
+        self.assertEqual(memory.read(0), 0)
+        self.assertEqual(copy.read(0), 42)
+
+
+class PagedMemoryTest(unittest.TestCase):
+    def test_untouched_words(self):
+        memory = main.PagedMemory(1 << 30, page_bits=4)
+        self.assertEqual(len(memory), 1 << 30)
+        self.assertEqual(memory.read(0), 0)
+        self.assertEqual(memory.read((1 << 30) - 1), 0)
+        self.assertEqual(memory.dump(100, 3), [0, 0, 0])
+        self.assertEqual(memory.pages, {})
+
+    def test_allocation_on_write(self):
+        memory = main.PagedMemory(1000, page_bits=4)
+        memory.write(37, 5)
+        self.assertEqual(list(memory.pages), [2])
+        memory.write(40, 6)
+        memory.write(33, 0)
+        self.assertEqual(list(memory.pages), [2])
+        self.assertEqual(memory.dump(32, 10), [0, 0, 0, 0, 0, 5, 0, 0, 6, 0])
+        memory.write(999, 1 << 32)
+        self.assertEqual(sorted(memory.pages), [2, 62])
+        self.assertEqual(memory.read(999), 0)
+
+    def test_out_of_range(self):
+        memory = main.PagedMemory(1000, page_bits=4)
+        memory.write(999, 1)
+        # 1000 to 1007 lie in the allocated last page, but past the end of memory
+        for address in (1000, 1007, 5000, -1):
+            with self.assertRaises(IndexError):
+                memory.write(address, 1)
+            with self.assertRaises(IndexError):
+                memory.read(address)
+        with self.assertRaises(IndexError):
+            memory.load(998, [1, 2, 3])
+        with self.assertRaises(IndexError):
+            memory.dump(990, 11)
+        with self.assertRaises(IndexError):
+            memory.view(-1, 1)
+        self.assertEqual(sorted(memory.pages), [62])
+
+    def test_view(self):
+        memory = main.PagedMemory(1000, page_bits=4)
+        memory.load(14, [1, 2, 3, 4])
+        # Inside one page the view shares the words, across pages it is a copy
+        self.assertEqual(memory.view(16, 2).tolist(), [3, 4])
+        self.assertEqual(memory.view(14, 4).tolist(), [1, 2, 3, 4])
+        self.assertEqual(memory.view(500, 2).tolist(), [0, 0])
+
+    def test_snapshot_restore(self):
+        memory = main.PagedMemory(1 << 20, page_bits=8)
+        memory.load(1000, range(10))
+        memory.write(500000, -3)
+        snapshot = memory.snapshot()
+        memory.write(1000, 7)
+        memory.write(9000, 7)
+        memory.restore(snapshot)
+        self.assertEqual(memory.dump(1000, 10), list(range(10)))
+        self.assertEqual(memory.read(500000), -3)
+        self.assertEqual(memory.read(9000), 0)
+        self.assertEqual(sorted(memory.pages), sorted(snapshot))
+
+        copy = memory.copy()
+        copy.write(1000, 42)
+        self.assertEqual(memory.read(1000), 0)
+
+    def test_program(self):
+        states = []
+        for memory in ('flat', 'paged'):
+            simulator = main.Simulator(memory=memory)
+            simulator.load_program(PROGRAM)
+            simulator.run()
+            state = simulator.state()
+            state['steps'] = simulator.steps
+            state['words'] = simulator.memory.dump(0, len(simulator.memory))
+            states.append(state)
+        self.assertEqual(states[0], states[1])
+
+
+class StackTest(unittest.TestCase):
+    def test_push_pop(self):
+        stack = main.Stack(4)
+        for value in (1, -2, 3):
+            stack.push(value)
+        self.assertEqual(stack.contents().tolist(), [1, -2, 3])
+        self.assertEqual(stack.pop(), 3)
+        self.assertEqual(stack.pop(), -2)
+        self.assertEqual(stack.contents().tolist(), [1])
+
+    def test_contents_is_a_view(self):
+        stack = main.Stack(4)
+        stack.push(5)
+        contents = stack.contents()
+        stack.stack[0] = 6
+        self.assertEqual(contents.tolist(), [6])
+
+    def test_wrap(self):
+        stack = main.Stack(3)
+        stack.push(1 << 31)
+        stack.push(-(1 << 31) - 1)
+        stack.push((1 << 40) + 7)
+        self.assertEqual(stack.contents().tolist(), [-(1 << 31), (1 << 31) - 1, 7])
+
+    def test_overflow(self):
+        stack = main.Stack(2)
+        stack.push(1)
+        stack.push(2)
+        with self.assertRaises(main.SimulatorFault):
+            stack.push(3)
+        self.assertEqual(stack.sp, 2)
+        self.assertEqual(stack.contents().tolist(), [1, 2])
+
+    def test_underflow(self):
+        stack = main.Stack(2)
+        with self.assertRaises(main.SimulatorFault):
+            stack.pop()
+        self.assertEqual(stack.sp, 0)
+
+    def test_program_overflow(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'push.asm')
+            with open(path, 'w') as file:
+                file.write("#DATA\n#CODE\nPUSH 1\nPUSH 2\nPUSH 3\nHLT\n")
+            simulator = main.Simulator(stack_size=2)
+            simulator.load_program(path)
+        with self.assertRaises(main.SimulatorFault):
+            simulator.run()
+        self.assertEqual(simulator.program_counter.pc, 2)
+        self.assertEqual(simulator.steps, 2)
+        self.assertEqual(simulator.stack.contents().tolist(), [1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+from tests.test_engines import PROGRAMS, final_state
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Stores into A and RES
+PROGRAM = os.path.join(ROOT, 'test.asm')
+
+
+class ImageTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.directory)
+
+    def fresh_run(self, path):
+        simulator = main.Simulator()
+        simulator.load_program(path)
+        simulator.run()
+        return final_state(simulator)
+
+    def test_initial_values(self):
+        simulator = main.Simulator()
+        simulator.load_program(PROGRAM)
+        image = simulator.image()
+        simulator.run()
+        self.assertEqual(simulator.variables['RES']['value'], 40)
+        self.assertEqual(simulator.image(), image)
+        self.assertEqual(image['variables']['A'], {'value': 10, 'indice': 0})
+        self.assertEqual(image['variables']['RES'], {'value': 0, 'indice': 2})
+
+    def test_object_after_run(self):
+        for path in PROGRAMS:
+            with self.subTest(program=os.path.basename(path)):
+                simulator = main.Simulator()
+                simulator.load_program(path)
+                simulator.run()
+                output = os.path.join(self.directory, os.path.basename(path) + '.obj')
+                main.write_object(simulator.image(), output)
+
+                loaded = main.Simulator()
+                loaded.load(output)
+                loaded.run()
+                self.assertEqual(final_state(loaded), self.fresh_run(path))
+
+    def test_optimize_after_run(self):
+        simulator = main.Simulator()
+        simulator.load_program(PROGRAM)
+        image = simulator.image()
+        simulator.run()
+        simulator.optimize(verify=True)
+        self.assertEqual(simulator.image()['variables'], image['variables'])
+        self.assertEqual(simulator.variables, image['variables'])
+
+    def test_sweep_after_run(self):
+        simulator = main.Simulator()
+        simulator.load_program(PROGRAM)
+        simulator.run()
+        result = main.run_variant(simulator.image(), {}, {}, None)
+        self.assertEqual(result['memory'], self.fresh_run(PROGRAM)['memory'])
+
+
+class ObjectFileTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.directory)
+
+    def image(self, path):
+        simulator = main.Simulator()
+        simulator.load_program(path)
+        return simulator.image()
+
+    def test_round_trip(self):
+        for path in PROGRAMS:
+            with self.subTest(program=os.path.basename(path)):
+                image = self.image(path)
+                output = os.path.join(self.directory, os.path.basename(path) + '.obj')
+                main.write_object(image, output)
+                self.assertEqual(main.read_object(output), image)
+
+                simulator = main.Simulator()
+                simulator.load(output)
+                self.assertEqual(simulator.image(), image)
+
+    def test_invalid(self):
+        path = os.path.join(self.directory, 'invalid.obj')
+        main.write_object(self.image(PROGRAM), path)
+        with open(path, 'rb') as file:
+            data = file.read()
+        for name, contents in (('short', main.OBJECT_MAGIC),
+                               ('magic', b'ASMO\x02' + data[5:]),
+                               ('truncated', data[:-1])):
+            with self.subTest(name):
+                with open(path, 'wb') as file:
+                    file.write(contents)
+                with self.assertRaises(main.SimulatorError):
+                    main.read_object(path)
+
+    def test_cache(self):
+        cache = os.path.join(self.directory, 'cache')
+        simulator = main.Simulator()
+        simulator.load(PROGRAM, cache)
+        # Named after the hash of the whole source
+        with open(PROGRAM, 'rb') as file:
+            digest = hashlib.sha256(main.OBJECT_MAGIC + file.read()).hexdigest()
+        path = os.path.join(cache, digest + '.obj')
+        self.assertEqual(os.listdir(cache), [digest + '.obj'])
+        self.assertEqual(main.read_object(path), simulator.image())
+
+        # The next load reads the cached object instead of the source
+        other = self.image(PROGRAMS[1])
+        main.write_object(other, path)
+        loaded = main.Simulator()
+        loaded.load(PROGRAM, cache)
+        self.assertEqual(loaded.image(), other)
+
+
+if __name__ == '__main__':
+    unittest.main()
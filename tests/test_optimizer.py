@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+from tests.test_engines import PROGRAMS
+
+# T0 and T1 fold to 5, so the branch is always taken and the STR it skips, with the
+# label line after it, is unreachable; LDA T0 2 and LDA T2 7 are overwritten unread
+FOLDING = ("#DATA\nX 5\nY 0\n#CODE\nLDA T0 2\nADD T0 3\nLDA T1 T0\nBEQ T0 5 SKIP\n"
+           "STR Y T0\nSKIP:\nLDA T2 7\nLDA T2 X\nSTR Y T2\nHLT\n")
+# The dead LDA T3 4 and the label line go, so the loop starts two lines earlier
+MOVED = "#DATA\nN 3\n#CODE\nLDA T3 4\nLDA T3 0\nLOOP:\nINC T3\nBSM T3 N LOOP\nHLT\n"
+# The loop starts on the first instruction, so a NOP is kept before it
+FIRST = "#DATA\nN 3\n#CODE\nLOOP:\nINC T3\nBSM T3 N LOOP\nHLT\n"
+
+
+# Final state of a run, without the program counter, which optimizing moves
+def outcome(simulator):
+    state = simulator.state()
+    del state['pc']
+    state['words'] = simulator.memory.snapshot()
+    return state
+
+
+class OptimizerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.directory)
+
+    def load(self, source):
+        path = os.path.join(self.directory, 'program.asm')
+        with open(path, 'w') as file:
+            file.write(source)
+        simulator = main.Simulator()
+        simulator.load_program(path)
+        return simulator
+
+    def test_programs(self):
+        for path in PROGRAMS:
+            with self.subTest(program=os.path.basename(path)):
+                reference = main.Simulator()
+                reference.load_program(path)
+                reference.run()
+
+                simulator = main.Simulator()
+                simulator.load_program(path)
+                stats = simulator.optimize(verify=True)
+                self.assertEqual(stats['instructions'], len(reference.code))
+                self.assertEqual(stats['optimized'], len(simulator.code))
+                self.assertLessEqual(stats['optimized'], stats['instructions'])
+                simulator.run()
+                self.assertEqual(outcome(simulator), outcome(reference))
+
+    def test_counts(self):
+        simulator = self.load(FOLDING)
+        stats = simulator.optimize(verify=True)
+        self.assertEqual(stats, {'instructions': 9, 'folded': 3, 'unreachable': 2,
+                                 'dead': 2, 'optimized': 5})
+        self.assertEqual(simulator.program,
+                         ['LDA T0 5', 'LDA T1 5', 'JMP SKIP', 'LDA T2 X', 'STR Y T2'])
+        # The jump now lands on LDA T2 X, two lines after the JMP
+        self.assertEqual(simulator.labels, {'SKIP': 2})
+        self.assertEqual(simulator.code[2].operands[0].value, 2)
+        simulator.run()
+        self.assertEqual(simulator.state()['memory'], {'X': 5, 'Y': 5})
+
+    def test_moved_target(self):
+        simulator = self.load(MOVED)
+        self.assertEqual(simulator.labels, {'LOOP': 2})
+        stats = simulator.optimize(verify=True)
+        self.assertEqual((stats['dead'], stats['optimized']), (1, 3))
+        self.assertEqual(simulator.program, ['LDA T3 0', 'INC T3', 'BSM T3 N LOOP'])
+        self.assertEqual(simulator.labels, {'LOOP': 0})
+        self.assertEqual(simulator.code[2].operands[2].value, 0)
+        simulator.run()
+        self.assertEqual((simulator.steps, simulator.state()['registers']['T3']), (7, 3))
+
+    def test_target_on_first_instruction(self):
+        simulator = self.load(FIRST)
+        simulator.optimize(verify=True)
+        self.assertEqual([instruction.opcode for instruction in simulator.code],
+                         ['NOP', 'INC', 'BSM'])
+        self.assertEqual(simulator.labels, {'LOOP': 0})
+        simulator.run()
+        self.assertEqual(simulator.state()['registers']['T3'], 3)
+
+    def test_verify_detects_differences(self):
+        simulator = self.load(MOVED)
+        image = self.load(FOLDING).image()
+        with self.assertRaises(main.SimulatorError):
+            simulator.verify(image)
+
+
+if __name__ == '__main__':
+    unittest.main()
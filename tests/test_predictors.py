@@ -0,0 +1,66 @@
+import os
+import unittest
+
+import main
+
+# Loops over T0 = 0 .. 59999, branching on T0 & 3
+BRANCH = os.path.join(main.BENCHMARK_DIR, 'branch.asm')
+
+# Executions and taken counts of every branch: the first three test T0 & 3 against
+# 0, 2 and 1, BBG only runs (and is always taken) when it is 3, and BSM closes the loop
+EXECUTED = {'BEQ T1 0 FOUR': 60000, 'BEQ T1 2 EVEN': 45000, 'BNE T1 1 ODD3': 30000,
+            'BBG T1 2 THREE': 15000, 'BSM T0 N LOOP': 60000}
+TAKEN = {'BEQ T1 0 FOUR': 15000, 'BEQ T1 2 EVEN': 15000, 'BNE T1 1 ODD3': 15000,
+         'BBG T1 2 THREE': 15000, 'BSM T0 N LOOP': 59999}
+
+MISPREDICTED = {
+    'static': TAKEN,
+    'static-taken': {text: EXECUTED[text] - TAKEN[text] for text in EXECUTED},
+    # One miss per change of outcome, the table starting not taken: taken then not
+    # taken once every four iterations, alternating, taken from the start, and the
+    # loop exit
+    '1bit': {'BEQ T1 0 FOUR': 30000, 'BEQ T1 2 EVEN': 30000, 'BNE T1 1 ODD3': 29999,
+             'BBG T1 2 THREE': 1, 'BSM T0 N LOOP': 2},
+    # Counters start weakly not taken: a lone taken outcome misses once, except the
+    # first one of the FOUR branch, which also lifts its counter to weakly taken
+    '2bit': {'BEQ T1 0 FOUR': 15001, 'BEQ T1 2 EVEN': 15000, 'BNE T1 1 ODD3': 15000,
+             'BBG T1 2 THREE': 1, 'BSM T0 N LOOP': 2},
+}
+
+
+class PredictorTest(unittest.TestCase):
+    def by_branch(self, simulator, counts):
+        return {simulator.code[pc].text: count for pc, count in enumerate(counts) if count}
+
+    def test_counts(self):
+        simulator = main.Simulator()
+        simulator.load_program(BRANCH)
+        prediction = simulator.predict(tuple(MISPREDICTED))
+        self.assertTrue(simulator.run())
+        self.assertEqual(self.by_branch(simulator, prediction.counts), EXECUTED)
+        for predictor, (spec, expected) in zip(prediction.predictors, MISPREDICTED.items()):
+            with self.subTest(predictor=spec):
+                self.assertEqual(self.by_branch(simulator, predictor.mispredicts),
+                                 {text: count for text, count in expected.items() if count})
+
+        summary = {entry['predictor']: entry for entry in prediction.summary()}
+        self.assertEqual(summary['2bit:10']['branches'], 210000)
+        self.assertEqual(summary['2bit:10']['mispredictions'], 45004)
+        self.assertEqual(summary['2bit:10']['penalty_cycles'], 2 * 45004)
+
+    def test_gshare(self):
+        # Eight outcomes of history tell the branches of an iteration apart, so once
+        # the history is warm only the loop exit is mispredicted
+        simulator = main.Simulator()
+        simulator.load_program(BRANCH)
+        prediction = simulator.predict(('gshare',))
+        gshare = prediction.predictors[0]
+        simulator.run(1000)
+        warm = sum(gshare.mispredicts)
+        self.assertEqual(warm, 12)
+        simulator.run()
+        self.assertEqual(sum(gshare.mispredicts), warm + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import unittest
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROGRAM = os.path.join(ROOT, 'test.asm')
+# Pushes, pops, stores and register writes in loops
+LOOPS = os.path.join(main.BENCHMARK_DIR, 'stack.asm')
+
+MACHINE = {'memory_size': 16, 'stack_size': 256}
+
+
+def snapshot(simulator):
+    return {'pc': simulator.program_counter.pc,
+            'steps': simulator.steps,
+            'registers': [r.value for r in simulator.registers],
+            'memory': simulator.memory.snapshot(),
+            'stack': simulator.stack.contents().tolist()}
+
+
+class UndoLogTest(unittest.TestCase):
+    def reference(self, path, steps):
+        simulator = main.Simulator(**MACHINE)
+        simulator.load_program(path)
+        simulator.run(steps)
+        return snapshot(simulator)
+
+    def test_step_back(self):
+        simulator = main.Simulator(**MACHINE)
+        simulator.load_program(PROGRAM)
+        simulator.enable_undo()
+        states = [snapshot(simulator)]
+        while not simulator.halted():
+            simulator.step()
+            states.append(snapshot(simulator))
+
+        for expected in reversed(states[:-1]):
+            self.assertTrue(simulator.step_back())
+            self.assertEqual(snapshot(simulator), expected)
+        self.assertFalse(simulator.step_back())
+
+    def test_seek(self):
+        simulator = main.Simulator(**MACHINE)
+        simulator.load_program(LOOPS)
+        undo = simulator.enable_undo(checkpoint_interval=500)
+        simulator.run(20000)
+        for step in (19999, 12345, 500, 0, 7001, 20000, 20250):
+            with self.subTest(step=step):
+                undo.seek(step)
+                self.assertEqual(snapshot(simulator), self.reference(LOOPS, step))
+
+    def test_small_budget(self):
+        simulator = main.Simulator(**MACHINE)
+        simulator.load_program(LOOPS)
+        # Room for 64 undo entries and seven checkpoints of 1088 bytes, so most of
+        # the 300 checkpoints taken are evicted
+        undo = simulator.enable_undo(budget=16384, checkpoint_interval=100)
+        simulator.run(30000)
+        self.assertEqual(len(undo.entries), 64)
+        self.assertLessEqual(undo.checkpoint_bytes, undo.budget // 2)
+        self.assertEqual(undo.checkpoint_interval, 6400)
+        self.assertEqual([checkpoint[0] for checkpoint in undo.checkpoints],
+                         [0, 6400, 12800, 19200, 25600])
+
+        # Steps whose entries were evicted are reached through checkpoints
+        for step in (29995, 29000, 15001, 1, 0, 29990):
+            with self.subTest(step=step):
+                undo.seek(step)
+                self.assertEqual(snapshot(simulator), self.reference(LOOPS, step))
+
+        undo.seek(10)
+        self.assertTrue(simulator.step_back())
+        self.assertEqual(snapshot(simulator), self.reference(LOOPS, 9))
+
+    def test_unobserved_run(self):
+        simulator = main.Simulator(**MACHINE)
+        simulator.load_program(LOOPS)
+        undo = simulator.enable_undo(checkpoint_interval=500)
+        simulator.run(300)
+        simulator.run(4000, observed=False)
+        self.assertEqual(simulator.steps, 4300)
+        self.assertEqual(snapshot(simulator), self.reference(LOOPS, 4300))
+
+        # The engine ran without entries, so stepping back goes through checkpoints
+        for step in (4299, 4298):
+            self.assertTrue(simulator.step_back())
+            self.assertEqual(snapshot(simulator), self.reference(LOOPS, step))
+        undo.seek(150)
+        self.assertEqual(snapshot(simulator), self.reference(LOOPS, 150))
+
+
+if __name__ == '__main__':
+    unittest.main()
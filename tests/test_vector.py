@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+from tests.test_engines import PROGRAMS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Multiplies X by itself N times, pushing every power, then divides 100 by X
+POWERS = ("#DATA\nX 3\nN 4\nRES 0\n#CODE\nLDA T0 X\nLDA T1 N\nLOOP:\nMUL T0 X\n"
+          "PUSH T0\nDEC T1\nBBG T1 0 LOOP\nLDA T2 X\nDIV T2 100\nSTR RES T2\nHLT\n")
+MACHINE = {'stack_size': 8}
+
+# Lanes that run to the end on the vector engine
+VECTOR_LANES = [{}, {'X': 2}, {'X': -7, 'N': 6}, {'N': 0}, {'X': 101, 'RES': 5}]
+# Lanes that fall back to a Simulator: an int64 overflow, division by zero, stack
+# overflow, and an unknown variable
+FALLBACK_LANES = [{'X': 100000, 'N': 5}, {'X': 0}, {'N': 9}, {'Y': 1}]
+
+
+@unittest.skipUnless(numpy, "the vector engine needs numpy")
+class VectorMachineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.directory)
+        cls.path = os.path.join(cls.directory, 'powers.asm')
+        with open(cls.path, 'w') as file:
+            file.write(POWERS)
+
+    def image(self, path):
+        simulator = main.Simulator()
+        simulator.load_program(path)
+        return simulator.image()
+
+    # Every lane of a VectorMachine ends as run_variant leaves it
+    def assert_lanes(self, image, data, max_steps=None, **machine):
+        vector = main.VectorMachine(image, data, **machine)
+        vector.run(max_steps)
+        results = vector.results()
+        self.assertEqual(len(results), len(data))
+        for values, result in zip(data, results):
+            with self.subTest(data=values, max_steps=max_steps):
+                expected = main.run_variant(image, {'data': values}, machine, max_steps)
+                del expected['data']
+                self.assertEqual(result, expected)
+        return vector
+
+    def test_lanes(self):
+        image = self.image(self.path)
+        vector = self.assert_lanes(image, VECTOR_LANES + FALLBACK_LANES, **MACHINE)
+        self.assertEqual(vector.fallbacks.tolist(),
+                         [False] * len(VECTOR_LANES) + [True] * len(FALLBACK_LANES))
+        results = vector.results()
+        self.assertEqual(results[1]['stack'], [4, 8, 16, 32])
+        self.assertEqual(results[1]['memory']['RES'], 50)
+        self.assertEqual(results[len(VECTOR_LANES)]['registers']['T0'], 100000 ** 6)
+        self.assertEqual(results[len(VECTOR_LANES) + 1]['error'], "division by zero")
+
+    def test_step_limits(self):
+        # Limits that stop lanes inside the loop body and at the division
+        image = self.image(self.path)
+        for max_steps in (0, 1, 5, 11, 14):
+            self.assert_lanes(image, VECTOR_LANES + FALLBACK_LANES, max_steps, **MACHINE)
+
+    def test_programs(self):
+        for path in PROGRAMS:
+            image = self.image(path)
+            variables = sorted(image['variables'])
+            data = [{variables[lane % len(variables)]: lane * 7 - 20} for lane in range(16)]
+            self.assert_lanes(image, data, 20000)
+
+
+if __name__ == '__main__':
+    unittest.main()